@@ -0,0 +1,147 @@
+"""
+Benchmarks backing up and restoring a synthetic save, across numbers of workers and codecs.
+
+Writes one json object per measurement to the output file (one per line), so runs can be compared:
+
+    python benchmarks/bench_backup.py --workers 1,4,8 --codec gz,zstd:3
+    python benchmarks/bench_backup.py --baseline bench_output.txt --output new.txt
+"""
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+import click
+
+sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from savegen import SaveProfile, generate_save  # noqa: E402
+from catactl import Backup, Release, chdir, process_chunk  # noqa: E402
+from catactl.codec import Codec  # noqa: E402
+from catactl.config import current_env as env, init_app  # noqa: E402
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def timed(repeat: int, setup, run) -> float:
+    """The median time of running run() repeat times, calling setup() before each run"""
+    times = []
+    for _ in range(repeat):
+        setup()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            run()
+        times.append(time.perf_counter() - t0)
+    return statistics.median(times)
+
+
+def key(result: dict) -> tuple:
+    return result['bench'], result['codec'], result['workers']
+
+
+def compare(results: list, baseline_file: Path):
+    """Prints how much faster or slower each measurement is than the same one in the baseline"""
+    with open(baseline_file) as f:
+        baseline = {key(r): r for r in map(json.loads, f) if r.get('bench')}
+    print(f"{'bench':<14}{'codec':<8}{'workers':>8}{'MiB/s':>10}{'baseline':>10}{'change':>9}")
+    for result in results:
+        before = baseline.get(key(result))
+        line = f"{result['bench']:<14}{result['codec']:<8}{result['workers']:>8}{result['mib_per_s']:>10.1f}"
+        if before:
+            change = result['mib_per_s'] / before['mib_per_s'] - 1
+            line += f"{before['mib_per_s']:>10.1f}{change:>+9.1%}"
+        print(line)
+
+
+@click.command()
+@click.option('--workers', default=f'1,{os.cpu_count()}', show_default=True,
+              help='Comma separated numbers of worker processes to measure with')
+@click.option('--codec', 'codecs', default='gz', show_default=True,
+              help='Comma separated codecs to measure with, optionally with a level (like gz:6,zstd:3)')
+@click.option('--text-codec', help='How to compress text files in backups. Default is the codec being measured, '
+                                   'so all files are compressed the same way')
+@click.option('--scale', type=float, default=1.0, show_default=True,
+              help='Generate this many times the default number of files (about 3000 files and 60 MiB)')
+@click.option('--seed', type=int, default=0, show_default=True, help='Seed of the generated save')
+@click.option('--repeat', type=int, default=3, show_default=True, help='Take the median of this many runs')
+@click.option('--output', type=click.Path(dir_okay=False, path_type=Path), default='bench_output.txt',
+              show_default=True, help='Where to write the results, as one json object per line')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False, path_type=Path),
+              help='Results of an earlier run to compare with')
+@click.option('--keep', is_flag=True, help='Keep the generated save and backups')
+def main(workers, codecs, text_codec, scale, seed, repeat, output, baseline, keep):
+    """Benchmarks process_chunk, Backup.backup and Backup.restore on a generated save."""
+    root = Path(tempfile.mkdtemp(prefix='catactl-bench-'))
+    init_app(root)
+    build = Release(tag_name='bench', file_name='bench.zip', download_url='', timestamp='')
+    generated = generate_save(build.save_target, SaveProfile().scaled(scale), seed)
+    print(f"INFO: generated {generated['files']} files, {generated['bytes'] / (1024*1024):.1f} MiB in {root}")
+
+    meta = {'commit': commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'scale': scale, 'seed': seed, 'text_codec': text_codec, **generated}
+    results = []
+
+    def record(bench: str, codec: Codec, n: int, seconds: float, out_bytes: int = None):
+        result = {'bench': bench, 'codec': str(codec), 'workers': n, 'seconds': round(seconds, 4),
+                  'mib_per_s': round(generated['bytes'] / (1024*1024) / seconds, 2),
+                  'files_per_s': round(generated['files'] / seconds, 1), 'out_bytes': out_bytes, **meta}
+        results.append(result)
+        print(f"{bench:<14}{str(codec):<8}{n:>3} workers {seconds:8.3f}s {result['mib_per_s']:8.1f} MiB/s "
+              f"{result['files_per_s']:9.0f} files/s")
+
+    try:
+        with chdir(build.install_target):
+            files = sorted(str(p) for p in Path('save').glob('**/*') if p.is_file())
+        for spec in codecs.split(','):
+            codec = Codec.parse(spec)
+            spool = root / 'spool'
+
+            def process_all():
+                with chdir(build.install_target):
+                    chunk = process_chunk(files, spool, codec=codec)
+                process_all.out_bytes = chunk.out_bytes
+
+            seconds = timed(repeat, lambda: shutil.rmtree(spool, ignore_errors=True) or spool.mkdir(), process_all)
+            record('process_chunk', codec, 1, seconds, process_all.out_bytes)
+
+            for n in map(int, workers.split(',')):
+                def backup():
+                    backup.id = Backup.backup(build, label='bench', workers=n, codec=spec, text_codec=text_codec or spec)
+
+                def clear_backups():
+                    for path in env.backup_folder.glob(f'*.{env.backup_suffix}'):
+                        path.unlink()
+
+                seconds = timed(repeat, clear_backups, backup)
+                size = (env.backup_folder / f'{backup.id}.{env.backup_suffix}').stat().st_size
+                record('backup', codec, n, seconds, size)
+
+                seconds = timed(repeat, lambda: None, lambda: Backup.restore(build, backup.id, workers=n))
+                record('restore', codec, n, seconds)
+    finally:
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(output, 'w') as f:
+        for result in results:
+            f.write(json.dumps(result) + '\n')
+    print(f"INFO: wrote {len(results)} results to {output}")
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Generates synthetic Cataclysm: DDA saves to benchmark backups with.
+
+A real save has thousands of small map files that compress very well, a few hundred larger overmap and
+map memory files, and a handful of big character files. The generated save mimics that layout, with file sizes
+drawn from a log-normal distribution per kind of file. The same seed always generates the same save.
+"""
+import json
+import math
+import random
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict
+
+
+@dataclass
+class FileKind:
+    """How many files of a kind to generate, and how large they are"""
+    count: int
+    median_bytes: int
+    sigma: float = 0.5
+
+
+@dataclass
+class SaveProfile:
+    worlds: int = 1
+    kinds: Dict[str, FileKind] = field(default_factory=lambda: {
+        'map': FileKind(count=3000, median_bytes=6 * 1024, sigma=0.6),
+        'overmap': FileKind(count=60, median_bytes=120 * 1024, sigma=0.4),
+        'seen': FileKind(count=60, median_bytes=40 * 1024, sigma=0.4),
+        'character': FileKind(count=2, median_bytes=2 * 1024 * 1024, sigma=0.3),
+        'blob': FileKind(count=4, median_bytes=8 * 1024 * 1024, sigma=0.3),
+    })
+
+    def scaled(self, factor: float) -> 'SaveProfile':
+        """The same profile with factor times as many files of each kind (at least one)"""
+        return SaveProfile(self.worlds, {
+            name: FileKind(max(1, round(kind.count * factor)), kind.median_bytes, kind.sigma)
+            for name, kind in self.kinds.items()
+        })
+
+
+terrain = ['t_grass', 't_dirt', 't_floor', 't_wall', 't_tree', 't_shrub', 't_pavement', 't_sidewalk', 't_door_c']
+items = ['rock', 'stick', 'can_beans', 'water_clean', 'knife_butter', 'jeans', 'tshirt', '9mm', 'battery']
+
+
+def json_content(rng: random.Random, size: int) -> bytes:
+    """Map-like json of about the given size, which compresses about as well as real map files"""
+    chunks = []
+    length = 0
+    while length < size:
+        submap = {
+            'coordinates': [rng.randrange(-500, 500), rng.randrange(-500, 500), rng.randrange(-10, 10)],
+            'turn_last_touched': rng.randrange(5_000_000),
+            'terrain': [[rng.choice(terrain), rng.randrange(1, 12)] for _ in range(rng.randrange(3, 10))],
+            'items': [[rng.randrange(12), rng.randrange(12), {'typeid': rng.choice(items), 'charges': rng.randrange(50)}]
+                      for _ in range(rng.randrange(0, 6))],
+        }
+        chunk = json.dumps(submap, separators=(',', ':'))
+        chunks.append(chunk)
+        length += len(chunk) + 1
+    return ('[' + ','.join(chunks) + ']').encode()[:max(size, 2)]
+
+
+def blob_content(rng: random.Random, size: int) -> bytes:
+    """Binary content that compresses a little, like map memory or sound data"""
+    block = rng.randbytes(4096)
+    repeats = bytes(4096)
+    out = bytearray()
+    while len(out) < size:
+        out += block if rng.random() < 0.6 else repeats
+        block = rng.randbytes(4096)
+    return bytes(out[:size])
+
+
+def file_size(rng: random.Random, kind: FileKind) -> int:
+    return max(1, int(rng.lognormvariate(math.log(kind.median_bytes), kind.sigma)))
+
+
+def generate_save(save: Path, profile: SaveProfile = None, seed: int = 0) -> Dict[str, int]:
+    """
+    Generates a save in the given folder.
+
+    :return: the number of files and bytes generated
+    """
+    profile = profile or SaveProfile()
+    rng = random.Random(seed)
+    files = 0
+    total = 0
+
+    def write(path: Path, content: bytes):
+        nonlocal files, total
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        files += 1
+        total += len(content)
+
+    for w in range(profile.worlds):
+        world = save / f'World{w}'
+        write(world / 'worldoptions.json', json_content(rng, 2000))
+        write(world / 'master.gsav', json_content(rng, 20_000))
+        for name, kind in profile.kinds.items():
+            for i in range(kind.count):
+                size = file_size(rng, kind)
+                if name == 'map':
+                    path = world / 'maps' / f'{i // 32}.{i % 32 // 8}.0' / f'{i}.{i % 8}.0.map'
+                    write(path, json_content(rng, size))
+                elif name == 'overmap':
+                    write(world / f'o.{i // 8}.{i % 8}', json_content(rng, size))
+                elif name == 'seen':
+                    write(world / f'#Q2hhcmFjdGVy.seen.{i // 8}.{i % 8}', json_content(rng, size))
+                elif name == 'character':
+                    write(world / f'#Q2hhcmFjdGVy{i}.sav', json_content(rng, size))
+                else:
+                    write(world / '#Q2hhcmFjdGVy.mm1' / f'{i}.mmr', blob_content(rng, size))
+    return {'files': files, 'bytes': total}
@@ -1,27 +1,42 @@
-import random
-import traceback
-import datetime
+from __future__ import annotations
 import dataclasses
-import multiprocessing
 import pathlib
-import shutil
 import sys
-import tarfile
 import io
 import time
-import requests
 import json
-import zipfile
-import pickle
-import subprocess
 import contextlib
 import os
-import psutil
-from urllib.request import urlretrieve
+import stat
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
+from typing import BinaryIO, Collection, Dict, Iterable, List, Optional, Tuple
+from .lazy import lazy_import
 from .config import current_env as env
+from .store import ObjectStore, LinkStore
+from .codec import Codec, classify, kinds
+from .stats import Stats
+
+# heavy modules that only some commands use are imported when first used, to keep startup fast
+traceback = lazy_import('traceback')
+datetime = lazy_import('datetime')
+multiprocessing = lazy_import('multiprocessing')
+shutil = lazy_import('shutil')
+tarfile = lazy_import('tarfile')
+requests = lazy_import('requests')
+zipfile = lazy_import('zipfile')
+pickle = lazy_import('pickle')
+subprocess = lazy_import('subprocess')
+gzip = lazy_import('gzip')
+hashlib = lazy_import('hashlib')
+tempfile = lazy_import('tempfile')
+heapq = lazy_import('heapq')
+statistics = lazy_import('statistics')
+sqlite3 = lazy_import('sqlite3')
+psutil = lazy_import('psutil')
+concurrent_futures = lazy_import('concurrent.futures')
+download = lazy_import('catactl.download')
+github = lazy_import('catactl.github')
 
 
 def chunked(lst, n):
@@ -30,19 +45,266 @@ def chunked(lst, n):
         yield lst[i:i + n]
 
 
+def partition(sizes: dict, n: int) -> List[List[str]]:
+    """
+    Partitions items into at most n bins of roughly equal total size.
+
+    Uses the longest-processing-time-first heuristic: items are placed largest first,
+    each into the bin with the smallest total so far. Ties are broken by name and bin number,
+    and each bin is sorted by name, so the result is deterministic.
+
+    :param sizes: the size of each item, by name
+    :return: the non-empty bins, largest total first
+    """
+    bins = [[] for _ in range(n)]
+    totals = [(0, i) for i in range(n)]
+    for item in sorted(sizes, key=lambda item: (-sizes[item], item)):
+        total, i = heapq.heappop(totals)
+        bins[i].append(item)
+        heapq.heappush(totals, (total + sizes[item], i))
+
+    bins = [sorted(b) for b in bins if b]
+    bins.sort(key=lambda b: -sum(sizes[item] for item in b))
+    return bins
+
+
+def scan_folder(folder: str) -> Tuple[dict, List[str]]:
+    """
+    Finds the regular files directly in a folder, using the stat results of os.scandir.
+    On Windows those come with the directory listing, so the files are not stat'ed at all.
+
+    :return: the size, modification time and mode of each file by path, and the subfolders
+    """
+    files = {}
+    folders = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            path = f'{folder}/{entry.name}'
+            # don't follow links to folders, which may loop
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(path)
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                # a broken link, or the file is gone already
+                continue
+            if stat.S_ISREG(st.st_mode):
+                files[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "mode": stat.S_IMODE(st.st_mode)}
+    return files, folders
+
+
+def scan_tree(root: str, threads: int = 1) -> dict:
+    """
+    Finds the regular files in a folder and its subfolders.
+
+    :param threads: how many folders to scan at once. Listing folders and stat'ing files mostly waits for the disk,
+        so threads help even on a single cpu.
+    :return: the size, modification time and mode of each file, by path (in posix form), sorted by path
+    """
+    files = {}
+    if not os.path.isdir(root):
+        return files
+
+    if threads <= 1:
+        folders = [root]
+        while folders:
+            found, subfolders = scan_folder(folders.pop())
+            files.update(found)
+            folders += subfolders
+    else:
+        with concurrent_futures.ThreadPoolExecutor(threads) as pool:
+            pending = {pool.submit(scan_folder, root)}
+            while pending:
+                done, pending = concurrent_futures.wait(pending, return_when=concurrent_futures.FIRST_COMPLETED)
+                for future in done:
+                    found, subfolders = future.result()
+                    files.update(found)
+                    pending |= {pool.submit(scan_folder, folder) for folder in subfolders}
+    return dict(sorted(files.items()))
+
+
+def start_detached(args: List[str], log: Path = None) -> subprocess.Popen:
+    """
+    Starts a process that carries on after this one exits, and is not interrupted by Ctrl+C in this one.
+
+    :param log: append the output of the process to this file; default is to discard it
+    """
+    if sys.platform == 'win32':
+        detach = {"creationflags": subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        detach = {"start_new_session": True}
+    output = open(log, 'a') if log is not None else subprocess.DEVNULL
+    try:
+        return subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.STDOUT, **detach)
+    finally:
+        if log is not None:
+            output.close()
+
+
+def remove_in_background(paths: List[str]):
+    """Deletes folders in a separate process, which carries on after this one exits"""
+    code = 'import shutil, sys\nfor path in sys.argv[1:]: shutil.rmtree(path, ignore_errors=True)'
+    start_detached([sys.executable, '-c', code, *paths])
+
+
+def claim_folder(folder: Path, proc: psutil.Process = None):
+    """Records that a process (default: this one) is using a temporary folder, see remove_abandoned"""
+    owner = folder / folder_owner_file
+    tmp = owner.with_name(f'{owner.name}.tmp')
+    tmp.write_text(json.dumps(process_record(proc or psutil.Process())))
+    os.replace(tmp, owner)
+
+
+def remove_abandoned(folders: Iterable[Path], grace_seconds: float = 3600) -> List[Path]:
+    """
+    Deletes temporary folders in the background, if the process that claimed them is no longer running.
+
+    :param grace_seconds: delete folders that nobody claimed only once they are this old, as the process
+        that made one may not have claimed it yet. Older versions of catactl did not claim their folders.
+    :return: the folders being deleted
+    """
+    abandoned = []
+    for folder in folders:
+        try:
+            with open(folder / folder_owner_file) as f:
+                owner = json.load(f)
+            if running_process(owner) is None:
+                abandoned.append(folder)
+        except FileNotFoundError:
+            try:
+                if time.time() - folder.stat().st_mtime > grace_seconds:
+                    abandoned.append(folder)
+            except FileNotFoundError:
+                # deleted meanwhile
+                pass
+        except ValueError:
+            abandoned.append(folder)
+    if abandoned:
+        remove_in_background([str(folder.absolute()) for folder in abandoned])
+    return abandoned
+
+
+def lower_priority():
+    """Makes the current process, and the processes it starts after this, give way to others for cpu and disk"""
+    process = psutil.Process()
+    try:
+        if sys.platform == 'win32':
+            process.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+            process.ionice(psutil.IOPRIO_LOW)
+        else:
+            process.nice(10)
+            if hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+                process.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (psutil.Error, OSError):
+        # not allowed to, or not supported: it's only an optimization
+        pass
+
+
+def select_retained(backups: List[str], keep_last: int = 0, keep_hourly: int = 0, keep_daily: int = 0,
+                    keep_weekly: int = 0, keep_monthly: int = 0) -> set:
+    """
+    Selects the backups to keep under a time-bucketed retention policy.
+
+    :param backups: backup ids, in chronologically ascending order
+    :param keep_last: keep this many of the most recent backups
+    :param keep_hourly: keep the most recent backup of each of the last this many hours that have backups.
+        Likewise for keep_daily, keep_weekly and keep_monthly.
+    :return: the ids of the backups to keep. Backups whose id does not start with a timestamp are always kept.
+    """
+    keep = set()
+    dated = []
+    for backup in backups:
+        try:
+            dated.append((datetime.datetime.strptime(backup[:17], '%Y-%m-%d-%H%M%S'), backup))
+        except ValueError:
+            keep.add(backup)
+    dated.sort(reverse=True)
+
+    keep.update(backup for _, backup in dated[:keep_last])
+
+    buckets = [
+        (keep_hourly, lambda t: t.strftime('%Y-%m-%d-%H')),
+        (keep_daily, lambda t: t.strftime('%Y-%m-%d')),
+        (keep_weekly, lambda t: t.isocalendar()[:2]),
+        (keep_monthly, lambda t: t.strftime('%Y-%m')),
+    ]
+    for count, bucket in buckets:
+        seen = set()
+        for timestamp, backup in dated:
+            if len(seen) >= count:
+                break
+            if bucket(timestamp) not in seen:
+                seen.add(bucket(timestamp))
+                keep.add(backup)
+    return keep
+
+
+def record_game_process(proc: psutil.Process):
+    """Remembers a game process, so that get_running_process finds it without scanning all processes"""
+    with open(env.game_process_file, 'w') as f:
+        json.dump(process_record(proc), f)
+
+
+def process_record(proc: psutil.Process) -> dict:
+    """What running_process needs to find a process again: its pid and create_time"""
+    return {'pid': proc.pid, 'create_time': proc.create_time()}
+
+
+def running_process(recorded: dict) -> Optional[psutil.Process]:
+    """
+    Finds a process that was recorded by process_record.
+
+    :return: the process; None if it is no longer running
+    """
+    try:
+        proc = psutil.Process(recorded['pid'])
+        # the pid may have been reused by another process since
+        if proc.create_time() == recorded['create_time'] and proc.is_running():
+            return proc
+    except (KeyError, TypeError, psutil.Error):
+        pass
+    return None
+
+
+def _recorded_game_process() -> Optional[psutil.Process]:
+    """The game process that was recorded, if it is still running"""
+    try:
+        with open(env.game_process_file) as f:
+            proc = running_process(json.load(f))
+        if proc is not None:
+            return proc
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        pass
+    env.game_process_file.unlink(missing_ok=True)
+    return None
+
+
 def get_running_process() -> Optional[psutil.Process]:
     """
     Check if an instance of Cataclysm: Dark Days Ahead is already running.
     Will not detect instances that are not managed by catactl.
 
+    Checks the game that catactl last launched first. Only if that is not running,
+    looks for it among all processes, fetching only their names.
+
     :return: an object representing the running game; None if no game is running.
     """
-    # for pid in psutil.pids():
-    #     proc = psutil.Process(pid)
-    for proc in psutil.process_iter():
-        if 'cataclysm' in proc.name():
-            if env.app_root in Path(proc.exe()).parents:
-                return proc
+    proc = _recorded_game_process()
+    if proc:
+        return proc
+
+    for proc in psutil.process_iter(attrs=['name'], ad_value=''):
+        if 'cataclysm' in (proc.info['name'] or ''):
+            try:
+                if env.app_root in Path(proc.exe()).parents:
+                    record_game_process(proc)
+                    return proc
+            except (psutil.AccessDenied, psutil.NoSuchProcess, psutil.ZombieProcess):
+                continue
+    return None
 
 
 @dataclass
@@ -51,6 +313,8 @@ class Release:
     file_name: str
     download_url: str
     timestamp: str
+    size: int = 0
+    digest: Optional[str] = None
 
     @staticmethod
     def parse(release, pattern='cdda-windows-tiles-x64'):
@@ -63,6 +327,8 @@ class Release:
                 file_name=asset["name"],
                 download_url=asset["browser_download_url"],
                 timestamp=release["published_at"],
+                size=asset.get("size", 0),
+                digest=asset.get("digest"),
             )
         except Exception as e:
             # This release appears to be broken or useless
@@ -83,10 +349,27 @@ class Release:
     def manifest_target(self):
         return self.install_target / 'catactl.manifest'
 
+    @property
+    def members_target(self):
+        """Path to the size and CRC32 of each installed file"""
+        return self.install_target / 'catactl.members.json'
+
     @property
     def save_target(self):
         return self.install_target / 'save'
 
+    def dump_members(self, members: dict):
+        with open(self.members_target, 'w') as f:
+            json.dump(members, f)
+
+    def load_members(self) -> Optional[dict]:
+        """The size and CRC32 of each installed file, by name; None if they were not recorded"""
+        try:
+            with open(self.members_target) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
     def dump(self, target: Path):
         with open(target, 'wb') as pkl:
             pickle.dump(self, pkl)
@@ -101,11 +384,19 @@ class Release:
             print(f"already downloaded {self.file_name}")
             return
 
-        print(f"downloading {self.file_name}")
-        urlretrieve(self.download_url, self.download_target)
+        try:
+            download.fetch(self.download_url, self.download_target, self.size, self.digest, env.download_connections)
+        except (download.DownloadError, requests.RequestException) as e:
+            print(f"ERROR: cannot download {self.file_name}: {e}")
+            print("INFO: run the same command again to resume the download")
+            sys.exit(1)
+
+    def install(self, force=False, stats: Stats = None):
+        """
+        Install the release. Must be downloaded first
 
-    def install(self, force=False):
-        """Install the release. Must be downloaded first"""
+        :param stats: where to record how long each phase took.
+        """
         if self.install_target.exists() and not force:
             print(f"already installed {self.tag_name}")
             return
@@ -117,16 +408,82 @@ class Release:
         if Path(self.file_name).suffix == ".zip":
             self.install_target.mkdir(exist_ok=True, parents=True)
             print(f"installing {self.file_name} to {self.install_target}")
-            with zipfile.ZipFile(env.download_folder / self.file_name, 'r') as f:
-                self.install_target.mkdir(exist_ok=True)
-                f.extractall(self.install_target)
-            self.dump(self.manifest_target)
+            if stats is None:
+                stats = Stats('install')
+            store = LinkStore(env.link_folder)
+            with stats.phase('extract'):
+                members = download.extract(self.download_target, self.install_target, store=store)
+            with stats.phase('write'):
+                store.save()
+                self.dump_members(members)
+                self.dump(self.manifest_target)
+            with stats.phase('gc'):
+                store.gc()
+            stats.count(files=len(members), in_bytes=sum(size for size, crc in members.values()))
         else:
             raise RuntimeError(f"don't know what to do with {self.file_name}")
 
+    def download_and_install(self, force=False, delta=False, stats: Stats = None):
+        """
+        Download and install the release at the same time: each file is extracted as soon as it has been downloaded.
+
+        :param delta: only download the files that changed since the current install, and link the rest.
+            The downloaded archive is not kept.
+        :param stats: where to record how long each phase took. Downloading and extracting overlap,
+            so they are one phase.
+        """
+        if self.install_target.exists() and not force:
+            print(f"already installed {self.tag_name}")
+            return
+
+        if Path(self.file_name).suffix != ".zip":
+            raise RuntimeError(f"don't know what to do with {self.file_name}")
+
+        self.install_target.mkdir(exist_ok=True, parents=True)
+        print(f"installing {self.file_name} to {self.install_target}")
+        if stats is None:
+            stats = Stats('install')
+        store = LinkStore(env.link_folder)
+        if delta:
+            base = get_current_install()
+            base_members = base.load_members() if base else None
+            if base_members is None:
+                print("INFO: the current install does not know its files, so all of them are downloaded")
+            else:
+                print(f"INFO: only downloading the files that changed since {base.tag_name}")
+                with stats.phase('scan'):
+                    store.add_install(base.install_target, base_members)
+        try:
+            with stats.phase('download_and_extract'):
+                members = download.download_and_extract(self.download_url, self.download_target,
+                                                        self.install_target, self.size, self.digest,
+                                                        connections=env.download_connections, store=store,
+                                                        delta=delta)
+        except (download.DownloadError, requests.RequestException) as e:
+            print(f"ERROR: cannot install {self.tag_name}: {e}")
+            print("INFO: run the same command again to resume the download")
+            sys.exit(1)
+        finally:
+            store.save()
+        with stats.phase('write'):
+            self.dump_members(members)
+            self.dump(self.manifest_target)
+        with stats.phase('gc'):
+            store.gc()
+        stats.count(files=len(members), in_bytes=sum(size for size, crc in members.values()))
+
     def run(self):
+        """
+        Launch the release and exit. Must be downloaded and installed first.
+        """
+        self.launch()
+        sys.exit(0)
+
+    def launch(self) -> Optional[psutil.Process]:
         """
         Launch the release. Must be downloaded and installed first.
+
+        :return: the game process; None if it exited already
         """
         if not self.install_target.exists():
             print(f"ERROR: Not installed: {self.tag_name}")
@@ -135,8 +492,14 @@ class Release:
         cwd = str(self.install_target)
         exe = "cataclysm-tiles"
         print(f"running {exe} from {cwd}")
-        p = subprocess.Popen([exe], shell=True, cwd=str(cwd))
-        sys.exit(0)
+        # no shell in between, so the process is the game itself and can be recorded
+        p = subprocess.Popen([str(self.install_target / exe)], cwd=cwd)
+        try:
+            process = psutil.Process(p.pid)
+            record_game_process(process)
+            return process
+        except psutil.NoSuchProcess:
+            return None
 
     def __json__(self):
         n = {"__dataclass__": self.__class__.__name__}
@@ -156,18 +519,386 @@ def chdir(path: Path = None):
         os.chdir(cwd)
 
 
-def process_chunk(files: List[str]):
-    in_bytes = 0
-    buffer = io.BytesIO()
-    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+@dataclass
+class ChunkResult:
+    parts: List[Path]
+    in_bytes: int
+    out_bytes: int
+    files: dict = dataclasses.field(default_factory=dict)
+    part_entries: dict = dataclasses.field(default_factory=dict)
+    kinds: dict = dataclasses.field(default_factory=dict)  # codec, files, input and output bytes by kind of file
+
+
+class HashingReader(io.RawIOBase):
+    """Wraps a binary file object to compute the sha256 of what is read from it"""
+    def __init__(self, fileobj):
+        super().__init__()
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+class HashingWriter:
+    """Wraps a binary file object to compute the sha256 of what is written to it"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+# files up to this size are read whole before they are added to a part, so the size in their tar header is the size
+# of what was read even if the game writes them meanwhile. Larger files are checked for having changed instead
+whole_read_limit = 1024 * 1024
+
+
+class PartWriter:
+    """Writes files into a compressed tar file: one part of a backup"""
+    def __init__(self, path: Path, codec: Codec):
+        self.path = path
+        self.in_bytes = 0
+        self.file = open(path, 'wb')
+        self.out = HashingWriter(self.file)
+        self.compressed = codec.open_writer(self.out)
+        self.tar = tarfile.open(fileobj=self.compressed, mode='w|')
+
+    def add(self, path: str, entry: dict = None, fileobj: BinaryIO = None) -> dict:
+        """
+        Adds a file to the part.
+
+        The size is the size of the file as it is read, not as it was scanned: the file may have changed since.
+
+        :param entry: the modification time and mode of the file, if they are known already.
+            Otherwise the file is stat'ed.
+        :param fileobj: the file opened for reading, at its start. Default is to open it.
+        :raise OSError: if a file larger than whole_read_limit changed size while it was added.
+            The part is unusable then.
+        :return: the index entry of the file: the part, the offset of the file within the uncompressed part,
+            its size and its sha256
+        """
+        offset = self.tar.offset
+        with open(path, 'rb') if fileobj is None else contextlib.nullcontext(fileobj) as f:
+            if entry is None:
+                tarinfo = self.tar.gettarinfo(arcname=path, fileobj=f)
+            else:
+                tarinfo = tarfile.TarInfo(path)
+                tarinfo.size = os.fstat(f.fileno()).st_size
+                tarinfo.mtime = entry["mtime_ns"] // 1_000_000_000
+                tarinfo.mode = entry.get("mode", 0o644)
+            if tarinfo.size <= whole_read_limit:
+                data = f.read()
+                tarinfo.size = len(data)
+                reader = HashingReader(io.BytesIO(data))
+                self.tar.addfile(tarinfo, reader)
+            else:
+                reader = HashingReader(f)
+                try:
+                    self.tar.addfile(tarinfo, reader)
+                except OSError as e:
+                    raise OSError(f'{path} got shorter while it was backed up') from e
+                if f.read(1):
+                    raise OSError(f'{path} grew while it was backed up')
+        self.in_bytes += tarinfo.size
+        return {"part": self.path.name, "offset": offset, "size": tarinfo.size, "sha256": reader.hash.hexdigest()}
+
+    def close(self) -> dict:
+        """
+        Finishes the part.
+
+        :return: the index entry of the part: its size and sha256
+        """
+        self.tar.close()
+        self.compressed.close()
+        self.file.close()
+        return {"size": self.path.stat().st_size, "sha256": self.out.hash.hexdigest()}
+
+
+def process_chunk(files: List[str], spool: Path, name: str = 'part-1', max_part_bytes: int = None,
+                  codec: Codec = Codec(), entries: dict = None, text_codec: Codec = None) -> ChunkResult:
+    """
+    Compresses the files into tar files in the spool folder.
+
+    Files are sorted into separate parts by what they contain (see classify):
+    files that are compressed already are stored without compressing them again,
+    and text is compressed with text_codec if one is given.
+
+    Starts a new part whenever max_part_bytes of input have been written to the current one,
+    so no part grows much beyond that (unless a single file is larger).
+    The parts are named after the chunk, the kind of file unless it is 'other', and the suffix of the codec:
+    name.tgz, name-2.tgz, name-raw.tar, name-text.tbz2, name-text-2.tbz2 and so on.
+
+    :param entries: the size, modification time and mode of the files by path, as found by scan_tree,
+        so they are not stat'ed again. Files that are not in it are stat'ed. The size in a part is always
+        the size of the file as it was read, which may have changed since the scan.
+    :param text_codec: how to compress text; None to compress it with codec, in the same parts as other files.
+    """
+    entries = entries or {}
+    codecs = {'raw': Codec('none'), 'text': text_codec or codec, 'other': codec}
+    result = ChunkResult(parts=[], in_bytes=0, out_bytes=0)
+    writers = {}  # the part being written, and the number of parts so far, of each kind
+    try:
         for path in files:
-            tarinfo = tar.gettarinfo(path)
-            in_bytes += tarinfo.size
+            scanned = entries.get(path)
+            # the file is opened once, both to classify it and to add it
             with open(path, 'rb') as f:
-                tar.addfile(tarinfo, f)
-    out_bytes = buffer.tell()
-    buffer.seek(0)
-    return buffer, in_bytes, out_bytes
+                kind = classify(path, f, scanned and scanned["size"])
+                if kind == 'text' and text_codec is None:
+                    kind = 'other'
+                part, n = writers.get(kind, (None, 0))
+                if part is None or (max_part_bytes and part.in_bytes >= max_part_bytes):
+                    if part is not None:
+                        result.part_entries[part.path.name] = part.close()
+                        result.kinds[kind]["out_bytes"] += result.part_entries[part.path.name]["size"]
+                    n += 1
+                    stem = name if kind == 'other' else f'{name}-{kind}'
+                    suffix = codecs[kind].suffix
+                    result.parts.append(Path(spool) / (f'{stem}{suffix}' if n == 1 else f'{stem}-{n}{suffix}'))
+                    part = PartWriter(result.parts[-1], codecs[kind])
+                    writers[kind] = (part, n)
+                    result.kinds.setdefault(kind, {"codec": str(codecs[kind]), "files": 0, "in_bytes": 0,
+                                                   "out_bytes": 0})
+                entry = part.add(path, scanned, f)
+            result.files[path] = entry
+            result.in_bytes += entry["size"]
+            result.kinds[kind]["files"] += 1
+            result.kinds[kind]["in_bytes"] += entry["size"]
+    finally:
+        for kind, (part, n) in writers.items():
+            result.part_entries[part.path.name] = part.close()
+            result.kinds[kind]["out_bytes"] += result.part_entries[part.path.name]["size"]
+
+    result.out_bytes = sum(entry["size"] for entry in result.part_entries.values())
+    return result
+
+
+def store_chunk(files: List[str], store: ObjectStore, scanned: dict = None):
+    """
+    Stores the content of each file in the object store
+
+    :param scanned: the modification times of the files by path, as found by scan_tree, so they are not stat'ed again
+    """
+    entries = {}
+    in_bytes = 0
+    out_bytes = 0
+    for path in files:
+        mtime_ns = scanned[path]["mtime_ns"] if scanned and path in scanned else os.stat(path).st_mtime_ns
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = store.digest(data)
+        out_bytes += store.put(data, digest)
+        in_bytes += len(data)
+        entries[path] = {"size": len(data), "mtime_ns": mtime_ns, "sha256": digest}
+    return entries, in_bytes, out_bytes
+
+
+def restore_objects(entries: dict, store: ObjectStore) -> List[str]:
+    """
+    Writes the files listed in a deduplicating backup's manifest from the object store.
+
+    :return: the paths of the files written
+    """
+    for path, entry in entries.items():
+        target = Path(path)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(store.get(entry["sha256"]))
+    return list(entries)
+
+
+class FileSlice(io.RawIOBase):
+    """Read-only file object for size bytes starting at offset in the file at path"""
+    def __init__(self, path: Path, offset: int, size: int):
+        super().__init__()
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.file.readinto(memoryview(b)[:min(len(b), self.remaining)])
+        self.remaining -= n
+        return n
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def restore_part(archive: Path, offset: int, size: int, codec: Codec, wanted: Optional[frozenset],
+                 start: int = 0) -> List[str]:
+    """
+    Extracts one compressed part of a backup archive into the current directory.
+
+    :param archive: path to the backup archive
+    :param offset: where the part starts in the archive
+    :param size: size of the part
+    :param codec: the compression of the part
+    :param wanted: extract only these files; None to extract everything.
+        Stops reading the part as soon as all of them have been extracted.
+    :param start: skip to this offset in the uncompressed part. Must be the offset of a file in the part.
+    :return: the paths of the files extracted
+    """
+    extracted = []
+    with codec.open_reader(io.BufferedReader(FileSlice(archive, offset, size))) as reader:
+        while start > 0:
+            skipped = len(reader.read(min(start, 1024 * 1024)))
+            if not skipped:
+                raise EOFError(f'{archive} is truncated')
+            start -= skipped
+
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in tar:
+                if wanted is None or member.name in wanted:
+                    # backups made by older versions of catactl don't say which directories to create up front
+                    os.makedirs(os.path.dirname(member.name) or '.', exist_ok=True)
+                    tar.extract(member, '.')
+                    extracted.append(member.name)
+                    if wanted is not None and len(extracted) == len(wanted):
+                        break
+    return extracted
+
+
+def verify_part(archive: Path, name: str, offset: int, size: int, expected: Optional[dict],
+                expected_files: dict) -> List[str]:
+    """
+    Checks one compressed part of a backup archive, reading it only once.
+
+    :param archive: path to the backup archive
+    :param name: name of the part
+    :param offset: where the part starts in the archive
+    :param size: size of the part
+    :param expected: the size and sha256 of the part; None if unknown.
+    :param expected_files: the sha256 of each file that should be in the part, by path
+    :return: descriptions of the problems found
+    """
+    codec = Codec.from_part_name(name)
+    problems = []
+    missing = dict(expected_files)
+    try:
+        with FileSlice(archive, offset, size) as raw:
+            compressed = HashingReader(io.BufferedReader(raw))
+            with codec.open_reader(compressed) as reader:
+                with tarfile.open(fileobj=reader, mode='r|') as tar:
+                    for member in tar:
+                        content = HashingReader(tar.extractfile(member))
+                        while content.read(1024 * 1024):
+                            pass
+                        digest = missing.pop(member.name, None)
+                        if digest is not None and digest != content.hash.hexdigest():
+                            problems.append(f'{member.name} in {name} is corrupt')
+            # hash whatever follows the end of the tar too
+            while compressed.read(1024 * 1024):
+                pass
+    except Exception as e:
+        # whatever the codec throws at us, the part is broken
+        problems.append(f'cannot read {name}: {e}')
+        return problems
+
+    if expected is not None and (expected["size"] != size or expected["sha256"] != compressed.hash.hexdigest()):
+        problems.append(f'part {name} is corrupt')
+    problems += [f'{path} is missing from {name}' for path in sorted(missing)]
+    return problems
+
+
+def verify_objects(digests: List[str], store: ObjectStore) -> dict:
+    """
+    Checks that objects are stored intact.
+
+    :return: a description of the problem with each broken object, by name
+    """
+    problems = {}
+    for digest in digests:
+        try:
+            if store.digest(store.get(digest)) != digest:
+                problems[digest] = f'object {digest} is corrupt'
+        except FileNotFoundError:
+            problems[digest] = f'object {digest} is missing'
+        except Exception as e:
+            problems[digest] = f'cannot read object {digest}: {e}'
+    return problems
+
+
+def is_unchanged(previous: Optional[dict], current: dict) -> bool:
+    """Compares manifest entries of a file by size and modification time"""
+    return previous is not None and \
+        previous["size"] == current["size"] and previous["mtime_ns"] == current["mtime_ns"]
+
+
+metadata_member = 'catactl.json.gz'
+index_member = 'index.json.gz'
+# restores extract into the staging folder of the build, with a journal saying how far they got
+staging_folder = '.restore'
+restore_journal = 'restore.json'
+# and move the save they replace to the trash folder
+trash_folder = '.trash'
+# a restore, or recovering from one, holds this lock in the build folder, so no other process touches its staging
+restore_lock = '.restore.lock'
+# snapshots of the save to back up in the background are folders next to it, named with this prefix
+snapshot_prefix = '.snapshot-'
+# backups spool their parts to a folder in the backup folder
+spool_prefix = '.spool-'
+# snapshots and spools record the process using them in this file, so recover() can tell when they are abandoned
+folder_owner_file = 'owner.json'
+
+
+def write_json_member(tar: tarfile.TarFile, name: str, obj):
+    """Adds a gzip compressed json document to the tar"""
+    data = gzip.compress(json.dumps(obj, separators=(',', ':')).encode('utf-8'), mtime=0)
+    tarinfo = tarfile.TarInfo(name=name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    tar.addfile(tarinfo, io.BytesIO(data))
+    return len(data)
+
+
+def read_json_member(tar: tarfile.TarFile, tarinfo: tarfile.TarInfo):
+    """Reads a gzip compressed json document from the tar"""
+    with tar.extractfile(tarinfo) as f:
+        return json.loads(gzip.decompress(f.read()))
+
+
+@dataclass
+class BackupDiff:
+    """The files that were added, removed and modified between two versions of a save, by path"""
+    added: dict = dataclasses.field(default_factory=dict)
+    removed: dict = dataclasses.field(default_factory=dict)
+    modified: Dict[str, Tuple[dict, dict]] = dataclasses.field(default_factory=dict)
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while data := f.read(1024 * 1024):
+            h.update(data)
+    return h.hexdigest()
+
+
+def same_content(old: dict, new: dict) -> bool:
+    """
+    Compares index entries of a file by sha256 if both have one, otherwise by size and modification time.
+    Backups made by older versions of catactl know neither, so only their sizes can be compared.
+    """
+    if old["size"] != new["size"]:
+        return False
+    if "sha256" in old and "sha256" in new:
+        return old["sha256"] == new["sha256"]
+    if "mtime_ns" in old and "mtime_ns" in new:
+        return old["mtime_ns"] == new["mtime_ns"]
+    return True
 
 
 class Backup:
@@ -176,26 +907,74 @@ class Backup:
 
     Uses multiprocessing to improve backup speed, especially
     on systems where storage read speed outstrips the compression speed of a single CPU core.
-    The resulting archive is a plain TAR formatted file containing a number of .tgz files,
-    each .tgz containing parts of the save.
+    The resulting archive is a plain TAR formatted file containing a number of compressed tar files,
+    each containing parts of the save. They are .tgz files by default, but other codecs can be chosen
+    and the suffix of each part tells restores how to decompress it.
+
+    The worker processes compress into temporary parts of bounded size next to the backup
+    and the main process moves each one into the archive as soon as it is done,
+    so memory use does not depend on the size of the save.
+
+    The first member of the archive is a manifest (catactl.json.gz) with the size and modification time
+    of every file in the save. Files are recognized as unchanged by their size and modification time,
+    so they are neither read nor written again:
+
+    Incremental backups only compress the files that changed since their parent backup,
+    and restoring one walks the chain of parent backups to rebuild the whole save.
 
-    May keep all of the .tgz files in memory while compressing,
-    so please don't let your saves approach 8-10x your available RAM in size :)
+    Deduplicating backups store the content of each file once in the shared object store,
+    and the archive only contains the manifest mapping each file to an object.
 
-    Restores are single-threaded to prevent hypothetical race conditions involving directory creation,
-    so they may be slower than backups.
+    Restores extract the parts in parallel too. The directories are created up front from the manifest,
+    so the processes don't race to create them.
+    They extract into a staging folder that replaces the save when it is complete, see restore().
     """
+    modes = ('full', 'incremental', 'dedup')
+    schedules = ('balanced', 'steal')
+
     @staticmethod
-    def backup(build: Release, label: str = None) -> str:
+    def backup(build: Release, label: str = None, mode: str = 'full', max_part_bytes: int = None,
+               workers: int = None, schedule: str = 'balanced', verbose: bool = False, codec: str = None,
+               stats: Stats = None, snapshot: dict = None, source: Path = None, text_codec: str = None) -> str:
         """
         Backs up the save of the given build.
 
         :param build: which installed build to back up from.
         :param label: a label for the backup. Default is to label it with the build tag.
+        :param mode: 'full' compresses the whole save into the backup.
+            'incremental' only compresses files that changed since the most recent backup.
+            Once the chain of incremental backups is long (see Backup.chain_is_long), it compresses the whole
+            save again to start a new chain.
+            'dedup' only stores new or changed files, in the object store shared by all deduplicating backups.
+        :param max_part_bytes: how many bytes of the save to compress into each part. Default is env.backup_part_size.
+        :param workers: how many processes to compress with. Default is two per cpu.
+        :param schedule: 'balanced' gives each process one task of about the same number of bytes.
+            'steal' splits the work into many small tasks that idle processes pick up as they go.
+        :param verbose: report how much work each process did.
+        :param codec: how to compress the parts, like 'gz:6' or 'zstd'. Default is env.backup_codec.
+            Files that are compressed already are stored as they are.
+        :param text_codec: how to compress text files, like the json of the save, like 'bz2'.
+            Default is env.backup_text_codec, or if that is None the same as the other files.
+        :param stats: where to record how long each phase took and what the worker processes did.
+        :param snapshot: the files in the save as scan() finds them, if they are known already (like when watching
+            the save), so the save is not scanned again.
+        :param source: the folder that contains the save to back up, like one made by snapshot().
+            Default is the folder of the build.
         :return: the backup id (timestamp + label)
         """
+        if mode not in Backup.modes:
+            raise ValueError(f"unknown backup mode {mode}")
+        if schedule not in Backup.schedules:
+            raise ValueError(f"unknown schedule {schedule}")
         if label is None:
             label = build.tag_name
+        if max_part_bytes is None:
+            max_part_bytes = env.backup_part_size
+        codec = Codec.parse(codec or env.backup_codec)
+        text_codec = text_codec or env.backup_text_codec
+        text_codec = Codec.parse(text_codec) if text_codec else None
+        if stats is None:
+            stats = Stats('backup')
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d-%H%M%S')
         backup_id = f'{timestamp}-{label}'
         file_name = f'{backup_id}.{env.backup_suffix}'
@@ -204,58 +983,55 @@ class Backup:
 
         t0 = time.monotonic()
 
-        with chdir(build.install_target):
-            files = [str(file) for file in Path("save").glob('**/*') if file.is_file()]
-
-            # Try to send a similar amount of data to each process.
-            # We could do a real algorithm but random shuffle should be good enough.
-            cpu_count = multiprocessing.cpu_count() * 2
-            chunk_size = 1 + int(len(files) / cpu_count)
-            random.seed(2)  # fixed seed for deterministic output
-            random.shuffle(files)
-            chunks = chunked(files, chunk_size)
-
-            part = 1
-            errors = []
-            in_bytes_sum = 0
-            out_bytes_sum = 0
+        with chdir(source or build.install_target):
+            Backup.recover()
+            with stats.phase('scan'):
+                if snapshot is None:
+                    snapshot = Backup.scan()
+            files = list(snapshot)
+            if workers is None:
+                workers = multiprocessing.cpu_count() * 2
+
+            parent_id, parent, chain = None, None, []
+            if mode == 'incremental':
+                parent_id, parent = Backup.latest_metadata()
+                if parent:
+                    chain = Backup.get_chain_ids(parent_id, parent)
+                    if Backup.chain_is_long(chain):
+                        print(f" (a new chain, {parent_id} has {len(chain) - 1} incremental backups below it)",
+                              end='', flush=True)
+                        parent_id, parent, chain = None, None, []
+            elif mode == 'dedup':
+                parent_id, parent = Backup.latest_metadata(mode='dedup')
+
+            changed = files
+            if mode == 'incremental' and parent:
+                changed = [path for path, entry in snapshot.items() if not is_unchanged(parent["files"].get(path), entry)]
 
             # open a plain tar file for writing each compressed chunk
-            with tarfile.open(backup_target, mode='w') as tar:
-
-                def on_result(r):
-                    """Writes a chunk of .tgz compressed files to the output tar"""
-                    buffer, in_bytes, out_bytes = r
-                    nonlocal tar, part, out_bytes_sum, in_bytes_sum
-
-                    # output the compressed chunk
-                    tarinfo = tarfile.TarInfo(name=f"part-{part}.tgz")
-                    tarinfo.size = out_bytes
-                    tarinfo.mtime = time.time()
-                    tar.addfile(tarinfo, buffer)
-
-                    # bean-counting
-                    part += 1
-                    in_bytes_sum += in_bytes
-                    out_bytes_sum += out_bytes
-                    print('.', end='', flush=True)
-
-                def on_error(e):
-                    """Records the failure to compress a chunk"""
-                    nonlocal errors
-                    traceback.print_exception(type(e), e, e.__traceback__)
-                    errors.append(e)
-                    print('X', end='', flush=True)
-
-                # Compress one chunk of files per cpu
-                with multiprocessing.Pool(cpu_count) as pool:
-                    for chunk in chunks:
-                        pool.apply_async(process_chunk, (chunk,), callback=on_result, error_callback=on_error)
-                    pool.close()
-                    pool.join()
-                    print()
-
-            if in_bytes_sum == 0:
+            with open(backup_target, 'wb') as archive:
+                with tarfile.open(fileobj=archive, mode='w') as tar:
+                    if mode == 'dedup':
+                        errors, in_bytes_sum, out_bytes_sum = Backup._backup_objects(
+                            tar, snapshot, workers, parent, stats)
+                    else:
+                        metadata = {"version": 1, "mode": mode, "parent": parent_id, "chain": chain,
+                                    "codec": str(codec),
+                                    "text_codec": text_codec and str(text_codec), "files": snapshot}
+                        with stats.phase('write'):
+                            write_json_member(tar, metadata_member, metadata)
+                        sizes = {path: snapshot[path]["size"] for path in changed}
+                        errors, in_bytes_sum, out_bytes_sum = Backup._backup_parts(
+                            tar, snapshot, sizes, workers, max_part_bytes, schedule, verbose, codec, text_codec, stats)
+
+                # make sure the backup is on disk before it is reported as done.
+                # the tar does not close a file it was given, so this includes its end of archive marker
+                with stats.phase('fsync'):
+                    archive.flush()
+                    os.fsync(archive.fileno())
+            stats.count(files=len(files), changed_files=len(changed), in_bytes=in_bytes_sum, out_bytes=out_bytes_sum)
+
+            if not files:
                 errors.append(f'Nothing to back up for {build.tag_name}')
 
             if errors:
@@ -263,12 +1039,21 @@ class Backup:
                 backup_target.unlink(missing_ok=True)
                 sys.exit(1)
 
-            compression_rate = 1.0 - out_bytes_sum / in_bytes_sum
-            print(
-                f'INFO: compressed {in_bytes_sum / (1024*1024) :.1f} MiB '
-                f'in {len(files)} files '
-                f'to {out_bytes_sum / (1024*1024) :.1f} MiB '
-                f'at {compression_rate*100 :.1f}% compression rate')
+            if mode == 'dedup':
+                print(
+                    f'INFO: deduplicated {in_bytes_sum / (1024*1024) :.1f} MiB '
+                    f'in {len(files)} files '
+                    f'by writing {out_bytes_sum / (1024*1024) :.1f} MiB')
+            else:
+                if parent_id:
+                    print(f'INFO: {len(changed)} of {len(files)} files changed since {parent_id}')
+                if in_bytes_sum:
+                    compression_rate = 1.0 - out_bytes_sum / in_bytes_sum
+                    print(
+                        f'INFO: compressed {in_bytes_sum / (1024*1024) :.1f} MiB '
+                        f'in {len(changed)} files '
+                        f'to {out_bytes_sum / (1024*1024) :.1f} MiB '
+                        f'at {compression_rate*100 :.1f}% compression rate')
 
             t1 = time.monotonic()
             t = t1 - t0
@@ -279,51 +1064,821 @@ class Backup:
         return backup_id
 
     @staticmethod
-    def restore(build: Release, backup: str):
-        with chdir(env.backup_folder):
+    def snapshot(build: Release) -> Path:
+        """
+        Captures the save of a build as it is now, much faster than backing it up, so it can be backed up later.
+
+        The files are hard linked into a new folder next to the save, or copied where the file system cannot link.
+        The game replaces the files of the save rather than writing into them, so the links keep their content
+        while the game goes on saving.
+
+        :return: the folder, with the save in it as 'save'. Back it up with backup(source=...).
+        """
+        folder = build.install_target / f'{snapshot_prefix}{time.time_ns()}'
+        folder.mkdir()
+        claim_folder(folder)
+        with chdir(build.install_target):
+            files = Backup.scan()
+        created = set()
+        for path in files:
+            target = folder / path
+            if target.parent not in created:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                created.add(target.parent)
+            try:
+                os.link(build.install_target / path, target)
+            except OSError:
+                shutil.copy2(build.install_target / path, target)
+        return folder
+
+    @staticmethod
+    def backup_in_background(snapshot: Path, label: str = None, mode: str = 'full', codec: str = None):
+        """
+        Backs up a snapshot of the current build in a separate process with low priority,
+        which carries on after this one exits and removes the snapshot when it is done.
+        Its output goes to env.background_log.
+        """
+        args = [sys.executable, '-m', 'catactl.catactl', 'backup', '--snapshot', str(snapshot), '--mode', mode]
+        if label:
+            args += ['--label', label]
+        if codec:
+            args += ['--codec', codec]
+        process = start_detached(args, log=env.background_log)
+        try:
+            claim_folder(snapshot, psutil.Process(process.pid))
+        except psutil.NoSuchProcess:
+            # it is done already
+            pass
+        print(f"INFO: backing up in the background. See {env.background_log} for how it went")
+
+    @staticmethod
+    def scan(threads: int = None) -> dict:
+        """
+        Finds the files in the save of the current directory.
+
+        :param threads: how many folders to scan at once. Default is env.scan_threads.
+        :return: the size, modification time and mode of each file, by path
+        """
+        return scan_tree('save', threads or env.scan_threads)
+
+    @staticmethod
+    def _backup_parts(tar: tarfile.TarFile, snapshot: dict, sizes: dict, workers: int, max_part_bytes: int,
+                      schedule: str, verbose: bool, codec: Codec, text_codec: Optional[Codec], stats: Stats):
+        """
+        Compresses the files in sizes into parts of the backup, using what the scan found out about them.
+
+        :return: the errors, the bytes of the files, and the bytes of the parts they were compressed to
+        """
+        # Send a similar amount of data to each process.
+        # When stealing work, make many smaller tasks that idle processes pick up as they finish their previous one.
+        # The largest tasks are submitted first, so no process is left with a big task at the end.
+        task_count = workers * 8 if schedule == 'steal' else workers
+        chunks = partition(sizes, task_count)
+
+        errors = []
+        in_bytes_sum = 0
+        out_bytes_sum = 0
+        index = {}
+        part_index = {}
+        by_kind = {}
+
+        def on_result(r: ChunkResult):
+            """Moves the compressed parts of a chunk into the output tar"""
+            nonlocal out_bytes_sum, in_bytes_sum
+            with stats.phase('write'):
+                for path in r.parts:
+                    tar.add(str(path), arcname=path.name)
+                    path.unlink()
+
+            # bean-counting
+            index.update(r.files)
+            part_index.update(r.part_entries)
+            in_bytes_sum += r.in_bytes
+            out_bytes_sum += r.out_bytes
+            for kind, counts in r.kinds.items():
+                total = by_kind.setdefault(kind, {"codec": counts["codec"], "files": 0, "in_bytes": 0, "out_bytes": 0})
+                for name in ("files", "in_bytes", "out_bytes"):
+                    total[name] += counts[name]
+            print('.', end='', flush=True)
+
+        def on_error(e):
+            """Records the failure to compress a chunk"""
+            traceback.print_exception(type(e), e, e.__traceback__)
+            errors.append(e)
+            print('X', end='', flush=True)
+
+        # Compress the chunks, spooling the parts to a temporary folder next to the backup
+        if chunks:
+            spool = Path(tempfile.mkdtemp(prefix=spool_prefix, dir=env.backup_folder))
+            try:
+                claim_folder(spool)
+                with stats.phase('compress'), multiprocessing.Pool(min(workers, len(chunks))) as pool:
+                    for i, chunk in enumerate(chunks, start=1):
+                        entries = {path: snapshot[path] for path in chunk}
+                        args = (chunk, spool, f"part-{i}", max_part_bytes, codec, entries, text_codec)
+                        stats.submit(pool, process_chunk, args, sum(sizes[path] for path in chunk),
+                                     callback=on_result, error_callback=on_error)
+                    pool.close()
+                    pool.join()
+            finally:
+                shutil.rmtree(spool, ignore_errors=True)
+        print()
+
+        # the index goes last, when the parts are known. Reading it back needs a seekable archive anyway
+        index = {"version": 1, "files": dict(sorted(index.items())), "parts": dict(sorted(part_index.items()))}
+        with stats.phase('write'):
+            write_json_member(tar, index_member, index)
+
+        if stats.workers:
+            busy = [worker["seconds"] for worker in stats.workers.values()]
+            print(f'INFO: {len(busy)} workers were busy for {min(busy):.2f} to {max(busy):.2f} seconds '
+                  f'(median {statistics.median(busy):.2f})')
+            if verbose:
+                for pid, worker in sorted(stats.workers.items()):
+                    print(f'INFO: worker {pid} compressed {worker["bytes"] / (1024*1024) :.1f} MiB '
+                          f'in {worker["tasks"]} tasks in {worker["seconds"]:.2f} seconds '
+                          f'after waiting {worker["queue_wait"]:.2f} seconds in the queue')
+
+        # report where the time went: compressing text hard and not compressing what is compressed already
+        descriptions = {'raw': 'files that are compressed already', 'text': 'text files', 'other': 'other files'}
+        for kind in kinds:
+            if kind in by_kind:
+                counts = by_kind[kind]
+                print(f'INFO: {counts["in_bytes"] / (1024*1024) :.1f} MiB in {counts["files"]} {descriptions[kind]} '
+                      f'took {counts["out_bytes"] / (1024*1024) :.1f} MiB with {counts["codec"]}')
+                stats.count(**{f'{kind}_{name}': counts[name] for name in ("files", "in_bytes", "out_bytes")})
+
+        return errors, in_bytes_sum, out_bytes_sum
+
+    @staticmethod
+    def _backup_objects(tar: tarfile.TarFile, snapshot: dict, workers: int, parent: Optional[dict], stats: Stats):
+        """Stores new or changed files in the object store and writes the manifest of the backup"""
+        store = ObjectStore(env.object_folder)
+
+        # files that are unchanged since the previous deduplicating backup don't have to be read again
+        known = parent["files"] if parent else {}
+        entries = {}
+        changed = []
+        in_bytes_sum = 0
+        for path, entry in snapshot.items():
+            if is_unchanged(known.get(path), entry):
+                entries[path] = known[path]
+                in_bytes_sum += entry["size"]
+            else:
+                changed.append(path)
+
+        errors = []
+        out_bytes_sum = 0
+
+        def on_result(r):
+            """Records the stored objects"""
+            stored, in_bytes, out_bytes = r
+            nonlocal in_bytes_sum, out_bytes_sum
+            entries.update(stored)
+            in_bytes_sum += in_bytes
+            out_bytes_sum += out_bytes
+            print('.', end='', flush=True)
+
+        def on_error(e):
+            """Records the failure to store a chunk"""
+            traceback.print_exception(type(e), e, e.__traceback__)
+            errors.append(e)
+            print('X', end='', flush=True)
+
+        if changed:
+            chunks = partition({path: snapshot[path]["size"] for path in changed}, workers)
+            with stats.phase('compress'), multiprocessing.Pool(len(chunks)) as pool:
+                for chunk in chunks:
+                    scanned = {path: snapshot[path] for path in chunk}
+                    stats.submit(pool, store_chunk, (chunk, store, scanned),
+                                 sum(snapshot[path]["size"] for path in chunk),
+                                 callback=on_result, error_callback=on_error)
+                pool.close()
+                pool.join()
+        print()
+
+        metadata = {"version": 1, "mode": "dedup", "parent": None, "files": dict(sorted(entries.items()))}
+        with stats.phase('write'):
+            out_bytes_sum += write_json_member(tar, metadata_member, metadata)
+        return errors, in_bytes_sum, out_bytes_sum
+
+    @staticmethod
+    def restore(build: Release, backup: str, workers: int = None, stats: Stats = None):
+        """
+        Restores a backup into the save of the given build, replacing the existing save.
+
+        The backup is extracted into a staging folder next to the save, which then takes the place of the save
+        with two renames. The replaced save goes to a trash folder and is deleted in the background,
+        so the game can be played as soon as the backup is extracted.
+        A journal in the staging folder says whether the extraction finished, so recover() can finish
+        or undo a restore that was interrupted at any point. The restore lock of the build tells recover()
+        whether the restore is still running.
+
+        :param workers: how many processes to extract with. Default is one per cpu.
+        :param stats: where to record how long each phase took and what the worker processes did.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if stats is None:
+            stats = Stats('restore')
+        store = ObjectStore(env.object_folder)
+        chain = Backup.get_chain(backup)
+        with chdir(build.install_target), Backup._restore_lock() as locked:
+            if not locked:
+                print("ERROR: another restore into this build is running")
+                sys.exit(1)
+            Backup._recover()
             save_dir = Path('save')
             tmp_dir = Path('save.tmp')
-            with tarfile.open(f"{backup}.{env.backup_suffix}", mode='r|*') as tar:
-                with chdir(build.install_target):
-                    if tmp_dir.exists():
-                        print("ERROR: Refusing to touch the mess that the previous restore left. "
-                              "Maybe there was a power outage or you interrupted the process or something?")
-                        print("INFO: You can try to manually salvage the situation by "
-                              f"moving the 'save' folder out of the way and renaming the '{tmp_dir}' folder to 'save'.")
-                        print("`catactl explore` should open the location for you.")
-                        sys.exit(1)
-
-                    # stash existing save
-                    if save_dir.exists():
-                        save_dir.rename(tmp_dir)
-
-                    try:
-                        for part in tar:
-                            reader = tar.extractfile(part)
-                            with tarfile.open(fileobj=reader) as parttar:
-                                parttar.extractall('.')
-
-                        # restore seems ok. we can remove the stashed save
-                        if tmp_dir.exists():
-                            shutil.rmtree(tmp_dir)
-
-                    except Exception as e:
-                        print(f'ERROR: {e}')
-                        # try to restore the stashed save
-                        if tmp_dir.exists():
-                            if save_dir.exists():
-                                shutil.rmtree(save_dir)
-                            tmp_dir.rename(save_dir)
-                            print(f'INFO: the existing save should still exist')
-                        sys.exit(1)
+            if tmp_dir.exists():
+                print("ERROR: Refusing to touch the mess that the previous restore left. "
+                      "Maybe there was a power outage or you interrupted the process or something?")
+                print("INFO: You can try to manually salvage the situation by "
+                      f"moving the 'save' folder out of the way and renaming the '{tmp_dir}' folder to 'save'.")
+                print("`catactl explore` should open the location for you.")
+                sys.exit(1)
+            if save_dir.exists() and not save_dir.is_dir():
+                print(f"ERROR: {save_dir.absolute()} is not a folder. Move it out of the way to restore.")
+                sys.exit(1)
+
+            staging = Path(staging_folder)
+            staging.mkdir()
+            Backup._write_journal(backup, 'extracting')
+            try:
+                with chdir(staging):
+                    # backups made by older versions of catactl have no manifest: just extract everything.
+                    # otherwise extract each file in the manifest from the most recent backup in the chain that has it
+                    metadata = chain[0][1]
+                    wanted = set(metadata["files"]) if metadata else None
+
+                    # create the directories up front, so the worker processes don't race to create them
+                    with stats.phase('mkdir'):
+                        os.makedirs('save', exist_ok=True)
+                        if metadata:
+                            for folder in sorted({os.path.dirname(path) for path in metadata["files"]}):
+                                os.makedirs(folder, exist_ok=True)
+
+                    with stats.phase('extract'), multiprocessing.Pool(workers) as pool:
+                        for backup_id, _ in chain:
+                            Backup._extract(backup_id, wanted, store, pool, workers, stats)
+                    if wanted:
+                        raise RuntimeError(f'{len(wanted)} files are missing from {backup}, '
+                                           f'for example {min(wanted)}')
+
+                    # restore the exact modification times, so the next backup recognizes the files as unchanged
+                    with stats.phase('utime'):
+                        if metadata:
+                            for path, entry in metadata["files"].items():
+                                os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+                            stats.count(files=len(metadata["files"]))
+                Backup._write_journal(backup, 'ready')
+
+            except Exception as e:
+                print(f'ERROR: {e}')
+                # the existing save was not touched. Throw away what was extracted
+                Backup._discard(staging)
+                Backup.empty_trash()
+                print('INFO: the existing save is unchanged')
+                sys.exit(1)
+
+            with stats.phase('swap'):
+                Backup._swap()
+            with stats.phase('cleanup'):
+                Backup.empty_trash()
+
+    @staticmethod
+    def _write_journal(backup: str, state: str):
+        """Records how far the restore into the staging folder of the current directory got"""
+        journal = Path(staging_folder) / restore_journal
+        tmp = journal.with_name(f'{journal.name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({"backup": backup, "state": state}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, journal)
+
+    @staticmethod
+    def _swap():
+        """Replaces the save of the current directory with the one extracted into the staging folder"""
+        save_dir = Path('save')
+        if save_dir.exists():
+            Backup._discard(save_dir)
+        (Path(staging_folder) / 'save').rename(save_dir)
+        shutil.rmtree(staging_folder)
+
+    @staticmethod
+    def _discard(folder: Path):
+        """Moves a folder of the current directory to the trash, to be deleted later"""
+        trash = Path(trash_folder)
+        trash.mkdir(exist_ok=True)
+        folder.rename(trash / f'{folder.name}-{time.time_ns()}')
+
+    @staticmethod
+    def empty_trash(background: bool = True):
+        """
+        Deletes the saves that restores replaced, in the build folder of the current directory.
+
+        :param background: delete them in a separate process that carries on after catactl exits
+        """
+        trash = Path(trash_folder)
+        if not trash.is_dir():
+            return
+        folders = [str(path.absolute()) for path in trash.iterdir()]
+        if not folders:
+            return
+        if background:
+            remove_in_background(folders)
+        else:
+            for folder in folders:
+                shutil.rmtree(folder, ignore_errors=True)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _restore_lock():
+        """
+        Holds the restore lock of the build folder of the current directory.
+        Yields False without holding it if another process that is still running holds it.
+        """
+        lock = Path(restore_lock).absolute()
+        me = psutil.Process()
+        tmp = lock.with_name(f'{lock.name}-{me.pid}')
+        tmp.write_text(json.dumps(process_record(me)))
+        try:
+            while True:
+                try:
+                    # unlike creating the lock and then writing it, linking it is never seen half done
+                    os.link(tmp, lock)
+                    locked = True
+                    break
+                except FileExistsError:
+                    if Backup._restore_lock_owner(lock) is not None:
+                        locked = False
+                        break
+                    # the process that held it is gone
+                    lock.unlink(missing_ok=True)
+        finally:
+            tmp.unlink()
+        try:
+            yield locked
+        finally:
+            if locked:
+                lock.unlink(missing_ok=True)
+
+    @staticmethod
+    def _restore_lock_owner(lock: Path) -> Optional[psutil.Process]:
+        """The process holding a restore lock, if it is still running"""
+        try:
+            with open(lock) as f:
+                return running_process(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def recover() -> bool:
+        """
+        Finishes or undoes a restore that was interrupted, in the build folder of the current directory.
+
+        A restore that had extracted the whole backup is finished. Otherwise what it extracted is thrown away,
+        and the save is as it was before the restore started. A restore that is still running is left alone.
+        Also deletes the snapshots of the build and the spools of backups that crashed or were killed.
+
+        :return: False if a restore is still running
+        """
+        remove_abandoned(Path('.').glob(f'{snapshot_prefix}*'))
+        remove_abandoned(env.backup_folder.glob(f'{spool_prefix}*'))
+        if not Path(staging_folder).exists() and not Path('save.tmp').exists():
+            return True
+        with Backup._restore_lock() as locked:
+            if locked:
+                Backup._recover()
+            return locked
+
+    @staticmethod
+    def _recover():
+        """recover() for the process that holds the restore lock"""
+        staging = Path(staging_folder)
+        legacy_tmp = Path('save.tmp')
+        if legacy_tmp.is_dir() and not Path('save').exists():
+            # older versions of catactl stashed the save here before extracting into its place
+            legacy_tmp.rename('save')
+            print("INFO: put back the save that an interrupted restore had moved out of the way")
+        if not staging.is_dir():
+            return
+
+        try:
+            with open(staging / restore_journal) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            journal = {"backup": None, "state": None}
+        if journal["state"] == 'ready' and (staging / 'save').is_dir():
+            Backup._swap()
+            print(f"INFO: finished restoring {journal['backup']}, which was interrupted")
+        elif journal["state"] == 'ready':
+            # it was interrupted after the swap
+            shutil.rmtree(staging)
+        else:
+            Backup._discard(staging)
+            print("INFO: threw away an interrupted restore. The save is as it was before")
+
+    @staticmethod
+    def _extract(backup: str, wanted: Optional[set], store: ObjectStore, pool: multiprocessing.pool.Pool,
+                 workers: int, stats: Stats):
+        """
+        Extracts the files of a single backup into the current directory, one part per task in the pool.
+
+        :param wanted: extract only these files, and remove them from the set; None to extract everything.
+        """
+        archive = env.backup_folder / f"{backup}.{env.backup_suffix}"
+        only = frozenset(wanted) if wanted is not None else None
+        tasks = []
+        with tarfile.open(archive, mode='r') as tar:
+            for part in tar.getmembers():
+                if part.name == metadata_member:
+                    metadata = read_json_member(tar, part)
+                    if metadata["mode"] == 'dedup':
+                        entries = {path: entry for path, entry in metadata["files"].items()
+                                   if only is None or path in only}
+                        sizes = {path: entry["size"] for path, entry in entries.items()}
+                        for chunk in partition(sizes, workers):
+                            chunk_entries = {path: entries[path] for path in chunk}
+                            tasks.append(stats.submit(pool, restore_objects, (chunk_entries, store),
+                                                      sum(sizes[path] for path in chunk)))
+                    continue
+                if part.name == index_member:
+                    continue
+
+                codec = Codec.from_part_name(part.name)
+                tasks.append(stats.submit(pool, restore_part, (archive, part.offset_data, part.size, codec, only),
+                                          part.size))
+
+        for task in tasks:
+            extracted, _ = task.get()
+            if wanted is not None:
+                wanted.difference_update(extracted)
 
     @staticmethod
     def get_list():
         """
         Get list of backups, in chronologically ascending order
         """
-        with chdir(env.backup_folder):
-            return [backup.stem for backup in sorted(Path(".").glob(f'*.{env.backup_suffix}'))]
+        suffix = f'.{env.backup_suffix}'
+        with os.scandir(env.backup_folder) as entries:
+            return sorted(entry.name[:-len(suffix)] for entry in entries
+                          if entry.name.endswith(suffix) and not entry.name.startswith('.') and entry.is_file())
+
+    @staticmethod
+    def read_metadata(backup: str) -> Optional[dict]:
+        """
+        Reads the manifest of a backup.
+
+        :return: the manifest; None if the backup has no manifest (it was made by an older version of catactl).
+        """
+        try:
+            with tarfile.open(env.backup_folder / f"{backup}.{env.backup_suffix}", mode='r|*') as tar:
+                tarinfo = tar.next()
+                if tarinfo is not None and tarinfo.name == metadata_member:
+                    return read_json_member(tar, tarinfo)
+        except tarfile.TarError as e:
+            print(f"WARNING: cannot read backup {backup}: {e}")
+
+    @staticmethod
+    def latest_metadata(mode: str = None):
+        """
+        Finds the most recent backup that has a manifest.
+
+        :param mode: only consider backups made in this mode.
+        :return: the backup id and its manifest; (None, None) if there is no such backup
+        """
+        for backup in reversed(Backup.get_list()):
+            metadata = Backup.read_metadata(backup)
+            if metadata and (mode is None or metadata["mode"] == mode):
+                return backup, metadata
+        return None, None
+
+    @staticmethod
+    def get_chain(backup: str):
+        """
+        Finds the backups needed to restore a backup.
+
+        :return: list of (backup id, manifest) - the backup itself first, followed by its parent and so on.
+        """
+        chain = [(backup, Backup.read_metadata(backup))]
+        while chain[-1][1] and chain[-1][1].get("parent"):
+            parent = chain[-1][1]["parent"]
+            if not (env.backup_folder / f"{parent}.{env.backup_suffix}").exists():
+                print(f"ERROR: {chain[-1][0]} is an incremental backup of {parent}, which no longer exists")
+                sys.exit(1)
+            chain.append((parent, Backup.read_metadata(parent)))
+        return chain
+
+    @staticmethod
+    def get_chain_ids(backup: str, metadata: dict) -> List[str]:
+        """
+        Finds the backups needed to restore a backup like get_chain, without reading all of their manifests.
+
+        :return: the backup ids, starting from the backup that has no parent and ending with the backup itself
+        """
+        if "chain" in metadata:
+            return metadata["chain"] + [backup]
+        # made by an older version of catactl
+        return [backup_id for backup_id, _ in reversed(Backup.get_chain(backup))]
+
+    @staticmethod
+    def chain_is_long(chain: List[str]) -> bool:
+        """
+        Tells whether a chain of backups (see get_chain_ids) is too long to base another incremental backup on:
+        if it has env.backup_chain_length incremental backups already, or they together take more than
+        env.backup_chain_ratio of the size of the backup the chain starts with.
+        Every restore reads every backup in the chain, and prune can only remove a chain as a whole.
+        """
+        if len(chain) - 1 >= env.backup_chain_length:
+            return True
+        sizes = [(env.backup_folder / f"{backup}.{env.backup_suffix}").stat().st_size for backup in chain]
+        return sum(sizes[1:]) > env.backup_chain_ratio * sizes[0]
+
+    @staticmethod
+    def read_index(backup: str) -> Optional[dict]:
+        """
+        Reads the index of the parts of a backup.
+
+        :return: "files" has the part, offset in the uncompressed part, size and sha256 of each file, by path.
+            "parts" has the size and sha256 of each part, by name. None if the backup has no index.
+        """
+        with tarfile.open(env.backup_folder / f"{backup}.{env.backup_suffix}", mode='r') as tar:
+            try:
+                tarinfo = tar.getmember(index_member)
+            except KeyError:
+                return None
+            return read_json_member(tar, tarinfo)
+
+    @staticmethod
+    def _scan_parts(backup: str) -> dict:
+        """Builds the index of a backup that has none, by reading through all of its parts"""
+        index = {}
+        with tarfile.open(env.backup_folder / f"{backup}.{env.backup_suffix}", mode='r|*') as tar:
+            for part in tar:
+                if part.name in (metadata_member, index_member):
+                    continue
+                codec = Codec.from_part_name(part.name)
+                with codec.open_reader(tar.extractfile(part)) as reader:
+                    with tarfile.open(fileobj=reader, mode='r|') as parttar:
+                        for member in parttar:
+                            index[member.name] = {"part": part.name, "offset": member.offset, "size": member.size}
+        return index
+
+    @staticmethod
+    def get_contents(backup: str) -> dict:
+        """
+        Lists the files that restoring a backup would restore, and where to find each of them.
+
+        :return: the index entry of each file, by path. The entry also says which backup in the chain has the file.
+            Deduplicated files have no part, only a sha256.
+        """
+        chain = Backup.get_chain(backup)
+        head = chain[0][1]
+        contents = {}
+        for backup_id, metadata in chain:
+            if metadata and metadata["mode"] == 'dedup':
+                entries = metadata["files"]
+            else:
+                index = Backup.read_index(backup_id)
+                entries = index["files"] if index else Backup._scan_parts(backup_id)
+            for path, entry in entries.items():
+                if path not in contents and (head is None or path in head["files"]):
+                    contents[path] = {**entry, "backup": backup_id}
+        if head:
+            for path, entry in contents.items():
+                entry["mtime_ns"] = head["files"][path]["mtime_ns"]
+        return dict(sorted(contents.items()))
+
+    @staticmethod
+    def diff(old: str, new: str = None, build: Release = None) -> BackupDiff:
+        """
+        Finds the files that differ between two backups, or between a backup and the save of a build.
+
+        Only reads the indexes of the backups, never the compressed files:
+        files are compared by the sha256 the index has of them.
+        Files of the save are compared by size and modification time first,
+        and only read to compute their sha256 when their modification time differs.
+
+        :param old: the backup to compare with
+        :param new: the other backup; None to compare with the save of the build
+        """
+        before = Backup.get_contents(old)
+        if new is not None:
+            after = Backup.get_contents(new)
+        else:
+            with chdir(build.install_target):
+                after = Backup.scan()
+
+        result = BackupDiff()
+        for path, entry in after.items():
+            if path not in before:
+                result.added[path] = entry
+        with chdir(build.install_target if new is None else None):
+            for path, entry in before.items():
+                if path not in after:
+                    result.removed[path] = entry
+                elif not same_content(entry, after[path]):
+                    # a file of the save may have a new modification time but the same content
+                    if new is None and entry["size"] == after[path]["size"] and "sha256" in entry \
+                            and file_sha256(path) == entry["sha256"]:
+                        continue
+                    result.modified[path] = (entry, after[path])
+        return result
+
+    @staticmethod
+    def restore_paths(build: Release, backup: str, paths: List[str]) -> List[str]:
+        """
+        Restores some files from a backup into the save of the given build, leaving other files untouched.
+        Only the parts that contain the files are read, and only up to the files.
+
+        :param paths: files or folders to restore, relative to the build folder, like 'save/World/master.gsav'.
+        :return: the paths of the files restored
+        """
+        prefixes = [Path(path).as_posix().rstrip('/') for path in paths]
+        contents = Backup.get_contents(backup)
+        selected = {path: entry for path, entry in contents.items()
+                    if any(path == prefix or path.startswith(f'{prefix}/') for prefix in prefixes)}
+        if not selected:
+            print(f"ERROR: {backup} has no files in {', '.join(paths)}")
+            sys.exit(1)
+
+        # group the files by the part they are in
+        parts = {}
+        objects = {}
+        for path, entry in selected.items():
+            if "part" in entry:
+                parts.setdefault((entry["backup"], entry["part"]), {})[path] = entry
+            else:
+                objects[path] = entry
+
+        with chdir(build.install_target):
+            if not Backup.recover():
+                print("ERROR: a restore into this build is running. Try again when it is done")
+                sys.exit(1)
+            restore_objects(objects, ObjectStore(env.object_folder))
+            for (backup_id, part_name), entries in parts.items():
+                archive = env.backup_folder / f"{backup_id}.{env.backup_suffix}"
+                with tarfile.open(archive, mode='r') as tar:
+                    part = tar.getmember(part_name)
+                start = min(entry["offset"] for entry in entries.values())
+                restore_part(archive, part.offset_data, part.size, Codec.from_part_name(part_name),
+                             frozenset(entries), start=start)
+
+            for path, entry in selected.items():
+                if "mtime_ns" in entry:
+                    os.utime(path, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+
+        print(f"INFO: restored {len(selected)} files from {backup}")
+        return sorted(selected)
+
+    @staticmethod
+    def verify(backups: List[str], workers: int = None) -> dict:
+        """
+        Checks the integrity of backups, using a process pool to read all of the parts in parallel.
+
+        Checks the sha256 of each part and of each file in it against the index,
+        that incremental backups still have their parent,
+        and that the objects of deduplicating backups are intact (each object is only checked once).
+        Backups made by older versions of catactl can only be checked for being readable.
+
+        :return: descriptions of the problems found in each backup, by backup id
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        store = ObjectStore(env.object_folder)
+        problems = {backup: [] for backup in backups}
+        users = {}  # the backups using each object
+        tasks = []
+        with multiprocessing.Pool(workers) as pool:
+            for backup in backups:
+                archive = env.backup_folder / f"{backup}.{env.backup_suffix}"
+                try:
+                    with tarfile.open(archive, mode='r') as tar:
+                        members = {member.name: member for member in tar.getmembers()}
+                        metadata = read_json_member(tar, members[metadata_member]) \
+                            if metadata_member in members else None
+                        index = read_json_member(tar, members[index_member]) if index_member in members else None
+                except Exception as e:
+                    problems[backup].append(f'cannot read {archive.name}: {e}')
+                    continue
+
+                if metadata and metadata.get("parent"):
+                    if not (env.backup_folder / f'{metadata["parent"]}.{env.backup_suffix}').exists():
+                        problems[backup].append(f'its parent backup {metadata["parent"]} is missing')
+
+                if metadata and metadata["mode"] == 'dedup':
+                    for entry in metadata["files"].values():
+                        users.setdefault(entry["sha256"], set()).add(backup)
+
+                index_parts = index["parts"] if index else {}
+                index_files = index["files"] if index else {}
+                problems[backup] += [f'part {name} is missing' for name in sorted(set(index_parts) - set(members))]
+                for name, member in members.items():
+                    if name in (metadata_member, index_member):
+                        continue
+                    expected_files = {path: entry["sha256"] for path, entry in index_files.items()
+                                      if entry["part"] == name}
+                    task = pool.apply_async(verify_part, (archive, name, member.offset_data, member.size,
+                                                          index_parts.get(name), expected_files))
+                    tasks.append((backup, task))
+
+            digests = sorted(users)
+            for chunk in chunked(digests, 1 + len(digests) // (workers * 4)):
+                tasks.append((None, pool.apply_async(verify_objects, (chunk, store))))
+
+            for backup, task in tasks:
+                if backup is None:
+                    for digest, problem in task.get().items():
+                        for user in users[digest]:
+                            problems[user].append(problem)
+                else:
+                    problems[backup] += task.get()
+
+        return problems
+
+    @staticmethod
+    def prune(keep_last: int = 0, keep_hourly: int = 0, keep_daily: int = 0, keep_weekly: int = 0,
+              keep_monthly: int = 0, dry_run: bool = False) -> List[str]:
+        """
+        Deletes the backups that the retention policy does not keep, then garbage collects the object store.
+
+        The policy keeps the union of the most recent keep_last backups and the most recent backup of
+        each of the last keep_hourly hours, keep_daily days and so on (that have backups).
+        Backups that kept incremental backups are based on are kept too, and reported as such, and so are backups
+        whose id does not start with a timestamp. As incremental backups start a new chain every so often,
+        the older chains go as a whole once none of their backups is kept.
+
+        :param dry_run: only report what would be deleted.
+        :return: the ids of the deleted backups
+        """
+        backups = Backup.get_list()
+        keep = select_retained(backups, keep_last=keep_last, keep_hourly=keep_hourly, keep_daily=keep_daily,
+                               keep_weekly=keep_weekly, keep_monthly=keep_monthly)
+
+        # keep the parents of incremental backups that are kept
+        needed_by = {}
+        todo = list(keep)
+        while todo:
+            backup = todo.pop()
+            metadata = Backup.read_metadata(backup)
+            parent = metadata.get("parent") if metadata else None
+            if parent and parent not in keep and parent in backups:
+                keep.add(parent)
+                needed_by[parent] = backup
+                todo.append(parent)
+
+        removed = [backup for backup in backups if backup not in keep]
+        for backup in removed:
+            print(f"INFO: {'would remove' if dry_run else 'removing'} {backup}")
+            if not dry_run:
+                (env.backup_folder / f"{backup}.{env.backup_suffix}").unlink()
+        for parent, backup in sorted(needed_by.items()):
+            print(f"INFO: {'would keep' if dry_run else 'keeping'} {parent} only because {backup} is based on it")
+        print(f"INFO: {'would keep' if dry_run else 'kept'} {len(backups) - len(removed)} backups, "
+              f"{len(needed_by)} of them only because kept incremental backups are based on them")
+
+        # a dry run removes nothing, so tell gc which backups would be gone
+        Backup.gc(dry_run=dry_run, excluding=removed)
+        return removed
+
+    @staticmethod
+    def gc(grace_seconds: float = 3600, dry_run: bool = False, excluding: Collection[str] = ()):
+        """
+        Deletes the objects that no deduplicating backup uses anymore.
+
+        :param grace_seconds: keep objects younger than this, as a backup that is running right now
+            may have stored them without having written its manifest yet.
+        :param dry_run: only report what would be deleted.
+        :param excluding: backups whose objects count as unused, like the ones a dry run of prune would remove.
+        :return: the number of objects deleted and the bytes freed
+        """
+        store = ObjectStore(env.object_folder)
+        used = set()
+        for backup in Backup.get_list():
+            if backup in excluding:
+                continue
+            metadata = Backup.read_metadata(backup)
+            if metadata and metadata["mode"] == 'dedup':
+                used.update(entry["sha256"] for entry in metadata["files"].values())
+
+        deadline = time.time() - grace_seconds
+        count = 0
+        freed = 0
+        for digest in list(store):
+            if digest in used:
+                continue
+            path = store.path(digest)
+            if path.stat().st_mtime > deadline:
+                continue
+            count += 1
+            freed += path.stat().st_size if dry_run else store.delete(digest)
+
+        if count:
+            print(f"INFO: {'would free' if dry_run else 'freed'} {freed / (1024*1024) :.1f} MiB "
+                  f"in {count} unused objects")
+        return count, freed
 
 
 class DataclassEncoder(json.JSONEncoder):
@@ -341,42 +1896,177 @@ json_opts = {"indent": 4, "cls": DataclassEncoder}
 
 class ReleaseList:
     @staticmethod
-    def download(only_latest_stable: bool = True) -> List[Release]:
+    def download(only_latest_stable: bool = True, pages: int = None) -> List[Release]:
+        """
+        Gets the list of releases from GitHub, or from the cache of GitHub responses if it is recent.
+
+        :param pages: how many pages of 100 releases to get; env.release_pages by default
+        """
+        api = github.GitHub(env.api_cache_file, env.api_cache_ttl, env.download_connections)
         if only_latest_stable:
             print('downloading which release is the latest stable version')
-            url = f'{env.repo_url}/releases/latest'
-            latest = requests.get(url).json()
-            release = requests.get(latest['url']).json()
+            release, _ = api.get(f'{env.repo_url}/releases/latest')
             releases = [Release.parse(release, pattern='Windows_x64-Tiles')]
         else:
             print('downloading release list')
-            url = f'{env.repo_url}/releases'
-            releases = requests.get(url).json()
+            releases, _ = api.get_pages(f'{env.repo_url}/releases', pages or env.release_pages)
             releases = [Release.parse(r) for r in releases]
+        api.save()
 
         releases = [r for r in releases if r]
         return releases
 
     @staticmethod
-    def update(only_latest_stable: bool = True):
-        releases = ReleaseList.download(only_latest_stable)
-        ReleaseList.dump(releases)
+    def update(only_latest_stable: bool = True, pages: int = None):
+        releases = ReleaseList.download(only_latest_stable, pages)
+        ReleaseList.dump(releases, stable=only_latest_stable)
+
+    # Version of the layout of the builds database. Bump it when changing the layout: the database is only a cache
+    # of what GitHub knows, so a database with another version is simply dropped and downloaded again
+    schema_version = 1
+    columns = ('tag_name', 'file_name', 'download_url', 'timestamp', 'size', 'digest')
 
     @staticmethod
-    def dump(releases: List[Release]):
-        with open(env.builds_data_file, 'wb') as f:
-            pickle.dump(releases, f)
+    def connect() -> sqlite3.Connection:
+        """Opens the builds database, creating it if needed"""
+        db = sqlite3.connect(env.builds_data_file)
+        version, = db.execute('PRAGMA user_version').fetchone()
+        if version != ReleaseList.schema_version:
+            with db:
+                db.execute('DROP TABLE IF EXISTS releases')
+                db.execute('CREATE TABLE releases (tag_name TEXT PRIMARY KEY, file_name TEXT, download_url TEXT, '
+                           'timestamp TEXT, size INTEGER, digest TEXT, stable INTEGER)')
+                db.execute('CREATE INDEX releases_by_timestamp ON releases (stable, timestamp)')
+                db.execute(f'PRAGMA user_version = {ReleaseList.schema_version}')
+            ReleaseList._import_pickle(db)
+        return db
+
+    @staticmethod
+    def _import_pickle(db: sqlite3.Connection):
+        """Moves the releases from the list that older versions pickled into the database"""
+        legacy = env.builds_data_file.with_name('builds.pkl')
+        if not legacy.exists():
+            return
+        try:
+            with open(legacy, 'rb') as f:
+                releases = pickle.load(f)
+            ReleaseList._merge(db, releases, stable=False)
+        except Exception as e:
+            print(f"WARNING: cannot read the old list of builds: {e}")
+        legacy.unlink()
+
+    @staticmethod
+    def _merge(db: sqlite3.Connection, releases: List[Release], stable: bool):
+        with db:
+            db.executemany(f'INSERT OR REPLACE INTO releases VALUES ({", ".join("?" * (len(ReleaseList.columns) + 1))})',
+                           [(*(getattr(r, c) for c in ReleaseList.columns), stable) for r in releases])
+
+    @staticmethod
+    def dump(releases: List[Release], stable: bool = False):
+        """Adds releases to the database, replacing those with the same tag"""
+        with contextlib.closing(ReleaseList.connect()) as db:
+            ReleaseList._merge(db, releases, stable)
+
+    @staticmethod
+    def find(prefix: str = None, since: str = None, until: str = None, stable: bool = False) -> List[Release]:
+        """
+        Finds releases, most recent first.
+
+        :param prefix: only releases with a tag that starts with this
+        :param since: only releases published at or after this timestamp, like 2021-05-23 or 2021-05-23T07:32:00Z
+        :param until: only releases published before this timestamp
+        :param stable: stable releases rather than experimental builds
+        """
+        where = ['stable = ?']
+        params = [stable]
+        if prefix:
+            # a range rather than LIKE, which is case insensitive and cannot use the primary key
+            where.append('tag_name >= ? AND tag_name < ?')
+            params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        if since:
+            where.append('timestamp >= ?')
+            params.append(since)
+        if until:
+            where.append('timestamp < ?')
+            params.append(until)
+        with contextlib.closing(ReleaseList.connect()) as db:
+            rows = db.execute(f'SELECT {", ".join(ReleaseList.columns)} FROM releases '
+                              f'WHERE {" AND ".join(where)} ORDER BY timestamp DESC, tag_name DESC', params)
+            return [Release(*row) for row in rows]
+
+    @staticmethod
+    def get(tag: str) -> Optional[Release]:
+        """The release with the given tag; None if there is no such release"""
+        with contextlib.closing(ReleaseList.connect()) as db:
+            row = db.execute(f'SELECT {", ".join(ReleaseList.columns)} FROM releases WHERE tag_name = ?',
+                             [tag]).fetchone()
+            return Release(*row) if row else None
+
+    @staticmethod
+    def latest(stable: bool = False) -> Optional[Release]:
+        """The most recent release; None if there are none"""
+        with contextlib.closing(ReleaseList.connect()) as db:
+            row = db.execute(f'SELECT {", ".join(ReleaseList.columns)} FROM releases WHERE stable = ? '
+                             f'ORDER BY timestamp DESC, tag_name DESC LIMIT 1', [stable]).fetchone()
+            return Release(*row) if row else None
 
     @staticmethod
     def load() -> List[Release]:
-        with open(env.builds_data_file, 'rb') as f:
-            return pickle.load(f)
+        """All experimental builds, most recent first"""
+        return ReleaseList.find()
 
     @staticmethod
     def exists() -> bool:
         return env.builds_data_file.exists()
 
 
+@dataclass
+class DiskUsage:
+    name: str
+    files: int = 0
+    size: int = 0
+    shared: int = 0
+
+
+def get_disk_usage() -> Tuple[List[DiskUsage], int]:
+    """
+    Measures how much disk each install takes, and how much of that is files shared with other installs.
+
+    :return: the usage of each install, and the disk space that all of them actually take together
+    """
+    usages = []
+    inodes = {}
+    for install in sorted(os.scandir(env.install_folder), key=lambda entry: entry.name):
+        if install.name.startswith('.') or not install.is_dir():
+            continue
+        usage = DiskUsage(install.name)
+        stack = [install.path]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        # not entry.stat(), whose link count and inode are always 0 on windows
+                        st = os.lstat(entry.path)
+                        usage.files += 1
+                        usage.size += st.st_size
+                        # one link is the store's
+                        if st.st_nlink > 2:
+                            usage.shared += st.st_size
+                        inodes[st.st_dev, st.st_ino] = st.st_size
+        usages.append(usage)
+    return usages, sum(inodes.values())
+
+
+def get_current_install() -> Optional[Release]:
+    """The build that `catactl run` starts; None if there is none"""
+    if not env.current_install_data_file.exists():
+        return None
+    release = Release.load(env.current_install_data_file)
+    return release if release.install_target.exists() else None
+
+
 def switch_install(release: Release):
     print(f"switching to {release.tag_name}")
     release.dump(env.current_install_data_file)
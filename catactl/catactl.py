@@ -1,10 +1,40 @@
 import click
-import psutil
 import sys
-import subprocess
 from pathlib import Path
-from . import ReleaseList, Release, switch_install, Backup, get_running_process
+from . import ReleaseList, Release, switch_install, Backup, get_running_process, get_disk_usage, lower_priority, \
+    chdir
+from .codec import Codec, codec_names
 from .config import init_app, current_env as env
+from .stats import Stats
+from .watch import watch, game_exited
+from .lazy import lazy_import
+
+psutil = lazy_import('psutil')
+shutil = lazy_import('shutil')
+subprocess = lazy_import('subprocess')
+
+
+def validate_codec(ctx, param, value):
+    """Checks that a --codec option is usable"""
+    if value is not None:
+        try:
+            Codec.parse(value)
+        except ValueError as e:
+            raise click.BadParameter(str(e))
+    return value
+
+
+stats_help = 'Write how long each phase took, and what each worker process did, as json to this file (- for stdout)'
+profile_help = 'Profile each task of the worker processes with cProfile, writing the profiles to this folder'
+
+
+def write_stats(stats: Stats, stats_json):
+    """Writes the stats to the --stats-json file, if one was given"""
+    if stats_json is not None:
+        stats.dump(stats_json)
+
+
+codec_help = f"How to compress the backup, optionally with a level (like gz:6 or zstd:3). One of {', '.join(codec_names)}."
 
 
 @click.group()
@@ -58,14 +88,21 @@ def process(verbose):
 @show.command()
 @click.option('--cached', is_flag=True, help='Use the cached list. Do not download.')
 @click.option('--stable', is_flag=True, help='Show only the latest stable release')
-def builds(cached, stable):
+@click.option('--pages', type=int, help='How many pages of 100 builds to get. Default is 1.')
+@click.option('--since', help='Only show builds published on or after this date, like 2021-05-23')
+@click.option('--until', help='Only show builds published before this date')
+@click.argument('prefix', required=False)
+def builds(cached, stable, pages, since, until, prefix):
     """
     Downloads and shows most recent build tags (most recent last)
+
+    Builds that were downloaded before are remembered, so older builds are shown too.
+    Give a PREFIX like cdda-experimental-2021-05 to only show the builds with tags that start with it.
     """
     if not cached:
-        ReleaseList.update(only_latest_stable=stable)
+        ReleaseList.update(only_latest_stable=stable, pages=pages)
 
-    for build in reversed(ReleaseList.load()):
+    for build in reversed(ReleaseList.find(prefix, since, until, stable=stable)):
         print(f"{build.tag_name}")
 
 
@@ -73,7 +110,10 @@ def builds(cached, stable):
 @click.argument('tag')
 @click.option('--cached', is_flag=True, help='Use only cached data. Do not download.')
 @click.option('--force', is_flag=True, help='Reinstall if build is already installed (will keep the save).')
-def install(tag, cached, force):
+@click.option('--delta', is_flag=True,
+              help='Only download the files that changed since the current build. The archive is not kept.')
+@click.option('--stats-json', type=click.File('w'), help=stats_help)
+def install(tag, cached, force, delta, stats_json):
     """
     Downloads and installs the experimental build with the given TAG.
 
@@ -91,31 +131,39 @@ def install(tag, cached, force):
 
     if not cached:
         ReleaseList.update(only_latest_stable=(tag == 'stable'))
-    builds = ReleaseList.load()
 
-    if tag != 'latest':
-        builds = [b for b in builds if b.tag_name == tag]
+    if tag in ('latest', 'stable'):
+        build = ReleaseList.latest(stable=(tag == 'stable'))
+    else:
+        build = ReleaseList.get(tag)
 
-    if not builds:
+    if build is None:
         print(f"ERROR: No such build: {tag}")
         sys.exit(1)
 
-    build = builds[0]
-    if not build.download_target.exists():
-        if cached:
-            print(f"ERROR: Cannot install {tag} without downloading it first.")
-            sys.exit(1)
-        else:
-            build.download(force=force)
-
-    build.install(force=force)
+    stats = Stats('install')
+    if build.download_target.exists():
+        build.install(force=force, stats=stats)
+    elif cached:
+        print(f"ERROR: Cannot install {tag} without downloading it first.")
+        sys.exit(1)
+    else:
+        build.download_and_install(force=force, delta=delta, stats=stats)
     switch_install(build)
+    write_stats(stats, stats_json)
 
 
 @catactl.command()
 @click.option('--backup', is_flag=True, help='Backup the save before running')
 @click.option('--label', help='Label the backup to make it easier to identify')
-def run(backup, label):
+@click.option('--mode', type=click.Choice(Backup.modes), default='full', show_default=True,
+              help='Backup mode. incremental only compresses files that changed since the previous backup. '
+                   'dedup only stores files that changed since the previous dedup backup.')
+@click.option('--codec', callback=validate_codec, help=codec_help)
+@click.option('--watch', 'watch_save', is_flag=True,
+              help='Keep running, and back up the save whenever the game saves it until the game exits. '
+                   'These backups deduplicate, unless the mode is incremental')
+def run(backup, label, mode, codec, watch_save):
     """
     Runs the most recently installed build.
 
@@ -126,21 +174,100 @@ def run(backup, label):
         sys.exit(1)
 
     build = Release.load(env.current_install_data_file)
+    # don't start the game with half a save, or none, after a restore that was interrupted
+    if build.install_target.exists():
+        with chdir(build.install_target):
+            if not Backup.recover():
+                print("ERROR: a restore into the save is running. Try again when it is done")
+                sys.exit(1)
 
     if backup:
-        Backup.backup(build, label=label)
+        # capture the save now, and compress it while the game is running
+        snapshot = Backup.snapshot(build)
+        Backup.backup_in_background(snapshot, label=label, mode=mode, codec=codec)
+
+    if watch_save:
+        process = build.launch()
+        watch(build, mode=watch_mode(mode), codec=codec, until=game_exited(process))
+    else:
+        build.run()
+
 
-    build.run()
+def watch_mode(mode: str) -> str:
+    """Watching makes many backups, so it makes deduplicating backups unless told to make incremental ones"""
+    return 'incremental' if mode == 'incremental' else 'dedup'
+
+
+@catactl.command('watch')
+@click.option('--mode', type=click.Choice(['incremental', 'dedup']), default='dedup', show_default=True,
+              help='Backup mode. Both only store files that changed. '
+                   'Incremental backups start a new chain with the whole save every so often.')
+@click.option('--codec', callback=validate_codec, help=codec_help)
+@click.option('--settle', type=float, default=10.0, show_default=True,
+              help='Back up once nothing changed in the save for this many seconds')
+@click.option('--interval', type=float, default=1.0, show_default=True,
+              help='How often to look for changes, in seconds')
+def watch_command(mode, codec, settle, interval):
+    """
+    Backs up the save of the most recently installed build whenever it changes, until you press Ctrl+C.
+
+    Install watchdog (`pip install catalib[watch]`) to be told about changes by the operating system
+    rather than looking for them every INTERVAL seconds.
+    """
+    build = Release.load(env.current_install_data_file)
+    watch(build, settle=settle, interval=interval, mode=mode, codec=codec)
 
 
 @catactl.command()
 @click.option('--label', help='Label the backup to make it easier to identify')
-def backup(label):
+@click.option('--mode', type=click.Choice(Backup.modes), default='full', show_default=True,
+              help='Backup mode. incremental only compresses files that changed since the previous backup. '
+                   'dedup only stores files that changed since the previous dedup backup.')
+@click.option('--workers', type=int, help='Number of processes to compress with. Default is two per cpu.')
+@click.option('--schedule', type=click.Choice(Backup.schedules), default='balanced', show_default=True,
+              help='balanced gives each process the same amount of data. '
+                   'steal makes many small tasks that idle processes pick up.')
+@click.option('--verbose', '-v', is_flag=True, help='Report the work done by each process')
+@click.option('--codec', callback=validate_codec, help=codec_help)
+@click.option('--text-codec', callback=validate_codec,
+              help='How to compress text files, which most of the save is. Default is the same as --codec. '
+                   'bz2 makes smaller backups, but takes longer to restore.')
+@click.option('--stats-json', type=click.File('w'), help=stats_help)
+@click.option('--profile-workers', type=click.Path(file_okay=False, path_type=Path), help=profile_help)
+@click.option('--snapshot', type=click.Path(exists=True, file_okay=False, path_type=Path), hidden=True,
+              help='Back up this snapshot of the save with low priority, and remove it. Used by run --backup.')
+def backup(label, mode, workers, schedule, verbose, codec, text_codec, stats_json, profile_workers, snapshot):
     """
     Backs up the save of the most recently installed build.
     """
     build = Release.load(env.current_install_data_file)
-    Backup.backup(build, label=label)
+    stats = Stats('backup', profile_workers)
+    if snapshot is not None:
+        lower_priority()
+    try:
+        Backup.backup(build, label=label, mode=mode, workers=workers, schedule=schedule, verbose=verbose,
+                      codec=codec, text_codec=text_codec, stats=stats, source=snapshot)
+    finally:
+        if snapshot is not None:
+            shutil.rmtree(snapshot, ignore_errors=True)
+    write_stats(stats, stats_json)
+
+
+@show.command()
+def disk_usage():
+    """
+    Shows how much disk space each installed build takes.
+
+    Files that are identical between builds are only stored once, so together they take less than the sum.
+    """
+    usages, actual = get_disk_usage()
+    mib = 1024 * 1024
+    for usage in usages:
+        print(f"{usage.name}: {usage.files} files, {usage.size / mib :.1f} MiB, "
+              f"of which {usage.shared / mib :.1f} MiB shared with other builds")
+    total = sum(usage.size for usage in usages)
+    print(f"INFO: {len(usages)} builds take {actual / mib :.1f} MiB of disk, "
+          f"{total / mib :.1f} MiB without sharing")
 
 
 @show.command()
@@ -152,15 +279,37 @@ def backups():
         print(backup_id)
 
 
+@show.command()
+@click.argument('backup_id')
+def backup_contents(backup_id):
+    """
+    Shows the size and path of the files in a backup.
+
+    Use 'latest' as the BACKUP_ID to show the most recent backup.
+    """
+    if backup_id == 'latest':
+        backup_id = Backup.get_list()[-1]
+
+    for path, entry in Backup.get_contents(backup_id).items():
+        print(f"{entry['size']:>12} {path}")
+
+
 @catactl.command()
 @click.argument('backup_id')
-def restore(backup_id):
+@click.option('--workers', type=int, help='Number of processes to extract with. Default is one per cpu.')
+@click.option('--path', 'paths', multiple=True,
+              help='Only restore this file or folder (like save/World/maps/0.0.0), leaving the rest of the save as is. '
+                   'Can be repeated.')
+@click.option('--stats-json', type=click.File('w'), help=stats_help)
+@click.option('--profile-workers', type=click.Path(file_okay=False, path_type=Path), help=profile_help)
+def restore(backup_id, workers, paths, stats_json, profile_workers):
     """
     Restores a backup into the most recently installed build.
 
     Use 'latest' as the BACKUP_ID to restore the most recent backup.
 
-    Try `catactl show backups` to see the list of backups.
+    Try `catactl show backups` to see the list of backups,
+    and `catactl show backup-contents BACKUP_ID` to see the files in a backup.
     """
     if get_running_process():
         print("ERROR: Quit the game before restoring a backup. Maybe try `catactl kill` to force quit the game.")
@@ -175,7 +324,98 @@ def restore(backup_id):
         backup_id = Backup.get_list()[-1]
 
     build = Release.load(env.current_install_data_file)
-    Backup.restore(build, backup_id)
+    stats = Stats('restore', profile_workers)
+    if paths:
+        with stats.phase('extract'):
+            Backup.restore_paths(build, backup_id, list(paths))
+    else:
+        Backup.restore(build, backup_id, workers=workers, stats=stats)
+    write_stats(stats, stats_json)
+
+
+@catactl.command()
+@click.argument('old')
+@click.argument('new', required=False)
+def diff(old, new):
+    """
+    Shows the files that were added (A), removed (D) or modified (M) between two backups,
+    or between a backup and the save of the most recently installed build if NEW is not given.
+
+    Use 'latest' to compare with the most recent backup.
+    """
+    backups = Backup.get_list()
+    if not backups:
+        print("ERROR: No backups found")
+        sys.exit(1)
+    old, new = (backups[-1] if backup_id == 'latest' else backup_id for backup_id in (old, new))
+    for backup_id in (old, new):
+        if backup_id is not None and backup_id not in backups:
+            print(f"ERROR: No such backup: {backup_id}")
+            sys.exit(1)
+
+    build = Release.load(env.current_install_data_file) if new is None else None
+    result = Backup.diff(old, new, build)
+    for path, entry in result.added.items():
+        print(f"A {entry['size']:>12} {path}")
+    for path, entry in result.removed.items():
+        print(f"D {entry['size']:>12} {path}")
+    for path, (before, after) in result.modified.items():
+        print(f"M {after['size']:>12} {path} (was {before['size']})")
+    print(f"INFO: {len(result.added)} added, {len(result.removed)} removed, {len(result.modified)} modified "
+          f"since {old}")
+
+
+@catactl.command()
+@click.argument('backup_id', default='all')
+@click.option('--workers', type=int, help='Number of processes to verify with. Default is one per cpu.')
+def verify(backup_id, workers):
+    """
+    Checks that backups are intact.
+
+    Use 'all' as the BACKUP_ID (the default) to check every backup,
+    or 'latest' to check the most recent backup.
+    """
+    backups = Backup.get_list()
+    if backup_id == 'latest':
+        backups = backups[-1:]
+    elif backup_id != 'all':
+        backups = [backup_id]
+    if not backups:
+        print("ERROR: No backups found")
+        sys.exit(1)
+
+    problems = Backup.verify(backups, workers=workers)
+    for backup in backups:
+        if problems[backup]:
+            for problem in problems[backup]:
+                print(f"ERROR: {backup}: {problem}")
+        else:
+            print(f"INFO: {backup} is ok")
+    if any(problems.values()):
+        sys.exit(1)
+
+
+@catactl.command()
+@click.option('--keep-last', type=int, default=0, help='Keep this many of the most recent backups')
+@click.option('--keep-hourly', type=int, default=0, help='Keep the last backup of each of this many hours')
+@click.option('--keep-daily', type=int, default=0, help='Keep the last backup of each of this many days')
+@click.option('--keep-weekly', type=int, default=0, help='Keep the last backup of each of this many weeks')
+@click.option('--keep-monthly', type=int, default=0, help='Keep the last backup of each of this many months')
+@click.option('--dry-run', is_flag=True, help='Only show what would be removed')
+def prune(keep_last, keep_hourly, keep_daily, keep_weekly, keep_monthly, dry_run):
+    """
+    Removes old backups, and frees the space of files that no backup uses anymore.
+
+    For example, to keep the last 10 backups, hourly backups for a day and daily backups for a month:
+
+    catactl prune --keep-last 10 --keep-hourly 24 --keep-daily 30
+    """
+    if not any((keep_last, keep_hourly, keep_daily, keep_weekly, keep_monthly)):
+        print("ERROR: Say which backups to keep (see `catactl prune --help`), or all backups would be removed")
+        sys.exit(1)
+
+    Backup.prune(keep_last=keep_last, keep_hourly=keep_hourly, keep_daily=keep_daily,
+                 keep_weekly=keep_weekly, keep_monthly=keep_monthly, dry_run=dry_run)
 
 
 @catactl.command()
@@ -0,0 +1,204 @@
+import importlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import BinaryIO, Optional
+from .lazy import lazy_import
+__all__ = ['Codec', 'codec_names', 'classify', 'kinds']
+
+bz2 = lazy_import('bz2')
+gzip = lazy_import('gzip')
+lzma = lazy_import('lzma')
+zlib = lazy_import('zlib')
+
+# name: (part suffix, default level, python module needed)
+_codecs = {
+    'gz': ('.tgz', 9, None),
+    'bz2': ('.tbz2', 9, None),
+    'xz': ('.txz', 6, None),
+    'zstd': ('.tzst', 3, 'zstandard'),
+    'lz4': ('.tlz4', 0, 'lz4.frame'),
+    'none': ('.tar', None, None),
+}
+codec_names = tuple(_codecs)
+# the lowest and highest compression level of each codec that has levels
+_levels = {
+    'gz': (0, 9),
+    'bz2': (1, 9),
+    'xz': (0, 9),
+    'zstd': (-131072, 22),
+    'lz4': (0, 16),
+}
+
+# how files are compressed, by what they contain: 'raw' files are compressed already so they are stored as they are,
+# 'text' (the game saves json) compresses very well so it is worth a stronger codec, and 'other' is everything else
+kinds = ('raw', 'text', 'other')
+compressed_suffixes = frozenset({'.zzip', '.gz', '.tgz', '.zip', '.7z', '.bz2', '.xz', '.zst', '.lz4',
+                                 '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ogg', '.mp3', '.flac'})
+text_suffixes = frozenset({'.json', '.sav', '.gsav', '.map', '.txt', '.log'})
+# how many bytes of a file classify() looks at, from its start, middle and end
+probe_size = 4096
+
+
+def classify(path: str, fileobj: BinaryIO = None, size: int = None) -> str:
+    """
+    Tells what kind of content a file has, by its suffix, or else by looking at a few samples of it:
+    text if they are utf-8 without nul bytes, raw if they hardly compress, and other if they do.
+
+    :param fileobj: the file opened for reading, at its start, to take the samples from.
+        It is at its start again afterwards. Default is to open the file.
+    :param size: the size of the file, if it is known already. Otherwise the file is stat'ed.
+    :return: one of kinds
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix in compressed_suffixes:
+        return 'raw'
+    if suffix in text_suffixes:
+        return 'text'
+
+    if fileobj is None:
+        with open(path, 'rb') as f:
+            return classify(path, f, size)
+    if size is None:
+        size = os.fstat(fileobj.fileno()).st_size
+    if size <= 3 * probe_size:
+        sample = fileobj.read(3 * probe_size)
+    else:
+        sample = fileobj.read(probe_size)
+        for offset in (size // 2, size - probe_size):
+            fileobj.seek(offset)
+            sample += fileobj.read(probe_size)
+    fileobj.seek(0)
+    if _is_text(sample[:probe_size]):
+        return 'text'
+    if len(sample) >= 512 and len(zlib.compress(sample, 1)) > 0.9 * len(sample):
+        return 'raw'
+    return 'other'
+
+
+def _is_text(sample: bytes) -> bool:
+    if b'\0' in sample:
+        return False
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as e:
+        # the sample may end in the middle of a character
+        return e.start >= len(sample) - 3
+    return True
+
+
+@dataclass(frozen=True)
+class Codec:
+    """
+    Compression of the parts of a backup.
+
+    A codec is specified as its name, optionally followed by a compression level: 'gz', 'gz:6', 'zstd:3'.
+    zstd and lz4 need the zstandard and lz4 packages (`pip install catalib[zstd,lz4]`).
+    The codec of a part can be told from its suffix, so restores don't need to be told which codec was used.
+    """
+    name: str = 'gz'
+    level: Optional[int] = None
+
+    @staticmethod
+    def parse(spec: str) -> 'Codec':
+        """
+        Parses a codec specification.
+
+        :raises ValueError: if the codec is unknown, the level is out of its range
+            or the library it needs is not installed.
+        """
+        name, _, level = spec.partition(':')
+        if name not in _codecs:
+            raise ValueError(f"unknown codec {name}, try one of {', '.join(codec_names)}")
+        if level and name not in _levels:
+            raise ValueError(f"codec {name} has no compression level")
+        codec = Codec(name=name, level=Codec._parse_level(name, level) if level else None)
+        codec._module()
+        return codec
+
+    @staticmethod
+    def _parse_level(name: str, level: str) -> int:
+        lowest, highest = _levels[name]
+        try:
+            number = int(level)
+        except ValueError:
+            raise ValueError(f"the level of codec {name} must be a number from {lowest} to {highest}")
+        if not lowest <= number <= highest:
+            raise ValueError(f"the level of codec {name} must be from {lowest} to {highest}, not {number}")
+        return number
+
+    @staticmethod
+    def from_part_name(part_name: str) -> 'Codec':
+        """The codec of a part, by its suffix"""
+        suffix = Path(part_name).suffix
+        for name, (codec_suffix, _, _) in _codecs.items():
+            if suffix == codec_suffix:
+                return Codec(name=name)
+        raise ValueError(f"unknown codec for {part_name}")
+
+    def __str__(self):
+        return self.name if self.level is None else f'{self.name}:{self.level}'
+
+    @property
+    def suffix(self) -> str:
+        return _codecs[self.name][0]
+
+    @property
+    def compression_level(self) -> Optional[int]:
+        return self.level if self.level is not None else _codecs[self.name][1]
+
+    def _module(self):
+        module = _codecs[self.name][2]
+        if module is None:
+            return None
+        try:
+            return importlib.import_module(module)
+        except ImportError:
+            raise ValueError(f"codec {self.name} needs the {module.split('.')[0]} package")
+
+    def open_writer(self, fileobj: BinaryIO) -> BinaryIO:
+        """
+        Wraps a binary file object to write compressed data to it.
+        Closing the writer finishes the compressed stream, but does not close fileobj.
+        """
+        level = self.compression_level
+        if self.name == 'gz':
+            return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level, mtime=0)
+        if self.name == 'bz2':
+            return bz2.BZ2File(fileobj, mode='wb', compresslevel=level)
+        if self.name == 'xz':
+            return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+        if self.name == 'zstd':
+            return self._module().ZstdCompressor(level=level).stream_writer(fileobj, closefd=False)
+        if self.name == 'lz4':
+            return self._module().LZ4FrameFile(fileobj, mode='wb', compression_level=level)
+        return _Uncompressed(fileobj)
+
+    def open_reader(self, fileobj: BinaryIO) -> BinaryIO:
+        """Wraps a file object of compressed data to read the decompressed data"""
+        if self.name == 'gz':
+            return gzip.GzipFile(fileobj=fileobj, mode='rb')
+        if self.name == 'bz2':
+            return bz2.BZ2File(fileobj, mode='rb')
+        if self.name == 'xz':
+            return lzma.LZMAFile(fileobj, mode='rb')
+        if self.name == 'zstd':
+            return self._module().ZstdDecompressor().stream_reader(fileobj)
+        if self.name == 'lz4':
+            return self._module().LZ4FrameFile(fileobj, mode='rb')
+        return fileobj
+
+
+class _Uncompressed:
+    """Passes writes through to a file object, without closing it"""
+    def __init__(self, fileobj: BinaryIO):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.flush()
@@ -11,10 +11,27 @@ class Env:
         self.app_root = app_root
         self.download_folder = self.app_root / 'builds'
         self.install_folder = self.app_root / 'installs'
+        self.link_folder = self.install_folder / '.store'
         self.backup_folder = self.app_root / 'backups'
-        self.builds_data_file = self.download_folder / 'builds.pkl'
+        self.object_folder = self.backup_folder / 'objects'
+        self.builds_data_file = self.download_folder / 'builds.db'
+        self.api_cache_file = self.download_folder / 'api-cache.json'
+        self.api_cache_ttl = 10 * 60
+        self.release_pages = 1
         self.current_install_data_file = self.app_root / 'current.pkl'
+        self.game_process_file = self.app_root / 'game.json'
+        self.background_log = self.app_root / 'background.log'
+        self.download_connections = 4
         self.backup_suffix = 'zar'
+        self.backup_part_size = 32 * 1024 * 1024
+        self.backup_codec = 'gz'
+        self.backup_text_codec = None
+        # an incremental backup starts a new chain with what amounts to a full backup
+        # once its parent has this many incremental backups below it,
+        self.backup_chain_length = 10
+        # or once those together take more than this fraction of the size of the full backup they are based on
+        self.backup_chain_ratio = 0.5
+        self.scan_threads = 4
 
     def create_folders(self):
         """Ensures that the expected directory structure exists"""
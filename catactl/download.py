@@ -0,0 +1,466 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+import requests
+from .store import LinkStore
+__all__ = ['DownloadError', 'PartialDownload', 'fetch', 'extract', 'download_and_extract']
+
+chunk_size = 1024 * 1024
+tail_size = 64 * 1024
+segment_size = 4 * 1024 * 1024
+
+
+class DownloadError(RuntimeError):
+    pass
+
+
+class Progress:
+    """Reports the progress of a download every few percent. Safe to update from several threads"""
+    def __init__(self, name: str, total: int, done: int = 0):
+        self.name = name
+        self.total = total
+        self.done = done
+        self.reported = -1
+        self.t0 = time.monotonic()
+        self.lock = threading.Lock()
+
+    def update(self, n: int):
+        with self.lock:
+            self.done += n
+            if self.total:
+                percent = 100 * self.done // self.total
+                if percent // 5 > self.reported // 5:
+                    self.reported = percent
+                    print(f"\rdownloading {self.name}: {percent}% of {self.total / (1024*1024) :.1f} MiB",
+                          end='', flush=True)
+
+    def finish(self):
+        t = time.monotonic() - self.t0
+        print(f"\rdownloaded {self.name}: {self.done / (1024*1024) :.1f} MiB in {t:.1f} seconds")
+
+
+def check(path: Path, size: int = 0, digest: str = None, sha256: 'hashlib._Hash' = None):
+    """
+    Checks a downloaded file against the expected size and digest.
+
+    :param digest: the expected digest, as 'sha256:<hex>'. Other kinds of digest are not checked.
+    :param sha256: the sha256 of the content, if it was computed while downloading.
+        Otherwise the file is read to compute it.
+    :raises DownloadError: if the file is not as expected.
+    """
+    actual_size = path.stat().st_size
+    if size and actual_size != size:
+        raise DownloadError(f"{path.name} is {actual_size} bytes, expected {size}")
+    if digest and digest.startswith('sha256:'):
+        if sha256 is None:
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    sha256.update(chunk)
+        if sha256.hexdigest() != digest[len('sha256:'):]:
+            raise DownloadError(f"{path.name} is corrupt, its sha256 is {sha256.hexdigest()}, expected {digest}")
+
+
+def part_path(target: Path) -> Path:
+    """Where a download goes until it is complete"""
+    return target.with_name(f'{target.name}.part')
+
+
+def merge(ranges: List[List[int]]) -> List[List[int]]:
+    """Merges overlapping or adjacent [start, end) ranges"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class PartialDownload:
+    """
+    A download in progress into a .part file next to the target.
+
+    Which byte ranges of the .part file have been downloaded is recorded in a .part.json file,
+    together with the url, size and etag of the download, so that an interrupted download can be resumed
+    by downloading only the missing ranges, as long as the file on the server has not changed.
+
+    Ranges can also be skipped, to not download them at all. Those are not recorded.
+    """
+    def __init__(self, target: Path, url: str, size: int, etag: Optional[str]):
+        self.target = target
+        self.path = part_path(target)
+        self.state_path = target.with_name(f'{target.name}.part.json')
+        self.url = url
+        self.size = size
+        self.etag = etag
+        self.done: List[List[int]] = []
+        self.skipped: List[List[int]] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def open(target: Path, url: str, size: int, etag: Optional[str]) -> 'PartialDownload':
+        """
+        Resumes the download of url to target if there is a matching partial download, otherwise starts over.
+        Without an etag there is no telling whether the file changed on the server, so it always starts over.
+        """
+        download = PartialDownload(target, url, size, etag)
+        try:
+            with open(download.state_path) as f:
+                state = json.load(f)
+            if etag and (state['url'], state['size'], state['etag']) == (url, size, etag) \
+                    and download.path.stat().st_size == size:
+                download.done = state['done']
+                return download
+        except (OSError, ValueError, KeyError):
+            pass
+
+        with open(download.path, 'wb') as f:
+            f.truncate(size)
+        download.save()
+        return download
+
+    @property
+    def resumed(self) -> bool:
+        return bool(self.done)
+
+    @property
+    def downloaded(self) -> int:
+        return sum(end - start for start, end in self.done)
+
+    def save(self):
+        tmp = self.state_path.with_name(f'{self.state_path.name}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'url': self.url, 'size': self.size, 'etag': self.etag, 'done': self.done}, f)
+        os.replace(tmp, self.state_path)
+
+    def add(self, start: int, end: int):
+        """Records that the bytes from start up to end have been written to the .part file"""
+        with self.lock:
+            self.done = merge(self.done + [[start, end]])
+            self.save()
+
+    def skip(self, ranges: List[List[int]]):
+        """Leaves out the given ranges from the download"""
+        with self.lock:
+            self.skipped = merge(self.skipped + ranges)
+
+    def write(self, start: int, data: bytes):
+        with open(self.path, 'r+b') as f:
+            f.seek(start)
+            f.write(data)
+        self.add(start, start + len(data))
+
+    def covers(self, start: int, end: int) -> bool:
+        """Whether the bytes from start up to end have all been downloaded or skipped"""
+        with self.lock:
+            return any(s <= start and end <= e for s, e in merge(self.done + self.skipped))
+
+    def missing(self) -> List[List[int]]:
+        """The ranges still to download, at most segment_size long each"""
+        gaps = []
+        position = 0
+        for start, end in merge(self.done + self.skipped) + [[self.size, self.size]]:
+            gaps.extend([i, min(i + segment_size, start)] for i in range(position, start, segment_size))
+            position = end
+        return gaps
+
+    def finish(self):
+        os.replace(self.path, self.target)
+        self.state_path.unlink()
+
+    def discard(self):
+        for path in (self.path, self.state_path):
+            if path.exists():
+                path.unlink()
+
+
+_sessions = threading.local()
+
+
+def session() -> requests.Session:
+    """A session per thread, so that each thread keeps its connection open from one request to the next"""
+    if not hasattr(_sessions, 'session'):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def get_range(url: str, start: int, end: int = None) -> Optional[tuple]:
+    """
+    Downloads a range of bytes of url.
+
+    :param start: offset of the first byte. Negative to get the last -start bytes.
+    :param end: offset of the last byte (inclusive); None for the rest of the file.
+    :return: the bytes, the total size and the etag of the file; None if the server does not do ranges.
+    """
+    spec = f'{start}' if start < 0 else f'{start}-{"" if end is None else end}'
+    with session().get(url, headers={'Range': f'bytes={spec}'}, stream=True) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            return None
+        total = int(response.headers['Content-Range'].rpartition('/')[2])
+        return response.content, total, response.headers.get('ETag')
+
+
+def _fetch_segment(download: PartialDownload, start: int, end: int, progress: Progress):
+    """Downloads the bytes from start up to end into the .part file"""
+    headers = {'Range': f'bytes={start}-{end - 1}'}
+    if download.etag:
+        headers['If-Range'] = download.etag
+    with session().get(download.url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise DownloadError(f"{download.target.name} changed on the server while downloading")
+        written = 0
+        with open(download.path, 'r+b') as f:
+            f.seek(start)
+            for chunk in response.iter_content(chunk_size):
+                chunk = chunk[:end - start - written]
+                f.write(chunk)
+                written += len(chunk)
+                progress.update(len(chunk))
+    if written != end - start:
+        raise DownloadError(f"{download.target.name} was cut short at {start + written} of {end} bytes")
+    download.add(start, end)
+
+
+def download_segments(download: PartialDownload, progress: Progress, connections: int = 1,
+                      on_segment: Callable[[], None] = None):
+    """
+    Downloads the missing ranges of a partial download, over several connections at once.
+
+    :param on_segment: called after each segment is downloaded
+    :raises DownloadError: if a segment could not be downloaded. The segments that were downloaded are kept.
+    """
+    with concurrent.futures.ThreadPoolExecutor(connections) as pool:
+        futures = [pool.submit(_fetch_segment, download, start, end, progress) for start, end in download.missing()]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                if on_segment:
+                    on_segment()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def _fetch_whole(url: str, target: Path, size: int = 0, digest: str = None):
+    """Downloads url to target in one request"""
+    part = part_path(target)
+    sha256 = hashlib.sha256()
+    with session().get(url, stream=True) as response:
+        response.raise_for_status()
+        progress = Progress(target.name, int(response.headers.get('Content-Length', 0)) or size)
+        with open(part, 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+                sha256.update(chunk)
+                progress.update(len(chunk))
+        progress.finish()
+
+    check(part, size, digest, sha256)
+    os.replace(part, target)
+
+
+def fetch(url: str, target: Path, size: int = 0, digest: str = None, connections: int = 1):
+    """
+    Downloads url to target, reporting progress. The file only appears at target once it is complete and checked.
+
+    If the server does range requests, an interrupted download is resumed where it stopped,
+    and the file is downloaded in segments over several connections at once.
+
+    :param size: the expected size; 0 if unknown.
+    :param digest: the expected digest, as 'sha256:<hex>'; None if unknown.
+    :param connections: how many segments to download at once
+    :raises DownloadError: if the download is not as expected.
+    """
+    probe = get_range(url, 0, 0)
+    if probe is None:
+        _fetch_whole(url, target, size, digest)
+        return
+
+    _, total, etag = probe
+    if size and total != size:
+        raise DownloadError(f"{target.name} is {total} bytes, expected {size}")
+
+    download = PartialDownload.open(target, url, total, etag)
+    if download.resumed:
+        print(f"resuming download of {target.name}")
+    progress = Progress(target.name, total, done=download.downloaded)
+    download_segments(download, progress, connections)
+    progress.finish()
+
+    try:
+        check(download.path, size, digest)
+    except DownloadError:
+        download.discard()
+        raise
+    download.finish()
+
+
+def find_central_directory(tail: bytes) -> Optional[tuple]:
+    """
+    Finds the central directory of a zip file from the end of the file.
+
+    :return: the offset and size of the central directory; None if not found, or if it is a zip64 file.
+    """
+    i = tail.rfind(b'PK\x05\x06')
+    if i < 0 or len(tail) < i + 22:
+        return None
+    cd_size, cd_offset = struct.unpack('<LL', tail[i + 12:i + 20])
+    if cd_offset == 0xffffffff:
+        return None
+    return cd_offset, cd_size
+
+
+def make_dirs(infos: Iterable[zipfile.ZipInfo], destination: Path):
+    """Creates the directories of the members up front, so that extracting threads don't race to create them"""
+    folders = set()
+    for info in infos:
+        path = os.path.normpath(os.path.join(destination, info.filename))
+        folders.add(path if info.is_dir() else os.path.dirname(path))
+    for folder in sorted(folders):
+        os.makedirs(folder, exist_ok=True)
+
+
+def extract_member(zf: zipfile.ZipFile, info: zipfile.ZipInfo, destination: Path, store: LinkStore = None):
+    """
+    Extracts a member of a zip file, or links it to an identical file in the store.
+
+    An existing file is removed first rather than overwritten, since it may be linked to the store.
+    """
+    target = Path(os.path.normpath(os.path.join(destination, info.filename)))
+    if target.exists():
+        target.unlink()
+    if store is not None and store.link(info.CRC, info.file_size, target):
+        return
+    zf.extract(info, destination)
+    if store is not None:
+        store.add(target, info.CRC, info.file_size)
+
+
+def members(infos: Iterable[zipfile.ZipInfo]) -> dict:
+    """The size and CRC32 of each file in a zip file, by name"""
+    return {info.filename: [info.file_size, info.CRC] for info in infos if not info.is_dir()}
+
+
+def _extract_members(path: Path, names: List[str], destination: Path, store: LinkStore = None):
+    with zipfile.ZipFile(path) as zf:
+        for name in names:
+            extract_member(zf, zf.getinfo(name), destination, store)
+
+
+def extract(path: Path, destination: Path, workers: int = None, store: LinkStore = None):
+    """
+    Extracts a zip file, using a pool of threads that each extract about the same number of compressed bytes.
+
+    :param store: where to link members from if they are already stored, and to store them if not
+    :return: the size and CRC32 of each file, by name
+    """
+    from . import partition
+
+    with zipfile.ZipFile(path) as zf:
+        infos = zf.infolist()
+    make_dirs(infos, destination)
+
+    files = {info.filename: info.compress_size for info in infos if not info.is_dir()}
+    chunks = partition(files, workers or os.cpu_count())
+    with concurrent.futures.ThreadPoolExecutor(len(chunks) or 1) as pool:
+        for future in [pool.submit(_extract_members, path, chunk, destination, store) for chunk in chunks]:
+            future.result()
+    return members(infos)
+
+
+def download_and_extract(url: str, target: Path, destination: Path, size: int = 0, digest: str = None,
+                         workers: int = None, connections: int = 1, store: LinkStore = None,
+                         delta: bool = False) -> dict:
+    """
+    Downloads a zip file to target and extracts it to destination at the same time.
+
+    First gets the central directory from the end of the file with a range request,
+    then downloads the rest of the file in segments, handing each member to a pool of extracting threads
+    as soon as all of its bytes have arrived.
+    An interrupted download is resumed where it stopped.
+    Falls back to downloading first and extracting after if the server does not do range requests.
+
+    :param size: the expected size; 0 if unknown.
+    :param digest: the expected digest, as 'sha256:<hex>'; None if unknown.
+    :param connections: how many segments to download at once
+    :param store: where to link members from if they are already stored, and to store them if not
+    :param delta: only download the members that are not in the store already.
+        The zip file is then incomplete, so it is not kept, and not checked against the digest:
+        the downloaded members are still checked against their CRC32 as they are extracted.
+    :return: the size and CRC32 of each file, by name
+    :raises DownloadError: if the download is not as expected.
+    """
+    got = get_range(url, -tail_size)
+    directory = find_central_directory(got[0]) if got else None
+    if directory is None:
+        fetch(url, target, size, digest, connections)
+        return extract(target, destination, workers, store)
+
+    tail, total, etag = got
+    if size and total != size:
+        raise DownloadError(f"{target.name} is {total} bytes, expected {size}")
+    cd_offset, cd_size = directory
+    tail_start = total - len(tail)
+    if cd_offset < tail_start:
+        # the central directory is bigger than what we got
+        more, _, _ = get_range(url, cd_offset, tail_start - 1)
+        tail = more + tail
+        tail_start = cd_offset
+
+    # a file of the right size with the end of the zip file in place is enough for ZipFile to read the members
+    download = PartialDownload.open(target, url, total, etag)
+    if download.resumed:
+        print(f"resuming download of {target.name}")
+    download.write(tail_start, tail)
+
+    # an unbuffered file, so that no stale bytes of members that have not arrived yet are ever read from a buffer
+    with open(download.path, 'rb', buffering=0) as raw, zipfile.ZipFile(raw) as zf:
+        infos = sorted(zf.infolist(), key=lambda info: info.header_offset)
+        ends = [info.header_offset for info in infos[1:]] + [cd_offset]
+        make_dirs(infos, destination)
+        if delta and store is not None:
+            download.skip([[info.header_offset, end] for info, end in zip(infos, ends)
+                           if not info.is_dir() and store.has(info.CRC, info.file_size)])
+            skipped = sum(end - start for start, end in download.skipped)
+            print(f"INFO: {skipped / (1024*1024) :.1f} MiB of {target.name} is installed already")
+
+        progress = Progress(target.name, total - sum(end - start for start, end in download.skipped),
+                            done=download.downloaded)
+        futures = []
+        ready = 0
+        with concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+            def submit_ready():
+                nonlocal ready
+                while ready < len(infos) and download.covers(infos[ready].header_offset, ends[ready]):
+                    if not infos[ready].is_dir():
+                        futures.append(pool.submit(extract_member, zf, infos[ready], destination, store))
+                    ready += 1
+
+            submit_ready()
+            download_segments(download, progress, connections, on_segment=submit_ready)
+            progress.finish()
+            for future in futures:
+                future.result()
+
+    if download.skipped:
+        download.discard()
+        return members(infos)
+
+    try:
+        check(download.path, size, digest)
+    except DownloadError:
+        download.discard()
+        raise
+    download.finish()
+    return members(infos)
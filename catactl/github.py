@@ -0,0 +1,100 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, List, Tuple
+import requests
+import requests.adapters
+__all__ = ['GitHub']
+
+
+class GitHub:
+    """
+    Client for the GitHub REST api that caches responses on disk.
+
+    A cached response younger than ttl seconds is used without asking GitHub at all.
+    Older ones are revalidated with a conditional request (If-None-Match / If-Modified-Since),
+    which GitHub answers with 304 Not Modified without counting it against the rate limit.
+    If GitHub cannot be reached or refuses the request, a cached response is used however old it is.
+    """
+    def __init__(self, cache_file: Path, ttl: float = 600, connections: int = 4):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.session = requests.Session()
+        self.session.headers['Accept'] = 'application/vnd.github+json'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.connections = connections
+        self.lock = threading.Lock()
+        try:
+            with open(cache_file) as f:
+                self.cache = json.load(f)
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def save(self):
+        tmp = self.cache_file.with_name(f'{self.cache_file.name}.tmp')
+        with self.lock, open(tmp, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(tmp, self.cache_file)
+
+    def get(self, url: str) -> Tuple[Any, bool]:
+        """
+        Gets the json response for url, from the cache if it is fresh or GitHub says it has not changed.
+
+        :return: the response, and whether it changed since it was cached
+        """
+        with self.lock:
+            cached = self.cache.get(url)
+        if cached and time.time() - cached['fetched'] < self.ttl:
+            return cached['body'], False
+
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+        try:
+            response = self.session.get(url, headers=headers)
+            if response.status_code != 304:
+                response.raise_for_status()
+        except requests.RequestException as e:
+            if not cached:
+                raise
+            print(f"WARNING: using the cached response of {url}: {e}")
+            return cached['body'], False
+
+        if response.status_code == 304:
+            with self.lock:
+                cached['fetched'] = time.time()
+            return cached['body'], False
+
+        body = response.json()
+        with self.lock:
+            self.cache[url] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched': time.time(),
+                'body': body,
+            }
+        return body, not cached or cached['body'] != body
+
+    def get_pages(self, url: str, pages: int, per_page: int = 100) -> Tuple[List, bool]:
+        """
+        Gets the first pages of a paginated list, several pages at once.
+
+        :return: the items of all pages, and whether any page changed since it was cached
+        """
+        urls = [f'{url}?per_page={per_page}&page={page}' for page in range(1, pages + 1)]
+        with concurrent.futures.ThreadPoolExecutor(min(self.connections, pages)) as pool:
+            results = list(pool.map(self.get, urls))
+
+        items = []
+        for page, _ in results:
+            items.extend(page)
+            if len(page) < per_page:
+                break
+        return items, any(changed for _, changed in results)
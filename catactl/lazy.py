@@ -0,0 +1,28 @@
+import importlib.util
+import sys
+from types import ModuleType
+__all__ = ['lazy_import']
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Imports a module the first time one of its attributes is used, rather than now.
+
+    Keeps the startup of commands that never use a heavy module (like requests or multiprocessing) fast.
+    Modules using this need `from __future__ import annotations`, so that annotations don't count as a use.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    # like import does, make a submodule an attribute of its package
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    loader.exec_module(module)
+    return module
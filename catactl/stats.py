@@ -0,0 +1,153 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+from .lazy import lazy_import
+
+cProfile = lazy_import('cProfile')
+psutil = lazy_import('psutil')
+statistics = lazy_import('statistics')
+__all__ = ['Stats', 'TaskSample', 'run_task', 'peak_memory']
+
+
+def peak_memory() -> Optional[int]:
+    """The peak resident memory of the current process in bytes; None if it cannot be measured"""
+    try:
+        import resource
+    except ImportError:
+        # windows
+        try:
+            return psutil.Process().memory_info().peak_wset
+        except (AttributeError, psutil.Error):
+            return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kibibytes everywhere but on macos
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+@dataclass
+class TaskSample:
+    """What running one task took in a worker process"""
+    pid: int
+    started: float  # time.time(), which unlike the monotonic clocks can be compared between processes
+    seconds: float
+    peak_memory: Optional[int]
+
+
+def run_task(func: Callable, args: tuple, profile_dir: Optional[Path] = None):
+    """
+    Runs func(*args) in a worker process and measures it.
+
+    :param profile_dir: profile the task with cProfile and write the profile to this folder,
+        as func-pid-time.prof. Look at it with `python -m pstats` or snakeviz.
+    :return: the result of the task and a TaskSample
+    """
+    started = time.time()
+    t0 = time.perf_counter()
+    if profile_dir is None:
+        result = func(*args)
+    else:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(func, *args)
+        profiler.dump_stats(Path(profile_dir) / f'{func.__name__}-{os.getpid()}-{time.time_ns()}.prof')
+    return result, TaskSample(os.getpid(), started, time.perf_counter() - t0, peak_memory())
+
+
+class Stats:
+    """
+    Measurements of one backup, restore or install, to write out as json.
+
+    Phases are timed with the phase() context manager; a phase that is entered several times adds up.
+    Tasks submitted to a process pool with submit() are measured in the worker process,
+    including how long they waited in the queue before a worker picked them up.
+    """
+    def __init__(self, operation: str, profile_dir: Path = None):
+        self.operation = operation
+        self.profile_dir = profile_dir
+        self.phases = {}
+        self.counters = {}
+        self.workers = {}
+        self.queue_waits = []
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+        if profile_dir is not None:
+            Path(profile_dir).mkdir(parents=True, exist_ok=True)
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def add_time(self, name: str, seconds: float):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, **counters):
+        """Adds to counters like files=10, in_bytes=1024"""
+        with self.lock:
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_task(self, sample: TaskSample, submitted: float, in_bytes: int = 0):
+        """Records a task that a worker process ran, submitted at time.time() submitted"""
+        wait = max(0.0, sample.started - submitted)
+        with self.lock:
+            worker = self.workers.setdefault(sample.pid, {"tasks": 0, "bytes": 0, "seconds": 0.0,
+                                                          "queue_wait": 0.0, "peak_memory": None})
+            worker["tasks"] += 1
+            worker["bytes"] += in_bytes
+            worker["seconds"] += sample.seconds
+            worker["queue_wait"] += wait
+            if sample.peak_memory is not None:
+                worker["peak_memory"] = max(worker["peak_memory"] or 0, sample.peak_memory)
+            self.queue_waits.append(wait)
+
+    def submit(self, pool, func: Callable, args: tuple, in_bytes: int = 0, callback: Callable = None,
+               error_callback: Callable = None):
+        """
+        Like pool.apply_async(func, args), measuring the task.
+
+        :param in_bytes: how much data the task works on, for the throughput of the worker
+        :return: an AsyncResult, whose get() returns the result of func and the TaskSample
+        """
+        submitted = time.time()
+
+        def on_result(r):
+            result, sample = r
+            self.add_task(sample, submitted, in_bytes)
+            if callback is not None:
+                callback(result)
+
+        return pool.apply_async(run_task, (func, args, self.profile_dir),
+                                callback=on_result, error_callback=error_callback)
+
+    def to_dict(self) -> dict:
+        mib = 1024 * 1024
+        with self.lock:
+            workers = [{"pid": pid, **worker,
+                        "mib_per_s": worker["bytes"] / mib / worker["seconds"] if worker["seconds"] else None}
+                       for pid, worker in sorted(self.workers.items())]
+            waits = sorted(self.queue_waits)
+            worker_peaks = [worker["peak_memory"] for worker in workers if worker["peak_memory"] is not None]
+            return {
+                "operation": self.operation,
+                "seconds": time.perf_counter() - self.t0,
+                "phases": dict(self.phases),
+                **self.counters,
+                "workers": workers,
+                "queue_wait": {"tasks": len(waits), "total": sum(waits), "max": waits[-1],
+                               "median": statistics.median(waits)} if waits else {"tasks": 0},
+                "peak_memory": {"main": peak_memory(), "workers": max(worker_peaks) if worker_peaks else None},
+            }
+
+    def dump(self, fp):
+        json.dump(self.to_dict(), fp, indent=4)
+        fp.write('\n')
@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import zlib
+from pathlib import Path
+from typing import Iterator, Tuple
+from .lazy import lazy_import
+__all__ = ['ObjectStore', 'LinkStore']
+
+gzip = lazy_import('gzip')
+hashlib = lazy_import('hashlib')
+
+
+class ObjectStore:
+    """
+    Content-addressed store of compressed file contents.
+
+    Each object is named by the sha256 of its uncompressed content and stored gzip compressed
+    in a subfolder named by the first two hex digits of its name, so identical files are only stored once.
+
+    Objects are written to a temporary file and renamed into place,
+    so it is safe for several processes to store the same content at the same time.
+    """
+    def __init__(self, root: Path):
+        self.root = root
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        """The name of the object holding the given content"""
+        return hashlib.sha256(data).hexdigest()
+
+    def path(self, digest: str) -> Path:
+        """Path to the object with the given name"""
+        return self.root / digest[:2] / digest[2:]
+
+    def __contains__(self, digest: str) -> bool:
+        return self.path(digest).exists()
+
+    def put(self, data: bytes, digest: str = None) -> int:
+        """
+        Stores the content, unless an identical object is already stored.
+
+        :return: the number of compressed bytes written; 0 if the object already existed
+        """
+        if digest is None:
+            digest = self.digest(data)
+        target = self.path(digest)
+        if target.exists():
+            return 0
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f'{target.name}.{os.getpid()}.tmp')
+        compressed = gzip.compress(data, mtime=0)
+        with open(tmp, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp, target)
+        return len(compressed)
+
+    def get(self, digest: str) -> bytes:
+        """The uncompressed content of the object with the given name"""
+        with open(self.path(digest), 'rb') as f:
+            return gzip.decompress(f.read())
+
+    def __iter__(self) -> Iterator[str]:
+        """Yields the names of all stored objects"""
+        if not self.root.exists():
+            return
+        with os.scandir(self.root) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir():
+                    continue
+                with os.scandir(subdir.path) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith('.tmp'):
+                            yield subdir.name + entry.name
+
+    def delete(self, digest: str) -> int:
+        """
+        Deletes an object.
+
+        :return: the number of bytes freed
+        """
+        target = self.path(digest)
+        size = target.stat().st_size
+        target.unlink()
+        return size
+
+
+class LinkStore:
+    """
+    Content-addressed store of uncompressed files that installed builds hardlink to.
+
+    Each file is named by the sha256 of its content. An index maps the CRC32 and size
+    that a zip file records for a member to the name of the stored file with that content,
+    so a member that is already stored can be linked into place without extracting it.
+
+    The store must be on the same file system as the installs, or files are simply not linked.
+    """
+    def __init__(self, root: Path):
+        self.root = root
+        self.index_path = root / 'index.json'
+        self.lock = threading.Lock()
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def key(crc: int, size: int) -> str:
+        return f'{crc:08x}-{size}'
+
+    def path(self, digest: str) -> Path:
+        """Path to the stored file with the given name"""
+        return self.root / digest[:2] / digest[2:]
+
+    def save(self):
+        """Writes the index"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_name(f'{self.index_path.name}.{os.getpid()}.tmp')
+        with self.lock, open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+    @staticmethod
+    def _replace_with_link(source: Path, target: Path):
+        tmp = target.with_name(f'{target.name}.{threading.get_ident()}.tmp')
+        os.link(source, tmp)
+        os.replace(tmp, target)
+
+    def has(self, crc: int, size: int) -> bool:
+        """Whether a file with the given CRC32 and size is stored"""
+        digest = self.index.get(self.key(crc, size))
+        return digest is not None and self.path(digest).exists()
+
+    def add_install(self, folder: Path, members: dict) -> int:
+        """
+        Stores the files of an install that are not stored yet.
+
+        :param members: the size and CRC32 of each file of the install, by path relative to folder
+        :return: the number of files added
+        """
+        count = 0
+        for name, (size, crc) in members.items():
+            path = folder / name
+            if not self.has(crc, size) and path.is_file() and path.stat().st_size == size:
+                self.add(path, crc, size)
+                count += 1
+        return count
+
+    def link(self, crc: int, size: int, target: Path) -> bool:
+        """
+        Links target to the stored file with the given CRC32 and size, if there is one.
+
+        :return: whether target was linked
+        """
+        digest = self.index.get(self.key(crc, size))
+        if digest is None:
+            return False
+        try:
+            self._replace_with_link(self.path(digest), target)
+            return True
+        except OSError:
+            return False
+
+    def add(self, path: Path, crc: int, size: int) -> bool:
+        """
+        Stores the file at path, or replaces it with a link to the stored file if its content is already stored.
+        A file that does not have the given CRC32 is not stored.
+
+        :return: whether path was linked to an already stored file
+        """
+        sha256 = hashlib.sha256()
+        actual_crc = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+                actual_crc = zlib.crc32(chunk, actual_crc)
+        if actual_crc != crc:
+            return False
+        digest = sha256.hexdigest()
+        stored = self.path(digest)
+        linked = False
+        try:
+            stored.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                os.link(path, stored)
+            except FileExistsError:
+                if not os.path.samefile(path, stored):
+                    self._replace_with_link(stored, path)
+                    linked = True
+        except OSError:
+            # no hard links on this file system
+            return False
+        with self.lock:
+            self.index[self.key(crc, size)] = digest
+        return linked
+
+    def __iter__(self) -> Iterator[os.DirEntry]:
+        """Yields the stored files"""
+        if not self.root.exists():
+            return
+        with os.scandir(self.root) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir():
+                    continue
+                with os.scandir(subdir.path) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith('.tmp'):
+                            yield entry
+
+    def gc(self) -> Tuple[int, int]:
+        """
+        Deletes stored files that no install links to anymore.
+
+        :return: the number of files deleted and the number of bytes freed
+        """
+        count, freed = 0, 0
+        for entry in self:
+            # the link count of a DirEntry is always 0 on windows
+            st = os.stat(entry.path)
+            if st.st_nlink == 1:
+                os.unlink(entry.path)
+                count += 1
+                freed += st.st_size
+        if count:
+            existing = {Path(entry.path).parent.name + entry.name for entry in self}
+            with self.lock:
+                self.index = {key: digest for key, digest in self.index.items() if digest in existing}
+            self.save()
+        return count, freed
@@ -0,0 +1,194 @@
+from __future__ import annotations
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional, Set
+from . import Backup, Release, chdir, scan_folder
+from .lazy import lazy_import
+
+psutil = lazy_import('psutil')
+__all__ = ['SaveWatcher', 'watch', 'game_exited']
+
+
+class SaveWatcher:
+    """
+    Keeps a snapshot of the save of a build up to date, without scanning all of it again when something changes.
+
+    With the watchdog package (`pip install catalib[watch]`) the operating system tells which folders changed.
+    Without it, the folders are polled: the modification time of a folder changes when a file in it is
+    created, deleted or renamed, which is how the game saves (it writes a temporary file and renames it).
+    Either way only the folders that changed are scanned again.
+    """
+    def __init__(self, build: Release, use_notifications: bool = True):
+        self.base = build.install_target
+        self.dirty: Set[str] = set()
+        self.lock = threading.Lock()
+        self.observer = None
+        self.snapshot = {}
+        self.folders = {}  # the modification time of every folder in the save
+        with chdir(self.base):
+            self._rescan({'save'})
+        if use_notifications:
+            self.observer = self._start_observer()
+
+    def _start_observer(self):
+        """Starts watching the save with watchdog; None if it is not installed"""
+        try:
+            from watchdog.events import FileSystemEventHandler
+            from watchdog.observers import Observer
+        except ImportError:
+            return None
+
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                for path in (event.src_path, getattr(event, 'dest_path', '')):
+                    if path:
+                        watcher.mark(path if event.is_directory else os.path.dirname(path))
+
+        observer = Observer()
+        observer.schedule(Handler(), str(self.base / 'save'), recursive=True)
+        observer.start()
+        return observer
+
+    def mark(self, folder: str):
+        """Notes that something in a folder (an absolute path) changed"""
+        relative = Path(os.path.relpath(folder, self.base)).as_posix()
+        with self.lock:
+            self.dirty.add(relative)
+
+    @staticmethod
+    def _stat_folders(folders: dict) -> dict:
+        """The modification times of the folders that still exist"""
+        mtimes = {}
+        for folder in folders:
+            try:
+                mtimes[folder] = os.stat(folder).st_mtime_ns
+            except FileNotFoundError:
+                pass
+        return mtimes
+
+    def poll(self) -> Set[str]:
+        """
+        Updates the snapshot with what changed since the last poll.
+
+        :return: the paths of the files that were created, changed or deleted
+        """
+        with chdir(self.base):
+            if self.observer is not None:
+                with self.lock:
+                    dirty, self.dirty = self.dirty, set()
+            else:
+                current = self._stat_folders(self.folders)
+                dirty = {folder for folder in self.folders if current.get(folder) != self.folders[folder]}
+            return self._rescan(dirty)
+
+    def _rescan(self, folders: Set[str]) -> Set[str]:
+        """Scans the folders again, and any new folders in them, and updates the snapshot"""
+        changed = set()
+        if not folders:
+            return changed
+        by_folder = {}
+        for path, entry in self.snapshot.items():
+            by_folder.setdefault(os.path.dirname(path), {})[path] = entry
+
+        pending = sorted(folders)
+        while pending:
+            folder = pending.pop()
+            before = by_folder.get(folder, {})
+            try:
+                found, subfolders = scan_folder(folder)
+                mtime = os.stat(folder).st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                found, subfolders, mtime = {}, [], None
+                # everything below a removed folder is gone too
+                pending += [known for known in self.folders if known.startswith(f'{folder}/')]
+            for path in before.keys() - found.keys():
+                del self.snapshot[path]
+                changed.add(path)
+            for path, entry in found.items():
+                if before.get(path) != entry:
+                    self.snapshot[path] = entry
+                    changed.add(path)
+            if mtime is None:
+                self.folders.pop(folder, None)
+            else:
+                self.folders[folder] = mtime
+            pending += [subfolder for subfolder in subfolders if subfolder not in self.folders]
+        if changed:
+            self.snapshot = dict(sorted(self.snapshot.items()))
+        return changed
+
+    def close(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+
+def watch(build: Release, settle: float = 10.0, interval: float = 1.0, mode: str = 'dedup',
+          codec: str = None, until: Optional[Callable[[], bool]] = None, use_notifications: bool = True):
+    """
+    Backs up the save of a build whenever it changes, until interrupted.
+    A backup that fails is tried again once the save settles again.
+
+    :param settle: wait until nothing changed for this many seconds, so a save the game is still writing
+        is not backed up halfway.
+    :param interval: how often to look for changes, in seconds.
+    :param mode: the backup mode. 'dedup' (the default) and 'incremental' only store what changed.
+        Deduplicating backups suit making many backups best: they don't build up a chain of backups to restore.
+    :param codec: how to compress the backups.
+    :param until: stop watching when this returns True, like when the game exits. Changes that were not
+        backed up yet are backed up before stopping.
+    :param use_notifications: use the notifications of the operating system if watchdog is installed.
+    """
+    watcher = SaveWatcher(build, use_notifications)
+    how = 'notifications' if watcher.observer is not None else f'polling every {interval:g} seconds'
+    print(f"INFO: watching {watcher.base / 'save'} for changes ({how}). Press Ctrl+C to stop")
+    pending = set()
+    last_change = 0.0
+
+    def back_up():
+        nonlocal last_change
+        print(f"INFO: {len(pending)} files changed")
+        try:
+            Backup.backup(build, label='watch', mode=mode, codec=codec, snapshot=watcher.snapshot)
+            pending.clear()
+            return
+        except SystemExit:
+            # backup() reported the errors. They may be passing, like a file the game replaced meanwhile
+            pass
+        except Exception as e:
+            print(f"ERROR: backup failed: {e}")
+        # keep watching, and try again once the save settles again
+        print(f"INFO: will try again in {settle:g} seconds")
+        last_change = time.monotonic()
+
+    try:
+        while until is None or not until():
+            time.sleep(interval)
+            changed = watcher.poll()
+            if changed:
+                pending.update(changed)
+                last_change = time.monotonic()
+            elif pending and time.monotonic() - last_change >= settle:
+                back_up()
+        pending.update(watcher.poll())
+        if pending:
+            back_up()
+    except KeyboardInterrupt:
+        if pending:
+            back_up()
+    finally:
+        watcher.close()
+
+
+def game_exited(process: Optional[psutil.Process]) -> Callable[[], bool]:
+    """A function that says whether the game process has exited, for watch(until=...)"""
+    def exited() -> bool:
+        try:
+            return process is None or not process.is_running() or process.status() == psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return True
+    return exited
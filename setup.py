@@ -12,6 +12,11 @@ setup(
         'click>=8.0.0,<8.1',
         'psutil>=5.8.0,<5.9',
     ],
+    extras_require={
+        'zstd': ['zstandard>=0.15'],
+        'lz4': ['lz4>=3.1'],
+        'watch': ['watchdog>=2.1'],
+    },
     entry_points={
         'console_scripts': [
             "catactl=catactl.catactl:catactl",
@@ -1,3 +1,8 @@
+import functools
+import http.server
+import io
+import os
+import threading
 import pytest
 from pathlib import Path
 from catactl.config import Env, init_app, current_env
@@ -8,3 +13,114 @@ def env(tmpdir) -> Env:
     """the 'env' fixture provides an environment rooted in a temporary folder"""
     init_app(app_root=Path(tmpdir))
     return current_env
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves files from a folder with an etag, including single byte ranges unless the server's `ranges` is False.
+    Cuts the next server.drops responses to requests for a range from server.drop_from or later short,
+    after server.drop_after bytes.
+    Records the Range header of each request in server.ranges_requested.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = Path(self.translate_path(self.path))
+        if not path.is_file():
+            self.send_error(404)
+            return None
+        data = path.read_bytes()
+        etag = f'"{path.stat().st_mtime_ns:x}-{len(data):x}"'
+
+        spec = self.headers.get('Range')
+        self.server.ranges_requested.append(spec)
+        start, end = 0, len(data) - 1
+        first = None
+        ranged = spec and self.server.ranges and self.headers.get('If-Range', etag) == etag
+        if ranged:
+            first, _, last = spec[len('bytes='):].partition('-')
+            if not first:
+                start = max(0, len(data) - int(last))
+            else:
+                start, end = int(first), min(int(last), end) if last else end
+
+        body = data[start:end + 1]
+        self.send_response(206 if ranged else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if ranged:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.end_headers()
+        with self.server.lock:
+            if self.server.drops and ranged and first and start >= self.server.drop_from \
+                    and len(body) > self.server.drop_after:
+                self.server.drops -= 1
+                body = body[:self.server.drop_after]
+                self.close_connection = True
+        return io.BytesIO(body)
+
+
+@pytest.fixture
+def http_server(tmpdir):
+    """
+    the 'http_server' fixture serves the files in a temporary folder over http.
+    Put files in server.root and get their url with server.url(name).
+    Set server.ranges to False to ignore range requests.
+    Set server.drops to cut that many responses short, and server.drop_from to only cut those from that offset.
+    """
+    root = Path(tmpdir) / 'www'
+    root.mkdir()
+    handler = functools.partial(RangeRequestHandler, directory=str(root))
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.root = root
+    server.ranges = True
+    server.ranges_requested = []
+    server.drops = 0
+    server.drop_after = 1000
+    server.drop_from = 0
+    server.lock = threading.Lock()
+    server.url = lambda name: f'http://127.0.0.1:{server.server_port}/{name}'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class WindowsDirEntry:
+    """A DirEntry whose stat() has no link count, inode or device, like on windows"""
+    def __init__(self, entry: os.DirEntry):
+        self.entry = entry
+
+    def __getattr__(self, name):
+        return getattr(self.entry, name)
+
+    def __fspath__(self):
+        return self.entry.path
+
+    def stat(self, *, follow_symlinks=True):
+        st = self.entry.stat(follow_symlinks=follow_symlinks)
+        return os.stat_result((st.st_mode, 0, 0, 0, st.st_uid, st.st_gid, st.st_size,
+                               st.st_atime, st.st_mtime, st.st_ctime))
+
+
+class WindowsScandir:
+    def __init__(self, entries):
+        self.entries = entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.entries.close()
+
+    def __iter__(self):
+        return (WindowsDirEntry(entry) for entry in self.entries)
+
+
+@pytest.fixture
+def windows_scandir(monkeypatch):
+    """the 'windows_scandir' fixture makes os.scandir() report the file stats that it reports on windows"""
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path='.': WindowsScandir(scandir(path)))
@@ -1,8 +1,19 @@
+import json
+import os
 import pytest
+import time
 import tarfile
 import shutil
-from catactl import Backup, process_chunk, Release, switch_install
-from catactl.config import Env
+import subprocess
+import sys
+import psutil
+import catactl
+from catactl import Backup, BackupDiff, process_chunk, Release, switch_install, chdir, select_retained, scan_tree, \
+    staging_folder, restore_journal, trash_folder, restore_lock, snapshot_prefix, spool_prefix, claim_folder
+from catactl.config import Env, current_env, init_app
+from catactl.codec import Codec
+from catactl.store import ObjectStore
+from catactl.stats import Stats
 from pathlib import Path
 
 num_subdirs_in_save = 7
@@ -64,27 +75,145 @@ def build_folder(env: Env):
     return build_folder, files, byte_count
 
 
-def test_processes_files_and_returns_buffer(build_folder):
+def test_processes_files_into_part_files(build_folder, tmpdir):
     build_folder, files_in_save, expect_in_bytes = build_folder
-    buffer, in_bytes_count, out_bytes_count = process_chunk(files_in_save)
+    result = process_chunk(files_in_save, Path(tmpdir), name='part-7')
 
-    assert buffer.tell() == 0  # buffer must be ready for reading from start
-    assert len(buffer.getbuffer()) == out_bytes_count  # must count output bytes
-    assert in_bytes_count == expect_in_bytes  # must count input bytes
+    assert [part.name for part in result.parts] == ['part-7.tgz']
+    assert result.parts[0].stat().st_size == result.out_bytes  # must count output bytes
+    assert result.in_bytes == expect_in_bytes  # must count input bytes
 
 
-def test_targzs_the_input_files(build_folder):
+def test_targzs_the_input_files(build_folder, tmpdir):
     build_folder, files_in_save, expect_in_bytes = build_folder
-    buffer, in_bytes_count, out_bytes_count = process_chunk(files_in_save)
+    result = process_chunk(files_in_save, Path(tmpdir))
 
     # verify content
     fs_root = build_folder.parts[0]
-    with tarfile.open(fileobj=buffer, mode='r:gz') as tar:
+    with tarfile.open(result.parts[0], mode='r:gz') as tar:
         for file, tarinfo, i in zip(files_in_save, tar.getmembers(), range(len(files_in_save))):
             assert Path(tarinfo.name) == file.relative_to(fs_root)
             assert tar.extractfile(tarinfo).read() == generate_content(i)
 
 
+def test_splits_chunk_into_bounded_parts(build_folder, tmpdir):
+    build_folder, files_in_save, expect_in_bytes = build_folder
+    max_part_bytes = expect_in_bytes // 3
+    result = process_chunk(files_in_save, Path(tmpdir), max_part_bytes=max_part_bytes)
+
+    assert [part.name for part in result.parts] == ['part-1.tgz', 'part-1-2.tgz', 'part-1-3.tgz']
+    assert result.out_bytes == sum(part.stat().st_size for part in result.parts)
+
+    names = []
+    for part in result.parts:
+        with tarfile.open(part) as tar:
+            assert sum(tarinfo.size for tarinfo in tar.getmembers()[:-1]) < max_part_bytes
+            names += tar.getnames()
+    assert len(names) == len(files_in_save)
+
+
+@pytest.mark.parametrize('threads', [1, 4])
+def test_scans_every_file_once(build_folder, threads):
+    build_folder, files_in_save, expect_in_bytes = build_folder
+    (build_folder / 'save' / 'empty').mkdir()
+    with chdir(build_folder):
+        snapshot = scan_tree('save', threads)
+    expected = sorted(file.relative_to(build_folder).as_posix() for file in files_in_save)
+    assert list(snapshot) == expected
+    assert sum(entry["size"] for entry in snapshot.values()) == expect_in_bytes
+    first = snapshot[expected[0]]
+    assert first["mtime_ns"] == (build_folder / expected[0]).stat().st_mtime_ns
+
+
+def test_processes_files_with_scanned_metadata(build_folder, tmpdir):
+    build_folder, files_in_save, expect_in_bytes = build_folder
+    with chdir(build_folder):
+        snapshot = scan_tree('save')
+        files = list(snapshot)
+        snapshot[files[0]]["mtime_ns"] = 1_000_000_000_000
+        snapshot[files[0]]["mode"] = 0o600
+        result = process_chunk(files, Path(tmpdir), entries=snapshot)
+
+    assert result.in_bytes == expect_in_bytes
+    with tarfile.open(result.parts[0]) as tar:
+        first = tar.getmember(files[0])
+    assert (first.mtime, first.mode) == (1000, 0o600)  # the metadata of the scan is used, not stat'ed again
+
+
+def test_opens_scanned_files_once_without_stating_their_paths(build_folder, tmpdir, monkeypatch):
+    build_folder, files_in_save, expect_in_bytes = build_folder
+    with chdir(build_folder):
+        snapshot = scan_tree('save')
+        files = list(snapshot)
+        opened = []
+        builtin_open = open
+
+        def counting_open(file, *args, **kwargs):
+            opened.append(str(file))
+            return builtin_open(file, *args, **kwargs)
+
+        def no_stat(stat):
+            def checked(path, *args, **kwargs):
+                assert isinstance(path, int) or str(path) not in snapshot, f'{path} is stat\'ed again'
+                return stat(path, *args, **kwargs)
+            return checked
+        monkeypatch.setattr('builtins.open', counting_open)
+        for name in ('stat', 'lstat'):
+            monkeypatch.setattr(os, name, no_stat(getattr(os, name)))
+        result = process_chunk(files, Path(tmpdir), entries=snapshot, text_codec=Codec('bz2'))
+        monkeypatch.undo()
+
+    assert result.in_bytes == expect_in_bytes
+    assert sorted(path for path in opened if path in snapshot) == files
+
+
+def test_adds_files_as_they_are_read_not_as_they_were_scanned(build_folder, tmpdir):
+    build_folder, files_in_save, expect_in_bytes = build_folder
+    with chdir(build_folder):
+        snapshot = scan_tree('save')
+        files = list(snapshot)
+        with open(files[0], 'ab') as f:
+            f.write(b' and more')
+        expected = Path(files[0]).read_bytes()
+        result = process_chunk(files, Path(tmpdir), entries=snapshot)
+
+    assert result.files[files[0]]["size"] == len(expected)
+    with tarfile.open(result.parts[0]) as tar:
+        assert tar.extractfile(files[0]).read() == expected
+
+
+def test_large_file_that_grows_while_it_is_added_fails(build_folder, tmpdir, monkeypatch):
+    build_folder, files_in_save, expect_in_bytes = build_folder
+    monkeypatch.setattr(catactl, 'whole_read_limit', 0)
+    with chdir(build_folder):
+        files = [str(file.relative_to(build_folder)) for file in files_in_save]
+        read = catactl.HashingReader.read
+
+        def grows(self, size=-1):
+            """the game appends to the file right after it was stat'ed"""
+            with open(files[0], 'ab') as f:
+                f.write(b'more')
+            return read(self, size)
+        monkeypatch.setattr(catactl.HashingReader, 'read', grows)
+        with pytest.raises(OSError, match='grew while it was backed up'):
+            process_chunk(files[:1], Path(tmpdir))
+
+
+def test_sorts_files_into_parts_by_kind(build_folder, tmpdir):
+    build_folder, files_in_save, expect_in_bytes = build_folder
+    compressed = build_folder / 'save' / 'compressed.zzip'
+    compressed.write_bytes(os.urandom(10_000))
+    with chdir(build_folder):
+        files = [str(file.relative_to(build_folder)) for file in files_in_save + [compressed]]
+        result = process_chunk(files, Path(tmpdir), text_codec=Codec('bz2'))
+
+    assert sorted(part.name for part in result.parts) == ['part-1-raw.tar', 'part-1-text.tbz2']
+    assert result.kinds['raw'] == {"codec": 'none', "files": 1, "in_bytes": 10_000,
+                                   "out_bytes": (Path(tmpdir) / 'part-1-raw.tar').stat().st_size}
+    assert result.kinds['text']["files"] == len(files_in_save)
+    assert result.kinds['text']["in_bytes"] == expect_in_bytes
+
+
 @pytest.fixture
 def release(env, build_folder) -> Release:
     """fixture with a Release object for the fake installed build"""
@@ -172,6 +301,124 @@ def test_restore_with_error(backup_id, release: Release):
     assert not (release.install_target / 'save.tmp').exists()
 
 
+def empty_trash(release: Release):
+    with chdir(release.install_target):
+        Backup.empty_trash(background=False)
+    return list((release.install_target / trash_folder).iterdir())
+
+
+def test_restore_leaves_no_staging_and_trashes_the_old_save(backup_id, release: Release):
+    (release.save_target / 'extra').touch()
+    Backup.restore(release, backup_id)
+    assert_save_contents(release)
+    assert not (release.install_target / staging_folder).exists()
+    assert not (release.install_target / restore_lock).exists()
+    assert empty_trash(release) == []
+
+
+def test_failed_extraction_leaves_save_untouched(backup_id, release: Release, monkeypatch):
+    (release.save_target / 'extra').touch()
+
+    def broken_extract(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(Backup, '_extract', broken_extract)
+
+    with pytest.raises(SystemExit) as e:
+        Backup.restore(release, backup_id)
+    assert e.value.code != 0
+    assert (release.save_target / 'extra').exists()
+    assert not (release.install_target / staging_folder).exists()
+    assert empty_trash(release) == []
+
+
+def stage_restore(release: Release, backup_id: str, state: str):
+    """makes it look like a restore was interrupted in the given state"""
+    staging = release.install_target / staging_folder
+    staging.mkdir()
+    shutil.copytree(release.save_target, staging / 'save')
+    with open(staging / restore_journal, 'w') as f:
+        json.dump({"backup": backup_id, "state": state}, f)
+    return staging
+
+
+def test_recovery_discards_unfinished_extraction(backup_id, release: Release):
+    staging = stage_restore(release, backup_id, 'extracting')
+    (staging / 'save' / '0' / '0').unlink()
+    (release.save_target / 'extra').touch()
+
+    with chdir(release.install_target):
+        Backup.recover()
+    assert not staging.exists()
+    assert (release.save_target / 'extra').exists()  # the save is as it was
+    assert empty_trash(release) == []
+
+
+def test_recovery_finishes_interrupted_swap(backup_id, release: Release):
+    staging = stage_restore(release, backup_id, 'ready')
+    # interrupted between moving the old save away and moving the restored one in
+    shutil.rmtree(release.save_target)
+
+    with chdir(release.install_target):
+        Backup.recover()
+    assert not staging.exists()
+    assert_save_contents(release)
+
+
+def test_backup_recovers_interrupted_restore(backup_id, release: Release):
+    stage_restore(release, backup_id, 'ready')
+    shutil.rmtree(release.save_target)
+
+    second = Backup.backup(release)
+    assert len(Backup.get_contents(second)) == num_subdirs_in_save * num_files_per_subdir
+
+
+@pytest.fixture
+def other_process():
+    """fixture with another process that is running"""
+    p = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])
+    yield psutil.Process(p.pid)
+    p.kill()
+    p.wait()
+
+
+def hold_restore_lock(release: Release, process: psutil.Process):
+    with open(release.install_target / restore_lock, 'w') as f:
+        json.dump({'pid': process.pid, 'create_time': process.create_time()}, f)
+
+
+def test_recovery_leaves_running_restore_alone(backup_id, release: Release, other_process):
+    staging = stage_restore(release, backup_id, 'extracting')
+    hold_restore_lock(release, other_process)
+
+    with chdir(release.install_target):
+        assert not Backup.recover()
+    Backup.backup(release)
+    assert (staging / restore_journal).exists()
+    with pytest.raises(SystemExit):
+        Backup.restore(release, backup_id)
+    assert (staging / restore_journal).exists()
+
+
+def test_recovery_takes_over_lock_of_exited_restore(backup_id, release: Release, other_process):
+    staging = stage_restore(release, backup_id, 'extracting')
+    hold_restore_lock(release, other_process)
+    other_process.kill()
+    other_process.wait()
+
+    with chdir(release.install_target):
+        assert Backup.recover()
+    assert not staging.exists()
+    assert not (release.install_target / restore_lock).exists()
+    assert_save_contents(release)
+
+
+def test_recovery_puts_back_save_stashed_by_older_versions(backup_id, release: Release):
+    release.save_target.rename(release.install_target / 'save.tmp')
+    Backup.restore(release, backup_id)
+    assert not (release.install_target / 'save.tmp').exists()
+    assert_save_contents(release)
+
+
 def test_restore_with_previously_broken_restore_attempt(backup_id, release: Release):
     # place a save.tmp to indicate the previous restore went horribly wrong
     # (like a power outage or a kill -9 or something)
@@ -185,3 +432,464 @@ def test_restore_with_previously_broken_restore_attempt(backup_id, release: Rele
     # it leaves everything untouched
     assert (release.install_target / 'save.tmp').is_file()
     assert_save_contents(release)
+
+
+def test_dedup_backup_restores(env, release: Release):
+    backup_id = Backup.backup(release, mode='dedup')
+    shutil.rmtree(release.save_target)
+
+    Backup.restore(release, backup_id)
+    assert_save_contents(release)
+
+
+def test_dedup_backup_stores_each_content_once(env, release: Release):
+    Backup.backup(release, mode='dedup')
+    objects = [f for f in env.object_folder.glob('**/*') if f.is_file()]
+    assert len(objects) == num_subdirs_in_save * num_files_per_subdir
+
+    # an unchanged save stores no new objects
+    Backup.backup(release, mode='dedup', label='again')
+    assert [f for f in env.object_folder.glob('**/*') if f.is_file()] == objects
+
+    # a changed file stores exactly one new object
+    with open(release.save_target / '0' / '1', 'w') as f:
+        f.write('changed')
+    backup_id = Backup.backup(release, mode='dedup', label='changed')
+    assert len([f for f in env.object_folder.glob('**/*') if f.is_file()]) == len(objects) + 1
+
+    Backup.restore(release, backup_id)
+    with open(release.save_target / '0' / '1') as f:
+        assert f.read() == 'changed'
+
+
+def part_members(env: Env, backup_id: str):
+    """names of the files in the parts of a backup"""
+    names = []
+    with tarfile.open(env.backup_folder / f'{backup_id}.{env.backup_suffix}') as tar:
+        for part in tar.getmembers():
+            if part.name.startswith('part-'):
+                with tarfile.open(fileobj=tar.extractfile(part)) as parttar:
+                    names += parttar.getnames()
+    return names
+
+
+def test_incremental_backup_only_contains_changed_files(env, backup_id, release: Release):
+    with open(release.save_target / '0' / '1', 'w') as f:
+        f.write('changed')
+    incremental_id = Backup.backup(release, label='incremental', mode='incremental')
+
+    assert part_members(env, incremental_id) == ['save/0/1']
+    assert Backup.read_metadata(incremental_id)["parent"] == backup_id
+
+
+def test_incremental_restore_walks_the_chain(env, backup_id, release: Release):
+    (release.save_target / '0' / '0').unlink()
+    incremental_id = Backup.backup(release, label='incremental', mode='incremental')
+    assert part_members(env, incremental_id) == []
+
+    shutil.rmtree(release.save_target)
+    Backup.restore(release, incremental_id)
+    assert not (release.save_target / '0' / '0').exists()
+    assert (release.save_target / '0' / '1').is_file()
+
+    # restoring the parent brings back the deleted file
+    Backup.restore(release, backup_id)
+    assert_save_contents(release)
+
+
+def test_incremental_backup_after_restore_is_empty(env, backup_id, release: Release, capsys):
+    Backup.restore(release, backup_id)
+    capsys.readouterr()
+    incremental_id = Backup.backup(release, label='incremental', mode='incremental')
+    assert part_members(env, incremental_id) == []
+    assert 'compression rate' not in capsys.readouterr().out  # nothing was compressed
+
+
+def test_backup_reports_compression_of_the_parts(env, release: Release):
+    stats = Stats('backup')
+    backup_id = Backup.backup(release, stats=stats)
+    with tarfile.open(env.backup_folder / f'{backup_id}.{env.backup_suffix}') as tar:
+        part_bytes = sum(member.size for member in tar.getmembers() if member.name.startswith('part-'))
+    assert stats.counters["out_bytes"] == part_bytes
+
+
+def test_incremental_backup_starts_a_new_chain_when_it_is_long(env, backup_id, release: Release):
+    env.backup_chain_length = 2
+    ids = []
+    for n in range(1, 4):
+        with open(release.save_target / '0' / '1', 'w') as f:
+            f.write(f'changed {n}')
+        ids.append(Backup.backup(release, label=f'incremental{n}', mode='incremental'))
+
+    assert [Backup.read_metadata(backup)["parent"] for backup in ids] == [backup_id, ids[0], None]
+    assert Backup.read_metadata(ids[1])["chain"] == [backup_id, ids[0]]
+    assert len(part_members(env, ids[2])) == num_subdirs_in_save * num_files_per_subdir
+
+
+def test_incremental_backup_starts_a_new_chain_when_it_is_large(env, backup_id, release: Release):
+    env.backup_chain_ratio = 0.0
+    incremental_id = Backup.backup(release, label='incremental', mode='incremental')
+    assert Backup.read_metadata(incremental_id)["parent"] == backup_id
+    assert Backup.read_metadata(Backup.backup(release, label='new', mode='incremental'))["parent"] is None
+
+
+def test_incremental_restore_without_parent(env, backup_id, release: Release):
+    incremental_id = Backup.backup(release, label='incremental', mode='incremental')
+    (env.backup_folder / f'{backup_id}.{env.backup_suffix}').unlink()
+
+    with pytest.raises(SystemExit) as e:
+        Backup.restore(release, incremental_id)
+    assert e.value.code != 0
+    assert_save_contents(release)
+
+
+def test_backup_with_small_parts_restores(env, release: Release):
+    backup_id = Backup.backup(release, max_part_bytes=100)
+    assert not list(env.backup_folder.glob('.spool-*'))  # the spooled parts are cleaned up
+
+    shutil.rmtree(release.save_target)
+    Backup.restore(release, backup_id)
+    assert_save_contents(release)
+
+
+@pytest.mark.parametrize('schedule', ['balanced', 'steal'])
+def test_backup_schedules_are_deterministic(env, release: Release, schedule):
+    first = Backup.backup(release, label='first', workers=3, schedule=schedule)
+    second = Backup.backup(release, label='second', workers=3, schedule=schedule)
+    assert sorted(part_members(env, first)) == sorted(part_members(env, second))
+    with tarfile.open(env.backup_folder / f'{first}.{env.backup_suffix}') as a:
+        with tarfile.open(env.backup_folder / f'{second}.{env.backup_suffix}') as b:
+            assert sorted(a.getnames()) == sorted(b.getnames())
+
+    shutil.rmtree(release.save_target)
+    Backup.restore(release, second)
+    assert_save_contents(release)
+
+
+def test_restores_backup_without_manifest(env, release: Release, tmpdir):
+    """backups made by older versions of catactl only contain .tgz parts"""
+    with chdir(release.install_target):
+        files = [file.as_posix() for file in sorted(Path('save').glob('**/*')) if file.is_file()]
+        parts = process_chunk(files[:40], Path(tmpdir), name='part-1').parts + \
+            process_chunk(files[40:], Path(tmpdir), name='part-2').parts
+    with tarfile.open(env.backup_folder / f'old.{env.backup_suffix}', mode='w') as tar:
+        for part in parts:
+            tar.add(str(part), arcname=part.name)
+
+    assert len(Backup.get_contents('old')) == num_subdirs_in_save * num_files_per_subdir
+
+    shutil.rmtree(release.save_target)
+    Backup.restore(release, 'old', workers=4)
+    assert_save_contents(release)
+
+
+def test_snapshot_keeps_the_save_as_it_was(release: Release):
+    snapshot = Backup.snapshot(release)
+    original = release.save_target / '0' / '0'
+    assert (snapshot / 'save' / '0' / '0').stat().st_ino == original.stat().st_ino  # linked, not copied
+
+    # the game replaces files when it saves
+    replacement = original.with_name('0.temp')
+    replacement.write_text('saved again')
+    os.replace(replacement, original)
+
+    backup_id = Backup.backup(release, source=snapshot)
+    shutil.rmtree(snapshot)
+    Backup.restore(release, backup_id)
+    assert_save_contents(release)
+
+
+def test_recovery_removes_abandoned_snapshots_and_spools(env, release: Release, other_process, monkeypatch):
+    monkeypatch.setattr(catactl, 'remove_in_background',
+                        lambda paths: [shutil.rmtree(path) for path in paths])
+    dead = psutil.Process(subprocess.Popen([sys.executable, '-c', '']).pid)
+    dead.wait()
+    folders = {}
+    for name, owner in (('dead', dead), ('running', other_process), ('unclaimed', None)):
+        for parent, prefix in ((release.install_target, snapshot_prefix), (env.backup_folder, spool_prefix)):
+            folder = parent / f'{prefix}{name}'
+            folder.mkdir()
+            if owner is not None:
+                claim_folder(folder, owner)
+            folders[folder] = name
+
+    with chdir(release.install_target):
+        assert Backup.recover()
+    assert sorted(folders[folder] for folder in folders if folder.exists()) == ['running', 'running',
+                                                                                   'unclaimed', 'unclaimed']
+    old = time.time() - 7200
+    for folder in folders:
+        if folder.exists():
+            os.utime(folder, (old, old))
+    with chdir(release.install_target):
+        Backup.recover()
+    assert sorted(folders[folder] for folder in folders if folder.exists()) == ['running', 'running']
+
+
+def test_backs_up_snapshot_in_background(tmp_path, monkeypatch):
+    # the background process finds the app folder in the home folder, like any catactl command
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.setenv('PYTHONPATH', str(Path(__file__).parent.parent))
+    init_app(tmp_path / 'AppData' / 'Local' / 'Cataclysm')
+    release = Release(tag_name='fake_build', file_name='fake.zip', download_url='', timestamp='')
+    (release.save_target / 'world').mkdir(parents=True)
+    (release.save_target / 'world' / 'map').write_text('map')
+    switch_install(release)
+
+    snapshot = Backup.snapshot(release)
+    Backup.backup_in_background(snapshot, label='background', mode='full')
+    deadline = time.monotonic() + 60
+    while snapshot.exists() and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    assert not snapshot.exists(), current_env.background_log.read_text()
+    [backup_id] = Backup.get_list()
+    assert backup_id.endswith('-background')
+    assert list(Backup.get_contents(backup_id)) == ['save/world/map']
+
+
+def change_save(release: Release):
+    """adds, removes and modifies a file, and touches another one without changing it"""
+    (release.save_target / 'added').write_text('new')
+    (release.save_target / '0' / '0').unlink()
+    (release.save_target / '0' / '1').write_text('modified')
+    os.utime(release.save_target / '0' / '2', ns=(0, 0))
+
+
+@pytest.mark.parametrize('mode', ['full', 'incremental', 'dedup'])
+def test_diffs_backups_without_decompressing(release: Release, mode, monkeypatch):
+    old = Backup.backup(release, label='old', mode=mode)
+    change_save(release)
+    new = Backup.backup(release, label='new', mode=mode)
+
+    def no_decompressing(*args):
+        raise AssertionError('must not decompress')
+    monkeypatch.setattr(Codec, 'open_reader', no_decompressing)
+
+    diff = Backup.diff(old, new)
+    assert list(diff.added) == ['save/added']
+    assert list(diff.removed) == ['save/0/0']
+    assert list(diff.modified) == ['save/0/1']
+    before, after = diff.modified['save/0/1']
+    assert after['size'] == len('modified')
+
+
+def test_diffs_backup_with_save(release: Release):
+    backup_id = Backup.backup(release)
+    assert Backup.diff(backup_id, build=release) == BackupDiff()
+
+    change_save(release)
+    diff = Backup.diff(backup_id, build=release)
+    assert list(diff.added) == ['save/added']
+    assert list(diff.removed) == ['save/0/0']
+    assert list(diff.modified) == ['save/0/1']
+
+
+def test_backup_with_kinds_of_files_restores(env, release: Release):
+    (release.save_target / 'compressed.zzip').write_bytes(os.urandom(10_000))
+    (release.save_target / 'sound.dat').write_bytes(bytes(range(256)) * 100)
+    stats = Stats('backup')
+    backup_id = Backup.backup(release, text_codec='bz2', stats=stats)
+    with tarfile.open(env.backup_folder / f'{backup_id}.{env.backup_suffix}') as tar:
+        suffixes = {name.split('.', 1)[1] for name in tar.getnames() if name.startswith('part-')}
+    assert suffixes == {'tar', 'tbz2', 'tgz'}
+    report = stats.to_dict()
+    assert (report['raw_files'], report['other_files']) == (1, 1)
+    assert report['text_files'] == num_subdirs_in_save * num_files_per_subdir
+
+    (release.save_target / 'compressed.zzip').unlink()
+    (release.save_target / 'sound.dat').unlink()
+    Backup.restore(release, backup_id)
+    assert (release.save_target / 'compressed.zzip').stat().st_size == 10_000
+    (release.save_target / 'compressed.zzip').unlink()
+    (release.save_target / 'sound.dat').unlink()
+    assert_save_contents(release)
+
+
+def test_backup_and_restore_record_stats(env, release: Release):
+    stats = Stats('backup')
+    backup_id = Backup.backup(release, workers=2, stats=stats)
+    report = stats.to_dict()
+    assert {'scan', 'compress', 'write', 'fsync'} <= set(report['phases'])
+    assert report['files'] == num_subdirs_in_save * num_files_per_subdir
+    assert sum(worker['tasks'] for worker in report['workers']) == 2
+    assert sum(worker['bytes'] for worker in report['workers']) == report['in_bytes']
+    assert report['queue_wait']['tasks'] == 2
+    assert report['peak_memory']['main'] > 0
+
+    stats = Stats('restore')
+    Backup.restore(release, backup_id, workers=2, stats=stats)
+    report = stats.to_dict()
+    assert {'extract', 'utime'} <= set(report['phases'])
+    assert sum(worker['tasks'] for worker in report['workers']) == 2
+    assert_save_contents(release)
+
+
+def test_profiles_worker_tasks(env, release: Release, tmpdir):
+    profiles = Path(tmpdir) / 'profiles'
+    Backup.backup(release, workers=2, stats=Stats('backup', profiles))
+    assert len(list(profiles.glob('process_chunk-*.prof'))) == 2
+
+
+@pytest.mark.parametrize('codec', ['gz:1', 'xz', 'none'])
+def test_backup_with_codec_restores(env, release: Release, codec):
+    backup_id = Backup.backup(release, codec=codec)
+    assert Backup.read_metadata(backup_id)["codec"] == codec
+
+    shutil.rmtree(release.save_target)
+    Backup.restore(release, backup_id)
+    assert_save_contents(release)
+
+
+def test_backup_contents_lists_every_file(env, backup_id, release: Release):
+    contents = Backup.get_contents(backup_id)
+    assert len(contents) == num_subdirs_in_save * num_files_per_subdir
+    assert contents['save/0/3']["size"] == len(generate_content(3))
+    assert contents['save/0/3']["backup"] == backup_id
+
+
+def test_backup_contents_follows_the_chain(env, backup_id, release: Release):
+    with open(release.save_target / '0' / '1', 'w') as f:
+        f.write('changed')
+    (release.save_target / '0' / '0').unlink()
+    incremental_id = Backup.backup(release, label='incremental', mode='incremental')
+
+    contents = Backup.get_contents(incremental_id)
+    assert 'save/0/0' not in contents
+    assert contents['save/0/1']["backup"] == incremental_id
+    assert contents['save/0/2']["backup"] == backup_id
+
+
+def test_restores_single_file(env, release: Release):
+    backup_id = Backup.backup(release, max_part_bytes=100)
+    (release.save_target / '3' / '40').unlink()
+    with open(release.save_target / '3' / '41', 'w') as f:
+        f.write('changed, but not restored')
+
+    assert Backup.restore_paths(release, backup_id, ['save/3/40']) == ['save/3/40']
+    with open(release.save_target / '3' / '40', 'rb') as f:
+        assert f.read() == generate_content(40)
+    with open(release.save_target / '3' / '41') as f:
+        assert f.read() == 'changed, but not restored'
+
+
+def test_restores_folder(env, release: Release):
+    backup_id = Backup.backup(release, mode='dedup')
+    shutil.rmtree(release.save_target / '3')
+
+    restored = Backup.restore_paths(release, backup_id, ['save/3/'])
+    assert len(restored) == num_files_per_subdir
+    assert_save_contents(release)
+
+
+def test_restore_of_missing_path_fails(env, backup_id, release: Release):
+    with pytest.raises(SystemExit) as e:
+        Backup.restore_paths(release, backup_id, ['save/nope'])
+    assert e.value.code != 0
+
+
+def flip_a_bit(path: Path, offset: int):
+    with open(path, 'r+b') as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 1]))
+
+
+def test_verifies_intact_backups(env, backup_id, release: Release):
+    Backup.backup(release, label='dedup', mode='dedup')
+    Backup.backup(release, label='incremental', mode='incremental')
+    problems = Backup.verify(Backup.get_list())
+    assert len(problems) == 3
+    assert not any(problems.values())
+
+
+def test_verify_finds_corrupt_part(env, release: Release):
+    backup_id = Backup.backup(release, codec='none')
+    archive = env.backup_folder / f'{backup_id}.{env.backup_suffix}'
+    with tarfile.open(archive) as tar:
+        part = [member for member in tar.getmembers() if member.name.startswith('part-')][0]
+        first = tarfile.open(fileobj=tar.extractfile(part)).getmembers()[0]
+    # flip a bit in the content of the first file in the part
+    flip_a_bit(archive, part.offset_data + first.offset_data)
+
+    problems = Backup.verify([backup_id])[backup_id]
+    assert f'{first.name} in {part.name} is corrupt' in problems
+    assert f'part {part.name} is corrupt' in problems
+
+
+def test_verify_finds_corrupt_object(env, release: Release):
+    backup_id = Backup.backup(release, mode='dedup')
+    digest = Backup.read_metadata(backup_id)["files"]['save/0/0']["sha256"]
+    ObjectStore(env.object_folder).path(digest).unlink()
+
+    assert Backup.verify([backup_id])[backup_id] == [f'object {digest} is missing']
+
+
+backups_over_two_days = [
+    '2021-05-24-090000-a',
+    '2021-05-24-100000-a',
+    '2021-05-24-101500-a',
+    '2021-05-25-080000-a',
+    '2021-05-25-083000-a',
+    '2021-05-25-090000-a',
+]
+
+
+def test_retains_last_backups():
+    assert select_retained(backups_over_two_days, keep_last=2) == {'2021-05-25-083000-a', '2021-05-25-090000-a'}
+
+
+def test_retains_last_backup_of_each_bucket():
+    assert select_retained(backups_over_two_days, keep_daily=5) == {'2021-05-24-101500-a', '2021-05-25-090000-a'}
+    assert select_retained(backups_over_two_days, keep_hourly=3) == \
+        {'2021-05-24-101500-a', '2021-05-25-083000-a', '2021-05-25-090000-a'}
+
+
+def test_retains_backups_without_timestamp():
+    assert select_retained(['mine', *backups_over_two_days], keep_last=1) == {'mine', '2021-05-25-090000-a'}
+
+
+def test_prune_keeps_parents_of_incremental_backups(env, backup_id, release: Release, capsys):
+    (env.backup_folder / f'2000-01-01-000000-old.{env.backup_suffix}').touch()
+    incremental_id = Backup.backup(release, label='incremental', mode='incremental')
+
+    capsys.readouterr()
+    assert Backup.prune(keep_last=1, dry_run=True) == ['2000-01-01-000000-old']
+    assert f'would keep {backup_id} only because {incremental_id} is based on it' in capsys.readouterr().out
+    assert len(Backup.get_list()) == 3
+
+    assert Backup.prune(keep_last=1) == ['2000-01-01-000000-old']
+    assert Backup.get_list() == sorted([backup_id, incremental_id])
+
+
+def test_prune_removes_older_chains(env, backup_id, release: Release):
+    env.backup_chain_length = 1
+    ids = [Backup.backup(release, label=f'incremental{n}', mode='incremental') for n in range(1, 4)]
+    assert Backup.read_metadata(ids[1])["parent"] is None  # a new chain
+
+    assert Backup.prune(keep_last=1) == [backup_id, ids[0]]
+    assert Backup.get_list() == ids[1:]
+
+
+def test_gc_removes_unused_objects(env, release: Release):
+    old_id = Backup.backup(release, mode='dedup', label='old')
+    with open(release.save_target / '0' / '1', 'w') as f:
+        f.write('changed')
+    Backup.backup(release, mode='dedup', label='new')
+    store = ObjectStore(env.object_folder)
+    old_digest = Backup.read_metadata(old_id)["files"]['save/0/1']["sha256"]
+
+    # objects of a backup that is still around are used, and fresh objects are left alone anyway
+    assert Backup.gc(grace_seconds=0) == (0, 0)
+    # unless the backup would be removed, like in a dry run of prune
+    count, freed = Backup.gc(grace_seconds=0, dry_run=True, excluding=[old_id])
+    assert count == 1 and freed > 0
+    assert old_digest in store
+    (env.backup_folder / f'{old_id}.{env.backup_suffix}').unlink()
+    assert Backup.gc()[0] == 0
+
+    count, freed = Backup.gc(grace_seconds=0)
+    assert count == 1 and freed > 0
+    assert old_digest not in store
+    assert len(list(store)) == num_subdirs_in_save * num_files_per_subdir
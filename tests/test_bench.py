@@ -0,0 +1,37 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+bench = Path(__file__).parent.parent / 'benchmarks' / 'bench_backup.py'
+
+
+def test_benchmark_writes_a_result_per_measurement(tmpdir):
+    output = Path(tmpdir) / 'bench.txt'
+    subprocess.run([sys.executable, str(bench), '--scale', '0.01', '--workers', '1,2', '--codec', 'gz:1,none',
+                    '--repeat', '1', '--output', str(output)], check=True, capture_output=True)
+    with open(output) as f:
+        results = [json.loads(line) for line in f]
+    assert [(r['bench'], r['codec'], r['workers']) for r in results] == [
+        ('process_chunk', 'gz:1', 1), ('backup', 'gz:1', 1), ('restore', 'gz:1', 1),
+        ('backup', 'gz:1', 2), ('restore', 'gz:1', 2),
+        ('process_chunk', 'none', 1), ('backup', 'none', 1), ('restore', 'none', 1),
+        ('backup', 'none', 2), ('restore', 'none', 2),
+    ]
+    assert all(r['mib_per_s'] > 0 and r['files'] > 0 for r in results)
+
+
+def test_generated_save_is_reproducible(tmpdir):
+    sys.path.insert(0, str(bench.parent))
+    try:
+        from savegen import SaveProfile, generate_save
+    finally:
+        sys.path.remove(str(bench.parent))
+
+    profile = SaveProfile().scaled(0.01)
+    a = generate_save(Path(tmpdir) / 'a', profile, seed=1)
+    generate_save(Path(tmpdir) / 'b', profile, seed=1)
+    assert a['files'] == sum(1 for p in (Path(tmpdir) / 'a').glob('**/*') if p.is_file())
+    for path in (Path(tmpdir) / 'a').glob('**/*'):
+        if path.is_file():
+            assert path.read_bytes() == (Path(tmpdir) / 'b' / path.relative_to(Path(tmpdir) / 'a')).read_bytes()
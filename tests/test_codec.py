@@ -0,0 +1,86 @@
+import io
+import os
+import pytest
+import tarfile
+from pathlib import Path
+from catactl.codec import Codec, codec_names, classify
+
+
+def test_parses_name_and_level():
+    assert Codec.parse('gz') == Codec('gz')
+    assert Codec.parse('xz:2') == Codec('xz', 2)
+    assert str(Codec.parse('bz2:1')) == 'bz2:1'
+
+
+def test_uses_default_level():
+    assert Codec.parse('gz').compression_level == 9
+    assert Codec.parse('gz:1').compression_level == 1
+    assert Codec.parse('gz:0').compression_level == 0
+
+
+@pytest.mark.parametrize('spec', ['bogus', 'none:3', 'gz:x', 'gz:10', 'xz:12', 'bz2:0', 'zstd:23'])
+def test_rejects_bad_codecs(spec):
+    with pytest.raises(ValueError):
+        Codec.parse(spec)
+
+
+def test_tells_codec_from_part_name():
+    assert Codec.from_part_name('part-1.tgz') == Codec('gz')
+    assert Codec.from_part_name('part-1-2.txz') == Codec('xz')
+    with pytest.raises(ValueError):
+        Codec.from_part_name('part-1.zip')
+
+
+@pytest.mark.parametrize('name', codec_names)
+def test_roundtrips_tar(tmpdir, name):
+    if name == 'zstd':
+        pytest.importorskip('zstandard')
+    if name == 'lz4':
+        pytest.importorskip('lz4')
+    codec = Codec.parse(name)
+    path = Path(tmpdir) / f'part{codec.suffix}'
+
+    with open(path, 'wb') as f:
+        writer = codec.open_writer(f)
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            tarinfo = tarfile.TarInfo('file')
+            tarinfo.size = 5
+            tar.addfile(tarinfo, io.BytesIO(b'hello'))
+        writer.close()
+        assert not f.closed
+
+    with open(path, 'rb') as f:
+        with Codec.from_part_name(path.name).open_reader(f) as reader:
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                member = tar.next()
+                assert tar.extractfile(member).read() == b'hello'
+
+
+@pytest.mark.parametrize('name, content, kind', [
+    ('chunk.zzip', b'anything', 'raw'),
+    ('master.gsav', b'\0\1\2', 'text'),
+    ('o.0.0', '{"overmap": "ü"}'.encode() * 1000, 'text'),
+    ('map.mmr', os.urandom(50_000), 'raw'),
+    ('sound.dat', bytes(range(256)) * 200, 'other'),
+    ('tiny.dat', os.urandom(100), 'other'),
+])
+def test_classifies_files(tmp_path, name, content, kind):
+    path = tmp_path / name
+    path.write_bytes(content)
+    assert classify(str(path)) == kind
+
+
+def test_classifies_text_cut_in_the_middle_of_a_character(tmp_path):
+    path = tmp_path / 'notes'
+    # the first 4096 bytes end with the first byte of a two byte character
+    path.write_bytes(b'a' * 4095 + 'ü'.encode() * 10_000)
+    assert classify(str(path)) == 'text'
+
+
+def test_classifies_open_file_of_known_size(tmp_path, monkeypatch):
+    path = tmp_path / 'o.0.0'
+    path.write_bytes(b'{"overmap": 1}' * 1000)
+    with open(path, 'rb') as f:
+        monkeypatch.setattr(os, 'fstat', None)
+        assert classify(str(path), f, path.stat().st_size) == 'text'
+        assert f.tell() == 0
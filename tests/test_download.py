@@ -0,0 +1,270 @@
+import hashlib
+import os
+import zipfile
+import zlib
+import pytest
+import requests
+import catactl.download
+from catactl import Release, get_disk_usage, switch_install
+from catactl.config import Env
+from catactl.download import DownloadError, PartialDownload, fetch, extract, download_and_extract
+from pathlib import Path
+
+
+def make_zip(path: Path, num_files: int = 20) -> dict:
+    """Writes a zip file like a release build, with compressible and incompressible files. Returns their contents"""
+    contents = {'data/': b''}
+    for i in range(num_files):
+        contents[f'data/json/file{i}.json'] = f'{{"id": {i}}}\n'.encode() * (i % 20 * 50)
+        contents[f'gfx/tiles{i}.png'] = os.urandom(i % 20 * 1000)
+    contents['cataclysm-tiles.exe'] = b'MZ' + os.urandom(100_000)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in contents.items():
+            zf.writestr(name, data)
+    return {name: data for name, data in contents.items() if not name.endswith('/')}
+
+
+def digest_of(path: Path) -> str:
+    return 'sha256:' + hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def assert_extracted(folder: Path, contents: dict):
+    for name, data in contents.items():
+        assert (folder / name).read_bytes() == data
+
+
+@pytest.fixture
+def release_zip(http_server):
+    path = http_server.root / 'cdda-windows-tiles-x64-2021-01-01-0000.zip'
+    contents = make_zip(path)
+    return path, contents
+
+
+def test_fetches_and_checks_file(http_server, release_zip, tmpdir):
+    path, _ = release_zip
+    target = Path(tmpdir) / path.name
+    fetch(http_server.url(path.name), target, path.stat().st_size, digest_of(path))
+    assert target.read_bytes() == path.read_bytes()
+    assert not target.with_name(f'{target.name}.part').exists()
+
+
+@pytest.mark.parametrize('size, digest', [(1, None), (0, 'sha256:' + '0' * 64)])
+def test_refuses_corrupt_download(http_server, release_zip, tmpdir, size, digest):
+    path, _ = release_zip
+    target = Path(tmpdir) / path.name
+    with pytest.raises(DownloadError):
+        fetch(http_server.url(path.name), target, size, digest)
+    assert not target.exists()
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(catactl.download, 'segment_size', 16 * 1024)
+
+
+def test_fetches_in_segments_over_several_connections(http_server, release_zip, tmpdir, small_segments):
+    path, _ = release_zip
+    target = Path(tmpdir) / path.name
+    fetch(http_server.url(path.name), target, digest=digest_of(path), connections=4)
+    assert target.read_bytes() == path.read_bytes()
+    assert len(http_server.ranges_requested) > 4
+
+
+def test_resumes_interrupted_download(http_server, release_zip, tmpdir, small_segments):
+    path, _ = release_zip
+    target = Path(tmpdir) / path.name
+    url = http_server.url(path.name)
+    http_server.drops = 1
+    http_server.drop_from = 100_000
+    with pytest.raises((DownloadError, requests.RequestException)):
+        fetch(url, target, digest=digest_of(path))
+    assert not target.exists()
+
+    # only the missing segments are downloaded the second time
+    download = PartialDownload(target, url, path.stat().st_size, None)
+    assert download.state_path.exists()
+    http_server.ranges_requested.clear()
+    fetch(url, target, digest=digest_of(path), connections=2)
+    assert target.read_bytes() == path.read_bytes()
+    assert not download.state_path.exists()
+    assert len(http_server.ranges_requested) < path.stat().st_size // (16 * 1024)
+
+
+def test_starts_over_if_file_changed_on_server(http_server, release_zip, tmpdir, small_segments):
+    path, _ = release_zip
+    target = Path(tmpdir) / path.name
+    url = http_server.url(path.name)
+    http_server.drops = 1
+    with pytest.raises((DownloadError, requests.RequestException)):
+        fetch(url, target)
+
+    make_zip(path)
+    fetch(url, target, digest=digest_of(path))
+    assert target.read_bytes() == path.read_bytes()
+
+
+def test_partial_download_merges_ranges(tmpdir, small_segments):
+    download = PartialDownload.open(Path(tmpdir) / 'x.zip', 'http://x/x.zip', 100_000, '"1"')
+    download.add(16384, 32768)
+    download.add(90_000, 100_000)
+    download.add(0, 16384)
+    assert download.done == [[0, 32768], [90_000, 100_000]]
+    assert download.covers(100, 30_000)
+    assert not download.covers(30_000, 40_000)
+    assert download.missing() == [[32768, 49152], [49152, 65536], [65536, 81920], [81920, 90_000]]
+
+    resumed = PartialDownload.open(Path(tmpdir) / 'x.zip', 'http://x/x.zip', 100_000, '"1"')
+    assert resumed.done == download.done
+    other = PartialDownload.open(Path(tmpdir) / 'x.zip', 'http://x/x.zip', 100_000, '"2"')
+    assert other.done == []
+
+
+def test_extracts_in_parallel(release_zip, tmpdir):
+    path, contents = release_zip
+    extract(path, Path(tmpdir) / 'install', workers=4)
+    assert_extracted(Path(tmpdir) / 'install', contents)
+
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_downloads_and_extracts_at_once(http_server, release_zip, tmpdir, ranges):
+    http_server.ranges = ranges
+    path, contents = release_zip
+    target = Path(tmpdir) / path.name
+    download_and_extract(http_server.url(path.name), target, Path(tmpdir) / 'install',
+                         path.stat().st_size, digest_of(path), workers=4)
+    assert_extracted(Path(tmpdir) / 'install', contents)
+    assert target.read_bytes() == path.read_bytes()
+
+
+def test_resumes_interrupted_download_and_extract(http_server, release_zip, tmpdir, small_segments):
+    path, contents = release_zip
+    url = http_server.url(path.name)
+    target = Path(tmpdir) / path.name
+    http_server.drops = 1
+    with pytest.raises((DownloadError, requests.RequestException)):
+        download_and_extract(url, target, Path(tmpdir) / 'install', digest=digest_of(path))
+
+    download_and_extract(url, target, Path(tmpdir) / 'install', digest=digest_of(path), connections=4)
+    assert_extracted(Path(tmpdir) / 'install', contents)
+    assert target.read_bytes() == path.read_bytes()
+
+
+def test_downloads_and_extracts_large_central_directory(http_server, tmpdir):
+    path = http_server.root / 'many.zip'
+    contents = make_zip(path, num_files=1500)
+    target = Path(tmpdir) / path.name
+    download_and_extract(http_server.url(path.name), target, Path(tmpdir) / 'install', digest=digest_of(path))
+    assert_extracted(Path(tmpdir) / 'install', contents)
+
+
+def test_installs_release_while_downloading(env: Env, http_server, release_zip):
+    path, contents = release_zip
+    release = Release(tag_name='cdda-experimental-2021-01-01-0000', file_name=path.name,
+                      download_url=http_server.url(path.name), timestamp='2021-01-01T00:00:00Z',
+                      size=path.stat().st_size, digest=digest_of(path))
+    release.download_and_install()
+    assert_extracted(release.install_target, contents)
+    assert Release.load(release.manifest_target) == release
+    assert release.download_target.exists()
+
+
+def test_refuses_to_install_corrupt_release(env: Env, http_server, release_zip):
+    path, _ = release_zip
+    release = Release(tag_name='cdda-experimental-2021-01-01-0000', file_name=path.name,
+                      download_url=http_server.url(path.name), timestamp='2021-01-01T00:00:00Z',
+                      digest='sha256:' + '0' * 64)
+    with pytest.raises(SystemExit):
+        release.download_and_install()
+    assert not release.download_target.exists()
+    assert not release.manifest_target.exists()
+
+
+def test_installed_builds_share_identical_files(env: Env, http_server):
+    releases = []
+    for n in range(2):
+        path = http_server.root / f'cdda-windows-tiles-x64-2021-01-0{n + 1}-0000.zip'
+        make_zip(path)
+        with zipfile.ZipFile(path, 'a') as zf:
+            zf.writestr('VERSION.txt', f'build {n}')
+        release = Release(tag_name=f'cdda-experimental-2021-01-0{n + 1}-0000', file_name=path.name,
+                          download_url=http_server.url(path.name), timestamp='2021-01-01T00:00:00Z')
+        release.download_and_install()
+        releases.append(release)
+
+    old, new = (release.install_target for release in releases)
+    assert os.path.samefile(old / 'data/json/file3.json', new / 'data/json/file3.json')
+    assert not os.path.samefile(old / 'VERSION.txt', new / 'VERSION.txt')
+
+    usages, actual = get_disk_usage()
+    assert [usage.name for usage in usages] == [release.tag_name for release in releases]
+    assert usages[1].shared > 0
+    assert actual < sum(usage.size for usage in usages)
+
+    # reinstalling must not change the files of the other build through their links
+    (http_server.root / releases[1].file_name).unlink()
+    path = http_server.root / releases[1].file_name
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('data/json/file3.json', 'changed')
+    releases[1].download_target.unlink()
+    releases[1].download_and_install(force=True)
+    assert (new / 'data/json/file3.json').read_text() == 'changed'
+    assert (old / 'data/json/file3.json').read_text() != 'changed'
+
+
+def test_disk_usage_counts_links_without_the_stats_of_scandir(env: Env, windows_scandir):
+    store = env.link_folder / 'ab' / 'cd'
+    store.parent.mkdir(parents=True)
+    store.write_bytes(b'shared')
+    for build in ('a', 'b'):
+        (env.install_folder / build).mkdir()
+        os.link(store, env.install_folder / build / 'shared')
+        (env.install_folder / build / 'own').write_bytes(b'own')
+
+    usages, actual = get_disk_usage()
+    assert [(usage.name, usage.files, usage.size, usage.shared) for usage in usages] == [
+        ('a', 2, 9, 6), ('b', 2, 9, 6)]
+    assert actual == 12
+
+
+def requested_bytes(server) -> int:
+    """How many bytes were requested with ranges from an offset"""
+    total = 0
+    for spec in server.ranges_requested:
+        first, _, last = spec[len('bytes='):].partition('-')
+        if first:
+            total += int(last) - int(first) + 1
+    return total
+
+
+def test_delta_install_only_downloads_changed_files(env: Env, http_server, small_segments):
+    old_zip = http_server.root / 'cdda-windows-tiles-x64-2021-01-01-0000.zip'
+    contents = make_zip(old_zip)
+    old = Release(tag_name='cdda-experimental-2021-01-01-0000', file_name=old_zip.name,
+                  download_url=http_server.url(old_zip.name), timestamp='2021-01-01T00:00:00Z')
+    old.download_and_install()
+    switch_install(old)
+
+    new_zip = http_server.root / 'cdda-windows-tiles-x64-2021-01-02-0000.zip'
+    contents['cataclysm-tiles.exe'] = b'MZ' + os.urandom(20_000)
+    with zipfile.ZipFile(new_zip, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in contents.items():
+            zf.writestr(name, data)
+    new = Release(tag_name='cdda-experimental-2021-01-02-0000', file_name=new_zip.name,
+                  download_url=http_server.url(new_zip.name), timestamp='2021-01-02T00:00:00Z')
+    http_server.ranges_requested.clear()
+    new.download_and_install(delta=True)
+
+    assert_extracted(new.install_target, contents)
+    assert os.path.samefile(old.install_target / 'gfx/tiles7.png', new.install_target / 'gfx/tiles7.png')
+    assert requested_bytes(http_server) < new_zip.stat().st_size // 4
+    assert not new.download_target.exists()
+    assert new.load_members()['cataclysm-tiles.exe'] == [20_002, zlib.crc32(contents['cataclysm-tiles.exe'])]
+
+
+def test_delta_install_without_current_install_downloads_everything(env: Env, http_server, release_zip):
+    path, contents = release_zip
+    release = Release(tag_name='cdda-experimental-2021-01-01-0000', file_name=path.name,
+                      download_url=http_server.url(path.name), timestamp='2021-01-01T00:00:00Z')
+    release.download_and_install(delta=True)
+    assert_extracted(release.install_target, contents)
+    assert release.download_target.exists()
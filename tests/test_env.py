@@ -10,8 +10,12 @@ def test_all_items_are_placed_under_the_app_root_directory(tmpdir):
     assert root in env.install_folder.parents
     assert root in env.download_folder.parents
     assert root in env.backup_folder.parents
+    assert root in env.object_folder.parents
     assert root in env.current_install_data_file.parents
     assert root in env.builds_data_file.parents
+    assert root in env.api_cache_file.parents
+    assert root in env.link_folder.parents
+    assert root in env.background_log.parents
 
 
 def test_folders_are_created(tmpdir):
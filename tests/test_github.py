@@ -0,0 +1,124 @@
+import http.server
+import json
+import threading
+import urllib.parse
+import pytest
+from catactl import ReleaseList
+from catactl.config import Env
+from catactl.github import GitHub
+
+
+def release(n: int) -> dict:
+    """a GitHub release object for experimental build n"""
+    return {
+        'tag_name': f'cdda-experimental-2021-01-01-{n:04}',
+        'published_at': '2021-01-01T00:00:00Z',
+        'assets': [{
+            'name': f'cdda-windows-tiles-x64-2021-01-01-{n:04}.zip',
+            'browser_download_url': f'https://example.com/{n}.zip',
+            'size': 1000 + n,
+        }, {
+            'name': f'cdda-Windows_x64-Tiles-{n}.zip',
+            'browser_download_url': f'https://example.com/stable-{n}.zip',
+        }],
+    }
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the releases of server.releases, newest first, in pages, with an etag"""
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if self.server.rate_limited:
+            self.send_error(403, 'API rate limit exceeded')
+            return
+        if url.path.endswith('/releases/latest'):
+            body = release(len(self.server.releases) - 1)
+        else:
+            per_page = int(query.get('per_page', ['30'])[0])
+            page = int(query.get('page', ['1'])[0])
+            releases = [release(n) for n in reversed(self.server.releases)]
+            body = releases[(page - 1) * per_page:page * per_page]
+
+        data = json.dumps(body).encode()
+        etag = f'"{hash(data):x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def github_api(env: Env, monkeypatch):
+    """fixture with a fake GitHub api that env.repo_url points at"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+    server.releases = list(range(250))
+    server.requests = []
+    server.not_modified = 0
+    server.rate_limited = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(Env.current_global, 'repo_url', f'http://127.0.0.1:{server.server_port}/repos/x/y')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_gets_pages_concurrently(env: Env, github_api):
+    ReleaseList.update(only_latest_stable=False, pages=3)
+    builds = ReleaseList.load()
+    assert len(builds) == 250
+    assert builds[0].tag_name == 'cdda-experimental-2021-01-01-0249'
+    assert builds[0].size == 1249
+    assert len(github_api.requests) == 3
+
+
+def test_stops_at_last_page(env: Env, github_api):
+    github_api.releases = list(range(150))
+    ReleaseList.update(only_latest_stable=False, pages=5)
+    assert len(ReleaseList.load()) == 150
+
+
+def test_uses_fresh_cache_without_asking(env: Env, github_api):
+    ReleaseList.update(only_latest_stable=False)
+    ReleaseList.update(only_latest_stable=False)
+    assert len(github_api.requests) == 1
+
+
+def test_revalidates_stale_cache(env: Env, github_api, monkeypatch):
+    monkeypatch.setattr(Env.current_global, 'api_cache_ttl', 0)
+    ReleaseList.update(only_latest_stable=False)
+    ReleaseList.update(only_latest_stable=False)
+    assert len(github_api.requests) == 2
+    assert github_api.not_modified == 1
+
+    github_api.releases.append(250)
+    ReleaseList.update(only_latest_stable=False)
+    assert ReleaseList.load()[0].tag_name == 'cdda-experimental-2021-01-01-0250'
+
+
+def test_uses_stale_cache_when_rate_limited(env: Env, github_api, monkeypatch):
+    monkeypatch.setattr(Env.current_global, 'api_cache_ttl', 0)
+    ReleaseList.update(only_latest_stable=True)
+    github_api.rate_limited = True
+    ReleaseList.update(only_latest_stable=True)
+    assert len(github_api.requests) == 2
+    assert [b.tag_name for b in ReleaseList.find(stable=True)] == ['cdda-experimental-2021-01-01-0249']
+
+
+def test_fails_when_rate_limited_without_cache(env: Env, github_api):
+    github_api.rate_limited = True
+    api = GitHub(env.api_cache_file)
+    with pytest.raises(Exception):
+        api.get(f'{env.repo_url}/releases')
@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import psutil
+import pytest
+from catactl import Release, get_running_process, record_game_process
+from catactl.config import Env
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='runs a copy of /bin/sleep as the game')
+
+
+@pytest.fixture
+def fake_game(env: Env):
+    """fixture that runs a process named like the game from under the app root"""
+    exe = env.install_folder / 'cataclysm-tiles'
+    shutil.copy('/bin/sleep', exe)
+    p = subprocess.Popen([str(exe), '30'])
+    yield p
+    p.kill()
+    p.wait()
+
+
+def test_finds_recorded_process_without_scanning(env: Env, monkeypatch):
+    record_game_process(psutil.Process())
+    monkeypatch.setattr(psutil, 'process_iter', None)
+    assert get_running_process().pid == os.getpid()
+
+
+def test_ignores_recorded_process_with_reused_pid(env: Env):
+    with open(env.game_process_file, 'w') as f:
+        json.dump({'pid': os.getpid(), 'create_time': 0}, f)
+    assert get_running_process() is None
+    assert not env.game_process_file.exists()
+
+
+@linux_only
+def test_finds_game_by_name_and_records_it(env: Env, fake_game):
+    assert get_running_process().pid == fake_game.pid
+    with open(env.game_process_file) as f:
+        assert json.load(f)['pid'] == fake_game.pid
+
+
+@linux_only
+def test_ignores_game_outside_app_root(env: Env, tmp_path_factory):
+    exe = tmp_path_factory.mktemp('elsewhere') / 'cataclysm-tiles'
+    shutil.copy('/bin/sleep', exe)
+    p = subprocess.Popen([str(exe), '30'])
+    try:
+        assert get_running_process() is None
+    finally:
+        p.kill()
+        p.wait()
+
+
+@linux_only
+def test_run_records_game_process(env: Env):
+    release = Release(tag_name='fake_build', file_name='fake.zip', download_url='', timestamp='')
+    release.install_target.mkdir()
+    shutil.copy('/bin/sleep', release.install_target / 'cataclysm-tiles')
+    with pytest.raises(SystemExit):
+        release.run()
+    with open(env.game_process_file) as f:
+        recorded = json.load(f)
+    # the fake game exits at once, as sleep needs an argument. It may have been reaped already
+    try:
+        os.waitpid(recorded['pid'], 0)
+    except ChildProcessError:
+        pass
+    assert get_running_process() is None
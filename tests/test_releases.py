@@ -0,0 +1,60 @@
+import pickle
+import sqlite3
+from catactl import Release, ReleaseList
+from catactl.config import Env
+
+
+def make_release(day: int, hour: int = 0) -> Release:
+    stamp = f'2021-05-{day:02}-{hour:02}00'
+    return Release(tag_name=f'cdda-experimental-{stamp}', file_name=f'cdda-windows-tiles-x64-{stamp}.zip',
+                   download_url=f'https://example.com/{stamp}.zip', timestamp=f'2021-05-{day:02}T{hour:02}:00:00Z',
+                   size=day * 100 + hour)
+
+
+def test_merges_releases_incrementally(env: Env):
+    ReleaseList.dump([make_release(2), make_release(1)])
+    ReleaseList.dump([make_release(3), make_release(2)])
+    assert [r.timestamp[:10] for r in ReleaseList.load()] == ['2021-05-03', '2021-05-02', '2021-05-01']
+
+
+def test_gets_release_by_tag(env: Env):
+    ReleaseList.dump([make_release(day, hour) for day in range(1, 29) for hour in range(24)])
+    assert ReleaseList.get('cdda-experimental-2021-05-17-0500') == make_release(17, 5)
+    assert ReleaseList.get('cdda-experimental-2021-05-17-0530') is None
+
+
+def test_finds_releases_by_prefix_and_date(env: Env):
+    ReleaseList.dump([make_release(day, hour) for day in range(1, 29) for hour in range(24)])
+    assert len(ReleaseList.find(prefix='cdda-experimental-2021-05-1')) == 10 * 24
+    assert len(ReleaseList.find(prefix='cdda-experimental-2021-05-17-05')) == 1
+    assert ReleaseList.find(since='2021-05-28') == [make_release(28, hour) for hour in reversed(range(24))]
+    assert ReleaseList.find(until='2021-05-01T01') == [make_release(1, 0)]
+    assert ReleaseList.find(since='2021-05-10', until='2021-05-11', prefix='cdda-experimental-2021-05-10-2') \
+        == [make_release(10, 23), make_release(10, 22), make_release(10, 21), make_release(10, 20)]
+
+
+def test_keeps_stable_and_experimental_releases_apart(env: Env):
+    ReleaseList.dump([make_release(2)])
+    stable = Release(tag_name='0.F-3', file_name='cdda-windows-tiles-x64-0.F-3.zip',
+                     download_url='https://example.com/0.F-3.zip', timestamp='2021-04-01T00:00:00Z')
+    ReleaseList.dump([stable], stable=True)
+    assert ReleaseList.latest() == make_release(2)
+    assert ReleaseList.latest(stable=True) == stable
+    assert ReleaseList.load() == [make_release(2)]
+
+
+def test_imports_pickled_list(env: Env):
+    legacy = env.download_folder / 'builds.pkl'
+    with open(legacy, 'wb') as f:
+        pickle.dump([make_release(2), make_release(1)], f)
+    assert ReleaseList.get('cdda-experimental-2021-05-01-0000') == make_release(1)
+    assert not legacy.exists()
+
+
+def test_drops_database_of_another_version(env: Env):
+    ReleaseList.dump([make_release(1)])
+    with sqlite3.connect(env.builds_data_file) as db:
+        db.execute('PRAGMA user_version = 0')
+    assert ReleaseList.load() == []
+    ReleaseList.dump([make_release(1)])
+    assert ReleaseList.load() == [make_release(1)]
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+import pytest
+
+# Most commands only look at local files. They must not pay for importing these
+heavy_modules = ['requests', 'psutil', 'multiprocessing', 'tarfile', 'sqlite3', 'concurrent.futures']
+
+# Budget for importing catactl, in microseconds as reported by -X importtime. Generous, to allow for slow machines:
+# importing everything eagerly took about 170ms on a fast one
+startup_budget = 120_000
+
+
+def import_times(tmpdir, *args) -> dict:
+    """Runs the catactl cli with the given arguments and returns the cumulative import time of each module"""
+    environment = {**os.environ, 'HOME': str(tmpdir), 'USERPROFILE': str(tmpdir)}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'from catactl.catactl import catactl; catactl()',
+                             *args], env=environment, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('package'):
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize('args', [['--help'], ['show', 'backups']])
+def test_starts_without_heavy_modules(tmpdir, args):
+    times = import_times(tmpdir, *args)
+    assert 'catactl.catactl' in times
+    assert [module for module in heavy_modules if module in times] == []
+
+
+@pytest.mark.parametrize('args', [['--help'], ['show', 'backups']])
+def test_starts_within_budget(tmpdir, args):
+    # the best of a few runs, so that a busy machine does not fail the test
+    best = min(import_times(tmpdir, *args)['catactl.catactl'] for _ in range(3))
+    assert best < startup_budget
@@ -0,0 +1,85 @@
+from pathlib import Path
+import os
+import zlib
+from catactl.store import ObjectStore, LinkStore
+
+
+def test_stores_content_by_digest(tmpdir):
+    store = ObjectStore(Path(tmpdir))
+    digest = store.digest(b'content')
+    assert digest not in store
+
+    assert store.put(b'content') > 0
+    assert digest in store
+    assert store.get(digest) == b'content'
+
+
+def test_stores_identical_content_once(tmpdir):
+    store = ObjectStore(Path(tmpdir))
+    store.put(b'content')
+    assert store.put(b'content') == 0
+    assert len([f for f in Path(tmpdir).glob('**/*') if f.is_file()]) == 1
+
+
+def test_lists_and_deletes_objects(tmpdir):
+    store = ObjectStore(Path(tmpdir) / 'objects')
+    assert list(store) == []
+
+    a = store.digest(b'a')
+    b = store.digest(b'b')
+    store.put(b'a')
+    store.put(b'b')
+    assert sorted(store) == sorted([a, b])
+
+    assert store.delete(a) > 0
+    assert list(store) == [b]
+
+
+def write_file(path: Path, content: bytes) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+def test_links_identical_files(tmpdir):
+    store = LinkStore(Path(tmpdir) / '.store')
+    a = write_file(Path(tmpdir) / 'a' / 'file', b'content')
+    b = write_file(Path(tmpdir) / 'b' / 'file', b'content')
+    assert not store.add(a, zlib.crc32(b'content'), 7)
+    assert store.add(b, zlib.crc32(b'content'), 7)
+    assert os.path.samefile(a, b)
+    assert b.read_bytes() == b'content'
+
+
+def test_links_known_member_without_extracting(tmpdir):
+    store = LinkStore(Path(tmpdir) / '.store')
+    crc = zlib.crc32(b'content')
+    assert not store.link(crc, 7, Path(tmpdir) / 'b')
+    store.add(write_file(Path(tmpdir) / 'a', b'content'), crc, 7)
+    store.save()
+
+    store = LinkStore(Path(tmpdir) / '.store')
+    assert store.link(crc, 7, Path(tmpdir) / 'b')
+    assert os.path.samefile(Path(tmpdir) / 'a', Path(tmpdir) / 'b')
+
+
+def test_collects_files_no_install_links_to(tmpdir):
+    store = LinkStore(Path(tmpdir) / '.store')
+    a = write_file(Path(tmpdir) / 'a', b'a')
+    b = write_file(Path(tmpdir) / 'b', b'b')
+    store.add(a, zlib.crc32(b'a'), 1)
+    store.add(b, zlib.crc32(b'b'), 1)
+    a.unlink()
+    assert store.gc() == (1, 1)
+    assert [entry.name for entry in store] == [ObjectStore.digest(b'b')[2:]]
+    assert not store.link(zlib.crc32(b'a'), 1, a)
+
+
+def test_collects_files_without_the_link_count_of_scandir(tmpdir, windows_scandir):
+    store = LinkStore(Path(tmpdir) / '.store')
+    a = write_file(Path(tmpdir) / 'a', b'a')
+    b = write_file(Path(tmpdir) / 'b', b'b')
+    store.add(a, zlib.crc32(b'a'), 1)
+    store.add(b, zlib.crc32(b'b'), 1)
+    a.unlink()
+    assert store.gc() == (1, 1)
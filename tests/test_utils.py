@@ -1,7 +1,7 @@
 import pytest
 import os
 from pathlib import Path
-from catactl import chunked, chdir
+from catactl import chunked, chdir, partition
 
 a = list(range(100))
 
@@ -28,6 +28,24 @@ def test_empty_input_means_zero_chunks_in_output():
     assert list(chunked([], 99)) == []
 
 
+def test_partition_balances_sizes():
+    sizes = {'a': 10, 'b': 7, 'c': 5, 'd': 4, 'e': 3, 'f': 1}
+    bins = partition(sizes, 2)
+    assert bins == [['a', 'd', 'f'], ['b', 'c', 'e']]
+
+
+def test_partition_puts_huge_items_alone():
+    sizes = {'huge': 100, **{f'small{i}': 1 for i in range(10)}}
+    bins = partition(sizes, 3)
+    assert bins[0] == ['huge']
+    assert sorted(len(b) for b in bins[1:]) == [5, 5]
+
+
+def test_partition_drops_empty_bins():
+    assert partition({'a': 1}, 4) == [['a']]
+    assert partition({}, 4) == []
+
+
 def test_chdir_enters_and_exits_folder(tmpdir):
     cwd = Path(os.getcwd())
     tmp = Path(tmpdir)
@@ -0,0 +1,113 @@
+import os
+import pytest
+import catactl.watch
+from catactl import Backup, Release, switch_install
+from catactl.config import Env
+from catactl.watch import SaveWatcher, watch
+
+
+@pytest.fixture
+def release(env: Env) -> Release:
+    """fixture with an installed build with a small save"""
+    release = Release(tag_name='fake_build', file_name='fake.zip', download_url='', timestamp='')
+    for world in ('a', 'b'):
+        maps = release.save_target / world / 'maps'
+        maps.mkdir(parents=True)
+        for i in range(5):
+            (maps / f'{i}.map').write_text(f'{world} {i}')
+    (release.save_target / 'empty').mkdir()
+    switch_install(release)
+    return release
+
+
+def save_file(path, content: str):
+    """writes a file the way the game does: to a temporary file that is renamed"""
+    tmp = path.with_name(f'{path.name}.temp')
+    tmp.write_text(content)
+    os.replace(tmp, path)
+
+
+def test_finds_the_whole_save(release: Release):
+    watcher = SaveWatcher(release, use_notifications=False)
+    assert len(watcher.snapshot) == 10
+    assert 'save/empty' in watcher.folders
+    assert watcher.poll() == set()
+
+
+def test_polling_finds_changes_in_changed_folders_only(release: Release, monkeypatch):
+    watcher = SaveWatcher(release, use_notifications=False)
+    scanned = []
+    scan_folder = catactl.watch.scan_folder
+    monkeypatch.setattr(catactl.watch, 'scan_folder', lambda folder: scanned.append(folder) or scan_folder(folder))
+
+    save_file(release.save_target / 'a' / 'maps' / '0.map', 'changed content')
+    (release.save_target / 'a' / 'maps' / '1.map').unlink()
+    (release.save_target / 'empty' / 'new').mkdir()
+    (release.save_target / 'empty' / 'new' / 'file').write_text('new')
+
+    assert watcher.poll() == {'save/a/maps/0.map', 'save/a/maps/1.map', 'save/empty/new/file'}
+    assert sorted(scanned) == ['save/a/maps', 'save/empty', 'save/empty/new']
+    assert 'save/a/maps/1.map' not in watcher.snapshot
+    assert watcher.snapshot['save/a/maps/0.map']['size'] == len('changed content')
+
+
+def test_polling_finds_removed_folders(release: Release):
+    watcher = SaveWatcher(release, use_notifications=False)
+    for path in (release.save_target / 'b' / 'maps').iterdir():
+        path.unlink()
+    (release.save_target / 'b' / 'maps').rmdir()
+
+    assert watcher.poll() == {f'save/b/maps/{i}.map' for i in range(5)}
+    assert 'save/b/maps' not in watcher.folders
+
+
+def test_watch_backs_up_what_changed_once_it_settles(release: Release):
+    polls = 0
+
+    def until():
+        """changes the save twice in a row, then waits for the backup"""
+        nonlocal polls
+        polls += 1
+        if polls in (2, 3):
+            save_file(release.save_target / 'a' / 'maps' / f'{polls}.map', f'changed {polls}')
+        return polls > 10
+
+    Backup.backup(release)
+    watch(release, settle=0.02, interval=0.01, mode='incremental', until=until, use_notifications=False)
+
+    backups = Backup.get_list()
+    assert len(backups) == 2  # the two changes are backed up together
+    metadata = Backup.read_metadata(backups[-1])
+    assert metadata["mode"] == 'incremental'
+    assert len(metadata["files"]) == 10
+    assert sorted(Backup.read_index(backups[-1])["files"]) == ['save/a/maps/2.map', 'save/a/maps/3.map']
+
+
+def test_watch_retries_failed_backup(release: Release, monkeypatch):
+    polls = 0
+
+    def until():
+        nonlocal polls
+        polls += 1
+        if polls == 2:
+            save_file(release.save_target / 'a' / 'maps' / '2.map', 'changed')
+        return polls > 20
+
+    Backup.backup(release)
+    backup = Backup.backup
+    attempts = []
+
+    def fails_once(*args, **kwargs):
+        attempts.append(kwargs)
+        if len(attempts) == 1:
+            print('ERROR: backup failed')
+            raise SystemExit(1)
+        return backup(*args, **kwargs)
+    monkeypatch.setattr(Backup, 'backup', fails_once)
+    watch(release, settle=0.02, interval=0.01, until=until, use_notifications=False)
+
+    assert len(attempts) == 2
+    assert attempts[-1]["mode"] == 'dedup'
+    backups = Backup.get_list()
+    assert len(backups) == 2
+    assert Backup.read_metadata(backups[-1])["files"]['save/a/maps/2.map']["size"] == len('changed')